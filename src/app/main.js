@@ -200,7 +200,15 @@ function main(args) {
         messenger.on('message', (data) => {
             switch (data.sender) {
                 case 'logger':
-                    logger.append(data.message)
+                    if (data.history) {
+                        logger.restore()
+                    }
+                    if (data.dropped) {
+                        logger.append(`[WARNING] 日志过多，省略了 ${data.dropped} 条`)
+                    }
+                    for (let entry of data.messages) {
+                        logger.append(entry.message)
+                    }
                     win.webContents.send('logger-update')
                     break
                 case 'worker':
@@ -231,6 +239,9 @@ function main(args) {
                         body: noticeBody
                     })).show()
                     break
+                case 'exporter':
+                    win.webContents.send('export-progress', data)
+                    break
             }
         })
     
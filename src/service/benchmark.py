@@ -0,0 +1,85 @@
+# encoding: utf-8
+import argparse
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+from tasks import parsers
+from setting import DEFAULT_CACHE_PATH
+
+
+# 按 URL 判断页面类型，依次匹配
+PAGE_TYPES = OrderedDict([
+    ('status_list', (re.compile(r'/people/[^/]+/statuses'), parsers.parse_status_page)),
+    ('note_list', (re.compile(r'/people/[^/]+/notes'), parsers.parse_note_list_page)),
+    ('photo_album_list', (re.compile(r'/people/[^/]+/photos'), parsers.parse_photo_album_list_page)),
+    ('like_list', (re.compile(r'/people/[^/]+/likes'), parsers.parse_like_list_page)),
+    ('broadcast_comments', (re.compile(r'/people/[^/]+/status/\d+'), parsers.parse_broadcast_comments_page)),
+    ('note', (re.compile(r'/note/\d+'), parsers.parse_note_page)),
+    ('photo_album', (re.compile(r'/photos/album/\d+'), parsers.parse_photo_album_page)),
+])
+
+
+def load_pages(cache_path):
+    """
+    读取 HTTP 缓存中的页面，返回 {页面类型: [正文, ...]}
+    """
+    pages = OrderedDict((name, []) for name in PAGE_TYPES)
+    for directory, _, filenames in os.walk(os.path.join(cache_path, 'http')):
+        for filename in filenames:
+            if filename.endswith('.tmp'):
+                continue
+            with open(os.path.join(directory, filename), 'rb') as f:
+                try:
+                    meta = json.loads(f.readline().decode())
+                except ValueError:
+                    continue
+                body = f.read()
+            url = meta.get('final_url') or meta.get('url') or ''
+            for name, (pattern, _) in PAGE_TYPES.items():
+                if pattern.search(url):
+                    pages[name].append(body.decode(meta.get('encoding') or 'utf-8', 'replace'))
+                    break
+    return pages
+
+
+def run(pages, repeat):
+    """
+    逐类解析页面并输出每秒解析的页数和数据量
+    """
+    print('{0:<20}{1:>8}{2:>12}{3:>12}{4:>12}'.format('page type', 'pages', 'seconds', 'pages/s', 'MB/s'))
+    for name, texts in pages.items():
+        if not texts:
+            continue
+        parse_page = PAGE_TYPES[name][1]
+        size = sum(len(text.encode()) for text in texts) * repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in texts:
+                parse_page(text)
+        elapsed = time.perf_counter() - start
+        count = len(texts) * repeat
+        print('{0:<20}{1:>8}{2:>12.3f}{3:>12.1f}{4:>12.2f}'.format(
+            name, count, elapsed, count / elapsed, size / elapsed / 1024 / 1024
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark page parsers against the http cache')
+    parser.add_argument('-c', '--cache', default=DEFAULT_CACHE_PATH,
+                        metavar='path', help='cache path')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        metavar='count', help='parse every page this many times')
+    args = parser.parse_args()
+
+    pages = load_pages(args.cache)
+    if not any(pages.values()):
+        print('no cached pages found in {0}'.format(os.path.join(args.cache, 'http')))
+        return
+    run(pages, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
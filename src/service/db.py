@@ -1,33 +1,98 @@
 # encoding: utf-8
 from peewee import *
+from peewee import FieldAccessor, NodeList, Value
+from playhouse.migrate import SqliteMigrator, migrate
+from collections import OrderedDict
+from urllib.request import pathname2url
+import ast
 import datetime
+import itertools
+import json
+import os
+import re
+import sqlite3
+import struct
+import zlib
 
 
 DATEBASE_PATH = ''
+DATEBASE_PRAGMAS = ()
+# 连接参数：WAL 模式下读写互不阻塞，长时间的抓取事务不会卡住界面的查询
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),
+    ('temp_store', 'memory'),
+    ('busy_timeout', 60 * 1000),
+)
+SQLITE_MAX_VARIABLES = 999
+# SQLite 3.24.0 开始支持 INSERT ... ON CONFLICT DO UPDATE
+SQLITE_SUPPORTS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def _json1_supported():
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute("SELECT json_extract('{}', '$.a')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+# 没有编译 JSON1 扩展时不建 JSON 字段上的索引，也不能在 SQL 中按 JSON 内容筛选
+SQLITE_SUPPORTS_JSON = _json1_supported()
+
+
+class Database(SqliteDatabase):
+    """
+    设置了 writer 时，连接只用于查询，写入和事务交给服务进程中的写入线程（见 dbwriter）
+    """
+
+    writer = None
+
+    def _connect(self, *args, **kwargs):
+        conn = super()._connect(*args, **kwargs)
+        if self.writer is not None:
+            conn = self.writer.connect(conn)
+        return conn
+
+
+dbo = Database(None)
+dbo_reader = SqliteDatabase(None)
+
+
+def _reader_pragmas():
+    # 日志模式是数据库文件的属性，只读连接无法也不需要设置
+    pragmas = [(name, value) for name, value in DATEBASE_PRAGMAS if name != 'journal_mode']
+    pragmas.append(('query_only', 1))
+    return pragmas
 
-dbo = SqliteDatabase(None)
 
-def init(db_path, create_tables=True):
+def init(db_path, create_tables=True, pragmas=DEFAULT_PRAGMAS, writer=None):
     """
-    初始化数据库
+    初始化数据库。工作进程传入 writer，只在本地读取，所有写入交给写入线程
     """
-    global DATEBASE_PATH
+    global DATEBASE_PATH, DATEBASE_PRAGMAS
     DATEBASE_PATH = db_path
-    dbo.init(db_path, timeout=60)
+    DATEBASE_PRAGMAS = tuple(pragmas)
+    dbo.writer = writer
+    dbo.init(db_path, timeout=60, pragmas=_reader_pragmas() if writer is not None else list(DATEBASE_PRAGMAS))
 
     if create_tables:
         with dbo:
+            is_new_database = not Account.table_exists()
+            # 先升级已有的表，新增字段上的索引才能创建
+            migrate_schema(is_new_database)
             dbo.create_tables([
                 Account,
                 User,
-                UserHistorical,
                 UserExtra,
                 Movie,
-                MovieHistorical,
                 Book,
-                BookHistorical,
                 Music,
-                MusicHistorical,
                 Setting,
                 Following,
                 FollowingHistorical,
@@ -46,14 +111,482 @@ def init(db_path, create_tables=True):
                 Timeline,
                 Comment,
                 Note,
-                NoteHistorical,
                 PhotoAlbum,
-                PhotoAlbumHistorical,
                 PhotoPicture,
-                PhotoPictureHistorical,
                 Favorite,
                 FavoriteHistorical,
+                TaskState,
+                Checkpoint,
+                CheckpointPage,
+                Revision,
+                Counter,
+                CompressionDictionary,
             ])
+            create_json_indexes()
+            load_dictionaries()
+            train_dictionaries()
+    else:
+        load_dictionaries()
+
+
+def _migrate_attachment_local(migrator):
+    """
+    附件按内容寻址存储后，多个附件可以共用一个本地文件
+    """
+    migrate(
+        migrator.drop_index('attachment', 'attachment_local'),
+        migrator.add_index('attachment', ('local',), False),
+    )
+
+
+def _migrate_timeline_sequence(migrator):
+    """
+    时间轴按序号排列，不再依赖插入顺序。原有记录是按从旧到新的顺序插入的，序号沿用 id
+    """
+    migrate(
+        migrator.add_column('timeline', 'sequence', BigIntegerField(null=True)),
+    )
+    dbo.execute_sql('UPDATE "timeline" SET "sequence" = "id"')
+    migrate(
+        migrator.add_index('timeline', ('user_id', 'sequence'), False),
+    )
+
+
+# 改为记录反向差异的历史表：(原始表, 历史表, 历史表中指向原始对象的字段)
+_REVISION_TABLES = (
+    ('user', 'user_historical', 'user_id'),
+    ('movie', 'movie_historical', 'movie_id'),
+    ('book', 'book_historical', 'book_id'),
+    ('music', 'music_historical', 'music_id'),
+    ('note', 'note_historical', 'note_id'),
+    ('photo_album', 'photo_album_historical', 'photo_album_id'),
+    ('photo_picture', 'photo_picture_historical', 'photo_picture_id'),
+)
+
+
+def _revision_rows(table, versions, current, columns):
+    """
+    versions 是一个对象按版本从旧到新排列的历史行，current 是它的当前行，返回每个历史版本的反向差异。
+    当前行已经不存在时（current 为 None）没有可以比较的新版本，每个历史版本保存完整的字段
+    """
+    if current is None:
+        for state in versions:
+            changes = {name: value for name, value in zip(columns, state[2:]) if name != 'version'}
+            yield table, state[0], state[1], json.dumps(changes, ensure_ascii=False), datetime.datetime.now()
+        return
+    states = versions + [current]
+    for state, newer in zip(states, states[1:]):
+        changes = {
+            name: value for name, value, newer_value in zip(columns, state[2:], newer[2:])
+            if name != 'version' and value != newer_value
+        }
+        yield table, state[0], state[1], json.dumps(changes, ensure_ascii=False), datetime.datetime.now()
+
+
+def _migrate_revisions(migrator):
+    """
+    历史表中每个版本都是整行复制，改为只保存变化的字段，然后删除历史表。
+    当前行已经被删除的对象，历史版本按完整的字段保存
+    """
+    Revision.create_table()
+    tables = dbo.get_tables()
+    for table, historical_table, foreign_key in _REVISION_TABLES:
+        if historical_table not in tables:
+            continue
+        source_columns = set(column.name for column in dbo.get_columns(table))
+        columns = [
+            column.name for column in dbo.get_columns(historical_table)
+            if column.name in source_columns and column.name not in ('id', foreign_key)
+        ]
+        select_columns = ', '.join('"{0}"'.format(name) for name in columns)
+        history = dbo.execute_sql(
+            'SELECT "{0}", "version", {1} FROM "{2}" WHERE "{0}" IS NOT NULL ORDER BY "{0}", "version", "id"'.format(
+                foreign_key, select_columns, historical_table)
+        )
+        insert_sql = 'INSERT OR IGNORE INTO "revision" ("target_type", "target_id", "version", "changes", "created_at") VALUES (?, ?, ?, ?, ?)'
+
+        rows = []
+        object_id = None
+        versions = []
+        for state in itertools.chain(history, [(None,)]):
+            if state[0] != object_id:
+                current = dbo.execute_sql(
+                    'SELECT "id", "version", {0} FROM "{1}" WHERE "id" = ?'.format(select_columns, table), [object_id]
+                ).fetchone() if versions else None
+                if versions:
+                    # 同一版本有多行时以最后一行为准
+                    versions = list(OrderedDict((version[1], version) for version in versions).values())
+                    rows.extend(_revision_rows(table, versions, current, columns))
+                if len(rows) >= SQLITE_MAX_VARIABLES:
+                    dbo.cursor().executemany(insert_sql, rows)
+                    rows = []
+                object_id = state[0]
+                versions = []
+            versions.append(state)
+        dbo.cursor().executemany(insert_sql, rows)
+        dbo.execute_sql('DROP TABLE "{0}"'.format(historical_table))
+
+
+def _migrate_compressed_columns(migrator):
+    """
+    原始 HTML 改为压缩存储：训练各列的字典，然后压缩已有的行
+    """
+    CompressionDictionary.create_table()
+    load_dictionaries()
+    train_dictionaries()
+    tables = dbo.get_tables()
+    for table, column in COMPRESSED_COLUMNS:
+        if table not in tables:
+            continue
+        select_sql = 'SELECT "id", "{1}" FROM "{0}" WHERE "id" > ? AND typeof("{1}") = \'text\' ORDER BY "id" LIMIT ?'.format(table, column)
+        update_sql = 'UPDATE "{0}" SET "{1}" = ? WHERE "id" = ?'.format(table, column)
+        last_id = 0
+        while True:
+            rows = dbo.execute_sql(select_sql, [last_id, SQLITE_MAX_VARIABLES]).fetchall()
+            if not rows:
+                break
+            dbo.cursor().executemany(update_sql, [(compress_text(value, (table, column)), row_id) for row_id, value in rows])
+            last_id = rows[-1][0]
+
+
+def _migrate_json_columns(migrator):
+    """
+    字典和列表改为按 JSON 保存，历史版本中的旧值一并转换
+    """
+    tables = dbo.get_tables()
+    json_columns = {}
+    for table, columns in JSON_COLUMNS:
+        json_columns[table] = columns
+        if table not in tables:
+            continue
+        select_columns = ', '.join('"{0}"'.format(column) for column in columns)
+        select_sql = 'SELECT "id", {0} FROM "{1}" WHERE "id" > ? ORDER BY "id" LIMIT ?'.format(select_columns, table)
+        update_sql = 'UPDATE "{0}" SET {1} WHERE "id" = ?'.format(
+            table, ', '.join('"{0}" = ?'.format(column) for column in columns))
+        last_id = 0
+        while True:
+            rows = dbo.execute_sql(select_sql, [last_id, SQLITE_MAX_VARIABLES]).fetchall()
+            if not rows:
+                break
+            dbo.cursor().executemany(update_sql, [
+                [_json_from_repr(value) for value in row[1:]] + [row[0]] for row in rows
+            ])
+            last_id = rows[-1][0]
+
+    revisions = dbo.execute_sql(
+        'SELECT "id", "target_type", "changes" FROM "revision" WHERE "target_type" IN ({0})'.format(
+            ', '.join('?' * len(json_columns))),
+        list(json_columns)
+    ).fetchall()
+    updates = []
+    for revision_id, target_type, changes in revisions:
+        changes = json.loads(changes)
+        converted = [name for name in changes if name in json_columns[target_type] and isinstance(changes[name], str)]
+        if converted:
+            for name in converted:
+                changes[name] = _json_from_repr(changes[name])
+            updates.append((json.dumps(changes, ensure_ascii=False), revision_id))
+    dbo.cursor().executemany('UPDATE "revision" SET "changes" = ? WHERE "id" = ?', updates)
+
+
+# 按顺序执行的数据库结构升级，已执行的个数记录在 PRAGMA user_version 中
+MIGRATIONS = [
+    _migrate_attachment_local,
+    _migrate_timeline_sequence,
+    _migrate_revisions,
+    _migrate_compressed_columns,
+    _migrate_json_columns,
+]
+
+
+def migrate_schema(is_new_database=False):
+    """
+    升级数据库结构。新建的数据库已经是最新结构，不需要升级
+    """
+    version = dbo.execute_sql('PRAGMA user_version').fetchone()[0]
+    if not is_new_database:
+        migrator = SqliteMigrator(dbo)
+        for migration in MIGRATIONS[version:]:
+            with dbo.atomic():
+                migration(migrator)
+    dbo.execute_sql('PRAGMA user_version = {0}'.format(len(MIGRATIONS)))
+
+
+def init_reader():
+    """
+    初始化只读连接，供界面浏览数据使用。必须在 init 之后调用
+    """
+    uri = 'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(DATEBASE_PATH)))
+    dbo_reader.init(uri, timeout=60, pragmas=_reader_pragmas(), uri=True)
+
+
+def read_only(query):
+    """
+    让查询使用只读连接，供界面浏览数据使用。只影响这个查询，
+    查询结果中的对象再发起的查询（例如访问没有 join 的外键）仍然使用默认连接
+    """
+    return query.bind(dbo_reader)
+
+
+def pragma_report(database=dbo):
+    """
+    返回连接实际生效的参数
+    """
+    return OrderedDict(
+        (name, database.execute_sql('PRAGMA {0}'.format(name)).fetchone()[0])
+        for name, _ in DATEBASE_PRAGMAS
+    )
+
+
+def chunked(items, size):
+    """
+    把列表切分成不超过 size 的片段
+    """
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+# JSON 字段：(表, [列])。之前按 Python 的 repr 保存
+JSON_COLUMNS = (
+    ('movie', ['rating', 'author', 'attrs', 'tags']),
+    ('book', ['rating', 'author', 'tags', 'translator', 'images']),
+    ('music', ['rating', 'author', 'attrs', 'tags']),
+    ('my_movie', ['rating', 'tags']),
+    ('my_book', ['rating', 'tags']),
+    ('my_music', ['rating', 'tags']),
+    ('my_movie_historical', ['rating', 'tags']),
+    ('my_book_historical', ['rating', 'tags']),
+    ('my_music_historical', ['rating', 'tags']),
+)
+# 常用筛选条件上的表达式索引：(索引名, 表, 列, JSON 路径)。查询时用 JSONField.extract 生成相同的表达式
+JSON_INDEXES = (
+    ('movie_rating_average', 'movie', 'rating', '$.average'),
+    ('movie_year', 'movie', 'attrs', '$.year[0]'),
+    ('book_rating_average', 'book', 'rating', '$.average'),
+    ('music_rating_average', 'music', 'rating', '$.average'),
+)
+
+
+class JSONField(TextField):
+    """
+    以 JSON 保存的字典或列表
+    """
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        return json.dumps(value, ensure_ascii=False)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def extract(self, path):
+        """
+        json_extract(字段, path)。路径写成字面量，查询才能用上 JSON_INDEXES 中的索引
+        """
+        return fn.json_extract(self, SQL(_json_path(path)))
+
+    def has_element(self, path, value):
+        """
+        path 处的列表中包含 value
+        """
+        return NodeList((
+            SQL('EXISTS (SELECT 1 FROM json_each('), self, SQL(', {0}) WHERE "value" = '.format(_json_path(path))),
+            Value(value), SQL(')')
+        ), glue='')
+
+
+def _json_path(path):
+    return "'{0}'".format(path.replace("'", "''"))
+
+
+def _json_from_repr(value):
+    """
+    把按 Python repr 保存的值转换为 JSON，已经是 JSON 的值原样返回
+    """
+    if value is None:
+        return None
+    try:
+        return json.dumps(ast.literal_eval(value), ensure_ascii=False)
+    except (ValueError, SyntaxError):
+        pass
+    try:
+        json.loads(value)
+        return value
+    except ValueError:
+        return json.dumps(value, ensure_ascii=False)
+
+
+def create_json_indexes():
+    if not SQLITE_SUPPORTS_JSON:
+        return
+    for name, table, column, path in JSON_INDEXES:
+        dbo.execute_sql('CREATE INDEX IF NOT EXISTS "{0}" ON "{1}" (json_extract("{2}", {3}))'.format(
+            name, table, column, _json_path(path)))
+
+
+# 压缩存储的文本列：(表, 列)。内容是重复度很高的豆瓣页面 HTML，每列训练一个预设字典
+COMPRESSED_COLUMNS = (
+    ('broadcast', 'content'),
+    ('comment', 'content'),
+    ('note', 'content'),
+)
+# 短于这个字节数的文本不压缩
+COMPRESS_MIN_SIZE = 128
+COMPRESS_LEVEL = 6
+# zlib 的预设字典最多只用到最后 32KB
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLES = 1000
+_DICTIONARY_TOKEN = re.compile(r'<[^<>]{1,200}>|[^<>]{4,200}')
+# 数据头：原文 / 压缩数据（之后是 2 字节的字典 id，0 表示不用字典）
+_RAW = b'\x00'
+_DEFLATE = b'\x01'
+# {字典 id: 字典}，{(表, 列): (字典 id, 字典)}，在 init 时载入
+_dictionaries = {}
+_current_dictionaries = {}
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    从样本中挑出在多个样本中重复出现的标签和文字片段，拼成预设字典。
+    zlib 优先匹配距离近的内容，收益最大的片段放在最后
+    """
+    frequency = {}
+    for sample in samples:
+        for token in set(_DICTIONARY_TOKEN.findall(sample)):
+            frequency[token] = frequency.get(token, 0) + 1
+    tokens = sorted(
+        (token for token, count in frequency.items() if count > 1),
+        key=lambda token: frequency[token] * len(token), reverse=True
+    )
+    selected = []
+    total = 0
+    for token in tokens:
+        data = token.encode()
+        if total + len(data) > size:
+            continue
+        selected.append(data)
+        total += len(data)
+    return b''.join(reversed(selected))
+
+
+def compress_text(value, column):
+    """
+    把文本压缩成 CompressedTextField 的存储格式，使用 column 当前的字典
+    """
+    data = value.encode()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return _RAW + data
+    dictionary_id, dictionary = _current_dictionaries.get(column, (0, None))
+    if dictionary:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + 3 >= len(data) + 1:
+        return _RAW + data
+    return _DEFLATE + struct.pack('<H', dictionary_id) + compressed
+
+
+def decompress_text(value):
+    """
+    还原 compress_text 的结果。未迁移的旧数据是文本，原样返回
+    """
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value[:1] == _RAW:
+        return value[1:].decode()
+    dictionary_id, = struct.unpack('<H', value[1:3])
+    if dictionary_id:
+        decompressor = zlib.decompressobj(zdict=_dictionaries[dictionary_id])
+    else:
+        decompressor = zlib.decompressobj()
+    return (decompressor.decompress(value[3:]) + decompressor.flush()).decode()
+
+
+@dbo.func('decompress_text', 1)
+@dbo_reader.func('decompress_text', 1)
+def _sql_decompress_text(value):
+    return decompress_text(value)
+
+
+class CompressedTextAccessor(FieldAccessor):
+    """
+    读取字段时才解压，解压结果缓存在对象中
+    """
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        value = instance.__data__.get(self.name)
+        if isinstance(value, (bytes, memoryview)):
+            value = decompress_text(value)
+            instance.__data__[self.name] = value
+        return value
+
+
+class CompressedTextField(BlobField):
+    """
+    压缩存储的文本字段。查询结果保持压缩状态，访问属性时才解压；
+    在 SQL 中按内容过滤时用 fn.decompress_text(字段)
+    """
+    accessor_class = CompressedTextAccessor
+
+    @property
+    def compressed_column(self):
+        return self.model._meta.table_name, self.column_name
+
+    def db_value(self, value):
+        if value is None or isinstance(value, (bytes, memoryview)):
+            return value
+        return compress_text(str(value), self.compressed_column)
+
+    def python_value(self, value):
+        return value
+
+    def text_value(self, value):
+        """
+        字段值（文本或存储格式）对应的文本
+        """
+        return decompress_text(value)
+
+
+def load_dictionaries():
+    """
+    载入压缩字典。每列使用最新的字典压缩，旧字典用于解压之前的数据
+    """
+    _dictionaries.clear()
+    _current_dictionaries.clear()
+    if not CompressionDictionary.table_exists():
+        return
+    for dictionary in CompressionDictionary.select().order_by(CompressionDictionary.id):
+        data = bytes(dictionary.data)
+        _dictionaries[dictionary.id] = data
+        _current_dictionaries[(dictionary.target_table, dictionary.target_column)] = (dictionary.id, data)
+
+
+def train_dictionaries():
+    """
+    为还没有字典且已有足够数据的列训练字典。训练之前写入的行不使用字典，仍然可以正常读取
+    """
+    for table, column in COMPRESSED_COLUMNS:
+        if (table, column) in _current_dictionaries:
+            continue
+        count = dbo.execute_sql('SELECT COUNT(*) FROM "{0}" WHERE "{1}" IS NOT NULL'.format(table, column)).fetchone()[0]
+        if count < DICTIONARY_SAMPLES:
+            continue
+        samples = [
+            decompress_text(value) for value, in dbo.execute_sql(
+                'SELECT "{1}" FROM "{0}" WHERE "{1}" IS NOT NULL ORDER BY RANDOM() LIMIT ?'.format(table, column),
+                [DICTIONARY_SAMPLES]
+            )
+        ]
+        dictionary = CompressionDictionary.create(target_table=table, target_column=column, data=train_dictionary(samples))
+        _dictionaries[dictionary.id] = bytes(dictionary.data)
+        _current_dictionaries[(table, column)] = (dictionary.id, bytes(dictionary.data))
 
 
 class BaseModel(Model):
@@ -61,6 +594,8 @@ class BaseModel(Model):
         database = dbo
 
     _attrs_to_compare_ = []
+    # 经常变化的计数，不参与 equals 比较，也不产生新版本。已有对象的计数变化时记入 Counter
+    _counters_ = []
 
     def equals(self, field_values, strict=False):
         """
@@ -102,6 +637,297 @@ class BaseModel(Model):
         
         return cls.create(**field_values)
 
+    @classmethod
+    def bulk_upsert(cls, rows, key='douban_id', update=None, preserve=(), historical=None, historical_defaults=None, revisions=False, touch=()):
+        """
+        批量插入或更新，返回与 rows 顺序一致的 id 列表
+
+        rows 是字段值字典的列表，key 是唯一键的字段名（联合唯一键用元组）。已存在的行更新 update
+        中的字段，默认为唯一键以外提供的所有字段；某一行没有提供的字段保留原值。preserve 中的字段只在原值为空时才更新。
+        version 不会被覆盖：没有指定 historical 和 revisions 时每次更新都递增版本号。
+        指定 historical 时，内容有变化（equals 为假）的行先整体复制到历史表，再更新并递增版本号；
+        revisions 为真时，内容有变化的行只把将被覆盖的字段的旧值记入 Revision，再更新并递增版本号。
+        内容没有变化的行只更新 touch 中的字段和有变化的计数。已有对象的计数（_counters_）变化时记入 Counter，
+        新插入的行不记录。
+        """
+        if not rows:
+            return []
+
+        fields = cls._meta.fields
+        key_names = (key,) if isinstance(key, str) else tuple(key)
+        rows = [{name: value for name, value in row.items() if name in fields} for row in rows]
+        keys = [cls._row_key(key_names, row) for row in rows]
+        # 同一批中唯一键重复的行以最后一行为准
+        unique_rows = OrderedDict(zip(keys, rows))
+
+        provided_names = []
+        for row in rows:
+            provided_names.extend(name for name in row if name not in provided_names)
+        if update is None:
+            update = provided_names
+        update = [name for name in update if name in provided_names and name not in key_names and name != 'id']
+
+        with cls._meta.database.atomic():
+            tracked = historical is not None or revisions
+            existing = cls._select_by_keys(key_names, list(unique_rows), full=tracked)
+            counter_names = [name for name in cls._counters_ if name in update]
+            counter_changes = OrderedDict()
+            for row_key, row in unique_rows.items():
+                if any(name not in row for name in counter_names):
+                    continue
+                obj = existing.get(row_key)
+                if obj is None:
+                    continue
+                values = cls._counter_values(row, counter_names)
+                if counter_names and values != cls._counter_values(obj.__data__, counter_names):
+                    counter_changes[row_key] = (values, row.get('updated_at'))
+
+            if not tracked:
+                write_rows = unique_rows
+                bump_version = 'version' in update
+            else:
+                write_rows = OrderedDict()
+                changed = []
+                touch_groups = OrderedDict()
+                for row_key, row in unique_rows.items():
+                    obj = existing.get(row_key)
+                    if obj is None:
+                        write_rows[row_key] = row
+                    elif not obj.equals(row):
+                        write_rows[row_key] = row
+                        changed.append((obj, row))
+                    else:
+                        touch_names = list(touch) + (counter_names if row_key in counter_changes else [])
+                        if touch_names:
+                            touch_values = tuple((name, row.get(name)) for name in touch_names)
+                            touch_groups.setdefault(touch_values, []).append(obj.id)
+                if historical is not None:
+                    cls._snapshot(historical, [obj.id for obj, _ in changed], historical_defaults or {})
+                if revisions:
+                    cls._save_revisions(changed, update, preserve)
+                for touch_values, ids in touch_groups.items():
+                    for chunk in chunked(ids, SQLITE_MAX_VARIABLES):
+                        cls.update(**dict(touch_values)).where(cls.id.in_(chunk)).execute()
+                bump_version = 'version' in fields
+            update = [name for name in update if name != 'version']
+
+            # 按行提供的字段分组写入，每组只更新这组行提供的字段
+            shapes = OrderedDict()
+            for row_key, row in write_rows.items():
+                shapes.setdefault(frozenset(row), OrderedDict())[row_key] = row
+            for names, shape_rows in shapes.items():
+                cls._upsert(shape_rows, existing, key_names, [name for name in update if name in names], preserve, bump_version)
+
+            ids = {row_key: obj.id for row_key, obj in existing.items()}
+            inserted_keys = [row_key for row_key in unique_rows if row_key not in ids]
+            if inserted_keys:
+                ids.update((row_key, obj.id) for row_key, obj in cls._select_by_keys(key_names, inserted_keys).items())
+
+            Counter.record(cls, counter_names, [
+                (ids[row_key], values, recorded_at) for row_key, (values, recorded_at) in counter_changes.items()
+                if ids.get(row_key) is not None
+            ])
+
+        return [ids.get(row_key) for row_key in keys]
+
+    @classmethod
+    def _counter_values(cls, data, names):
+        fields = cls._meta.fields
+        return tuple(fields[name].db_value(data.get(name)) for name in names)
+
+    @classmethod
+    def _row_key(cls, key_names, row):
+        fields = cls._meta.fields
+        return tuple(fields[name].db_value(row.get(name)) for name in key_names)
+
+    @classmethod
+    def _select_by_keys(cls, key_names, keys, full=False):
+        """
+        按唯一键批量查询已存在的行，返回 {唯一键: 模型对象}。full 为假时只查询 id 和唯一键
+        """
+        fields = cls._meta.fields
+        # 联合唯一键按前缀分组，每组只对最后一个字段做 IN 查询
+        groups = OrderedDict()
+        for row_key in keys:
+            groups.setdefault(row_key[:-1], []).append(row_key[-1])
+
+        columns = [] if full else [cls.id] + [fields[name] for name in key_names] + [fields[name] for name in cls._counters_]
+        last_field = fields[key_names[-1]]
+        result = {}
+        for prefix, values in groups.items():
+            for chunk in chunked(values, SQLITE_MAX_VARIABLES - len(prefix)):
+                conditions = [last_field.in_(chunk)]
+                conditions.extend(fields[name] == value for name, value in zip(key_names, prefix))
+                for obj in cls.select(*columns).where(*conditions):
+                    row_key = tuple(fields[name].db_value(obj.__data__.get(name)) for name in key_names)
+                    result[row_key] = obj
+        return result
+
+    @classmethod
+    def _snapshot(cls, historical, ids, defaults):
+        """
+        把指定的行复制到历史表
+        """
+        if not ids:
+            return
+        historical_fields = historical._meta.fields
+        names = [name for name in cls._meta.sorted_field_names if name in historical_fields and name != 'id']
+        source = [cls._meta.fields[name] for name in names]
+        target = [historical_fields[name] for name in names]
+        # 历史表中指向原始对象的外键与原始表同名
+        if cls._meta.table_name in historical_fields:
+            source.append(cls.id)
+            target.append(historical_fields[cls._meta.table_name])
+        for name, value in defaults.items():
+            source.append(SQL('?', [value]))
+            target.append(historical_fields[name])
+
+        for chunk in chunked(ids, SQLITE_MAX_VARIABLES - len(defaults)):
+            historical.insert_from(cls.select(*source).where(cls.id.in_(chunk)), target).execute()
+
+    @classmethod
+    def _save_revisions(cls, changed, update, preserve):
+        """
+        记录即将被覆盖的版本：只保存值会改变的字段的旧值
+        """
+        fields = cls._meta.fields
+        rows = []
+        for obj, row in changed:
+            changes = {}
+            for name in update:
+                if name == 'version' or name in cls._counters_ or name not in row:
+                    continue
+                field = fields[name]
+                # 压缩字段按文本比较和保存，旧值可能是用旧字典压缩的
+                to_value = field.text_value if isinstance(field, CompressedTextField) else field.db_value
+                old_value = to_value(obj.__data__.get(name))
+                if name in preserve and old_value is not None:
+                    continue
+                if old_value != to_value(row.get(name)):
+                    changes[name] = old_value
+            rows.append({
+                'target_type': cls._meta.table_name,
+                'target_id': obj.id,
+                'version': obj.version,
+                'changes': json.dumps(changes, ensure_ascii=False, default=str),
+            })
+        for chunk in chunked(rows, SQLITE_MAX_VARIABLES // 4):
+            Revision.insert_many(chunk).on_conflict_ignore().execute()
+
+    def revisions(self):
+        """
+        对象的历史版本，从新到旧
+        """
+        return Revision.select().where(
+            Revision.target_type == self._meta.table_name,
+            Revision.target_id == self.id
+        ).order_by(Revision.version.desc())
+
+    def at_version(self, version):
+        """
+        还原对象的指定版本，返回不保存的模型对象。版本不存在时抛出 Revision.DoesNotExist
+        """
+        if version == self.version:
+            return self
+        fields = self._meta.fields
+        data = dict(self.__data__)
+        restored = None
+        # 从当前版本开始，依次把较新版本的旧值覆盖回去
+        for revision in self.revisions().where(Revision.version >= version):
+            for name, value in json.loads(revision.changes).items():
+                if name in fields:
+                    data[name] = fields[name].python_value(value)
+            restored = revision.version
+        if restored != version:
+            raise Revision.DoesNotExist('{0} #{1} has no version {2}'.format(self._meta.table_name, self.id, version))
+        data['version'] = version
+        return type(self)(**data)
+
+    @classmethod
+    def _upsert(cls, rows, existing, key_names, update, preserve, bump_version):
+        if not rows:
+            return
+        database = cls._meta.database
+        fields = cls._meta.fields
+        table = '"{0}"'.format(cls._meta.table_name)
+
+        names = []
+        for row in rows.values():
+            names.extend(name for name in row if name not in names)
+        defaults = {}
+        for field in cls._meta.sorted_fields:
+            if field.name in names or field.primary_key:
+                continue
+            if field.default is not None:
+                defaults[field.name] = field.default
+                names.append(field.name)
+            elif field.name == 'version':
+                defaults[field.name] = 1
+                names.append(field.name)
+
+        def db_values(row, names):
+            values = []
+            for name in names:
+                if name in row:
+                    value = row[name]
+                else:
+                    value = defaults.get(name)
+                    if callable(value):
+                        value = value()
+                values.append(fields[name].db_value(value))
+            return values
+
+        def quote(name):
+            return '"{0}"'.format(fields[name].column_name)
+
+        assignments = []
+        for name in update:
+            if name in preserve:
+                assignments.append('{0} = COALESCE({1}.{0}, excluded.{0})'.format(quote(name), table))
+            else:
+                assignments.append('{0} = excluded.{0}'.format(quote(name)))
+        if bump_version:
+            assignments.append('"version" = {0}."version" + 1'.format(table))
+
+        columns = ', '.join(quote(name) for name in names)
+        placeholders = '({0})'.format(', '.join(['?'] * len(names)))
+        chunk_size = max(1, SQLITE_MAX_VARIABLES // len(names))
+        # 行中缺少不能为空的字段时，INSERT 在处理冲突之前就会失败，已存在的行只能用 UPDATE 更新
+        incomplete = any(
+            not field.null and not field.primary_key and field.name not in names
+            for field in cls._meta.sorted_fields
+        )
+
+        if not assignments or SQLITE_SUPPORTS_UPSERT and not incomplete:
+            if assignments:
+                sql = 'INSERT INTO {0} ({1}) VALUES {{0}} ON CONFLICT ({2}) DO UPDATE SET {3}'.format(
+                    table, columns, ', '.join(quote(name) for name in key_names), ', '.join(assignments))
+            else:
+                sql = 'INSERT OR IGNORE INTO {0} ({1}) VALUES {{0}}'.format(table, columns)
+            for chunk in chunked(list(rows.values()), chunk_size):
+                params = []
+                for row in chunk:
+                    params.extend(db_values(row, names))
+                database.execute_sql(sql.format(', '.join([placeholders] * len(chunk))), params)
+            return
+
+        # 旧版本 SQLite 不支持 upsert，或者行中缺少字段：新行批量插入，已存在的行用同一条预编译语句逐行更新
+        new_rows = [row for row_key, row in rows.items() if row_key not in existing]
+        # 缺少字段的新行应当报错，OR IGNORE 会把它静默丢弃
+        sql = 'INSERT {2}INTO {0} ({1}) VALUES {{0}}'.format(table, columns, '' if incomplete else 'OR IGNORE ')
+        for chunk in chunked(new_rows, chunk_size):
+            params = []
+            for row in chunk:
+                params.extend(db_values(row, names))
+            database.execute_sql(sql.format(', '.join([placeholders] * len(chunk))), params)
+
+        assignments = [assignment.replace('excluded.{0}'.format(quote(name)), '?') for assignment, name in zip(assignments, update)] + assignments[len(update):]
+        sql = 'UPDATE {0} SET {1} WHERE "id" = ?'.format(table, ', '.join(assignments))
+        database.cursor().executemany(sql, [
+            db_values(row, update) + [existing[row_key].id]
+            for row_key, row in rows.items() if row_key in existing
+        ])
+
 
 class User(BaseModel):
     """
@@ -164,16 +990,6 @@ class User(BaseModel):
         return self.id == 0
 
 
-class UserHistorical(User):
-    """
-    用户历史数据
-    """
-    class Meta:
-        table_name = 'user_historical'
-
-    douban_id = IntegerField(help_text='豆瓣ID')
-    unique_name = CharField(help_text='豆瓣域名')
-    user = ForeignKeyField(User, field=User.id, help_text='原始对象ID')
 
 
 class UserExtra(BaseModel):
@@ -323,28 +1139,19 @@ class Movie(BaseModel):
     ]
 
     douban_id = CharField(unique=True, help_text='豆瓣ID')
-    rating = TextField(help_text='评分', null=True)
-    author = TextField(help_text='作者', null=True)
+    rating = JSONField(help_text='评分', null=True)
+    author = JSONField(help_text='作者', null=True)
     alt_title = TextField(help_text='又名', null=True)
     image = CharField(help_text='电影海报', null=True)
     title = CharField(help_text='中文名')
     summary = TextField(help_text='简介', null=True)
-    attrs = TextField(help_text='属性', null=True)
+    attrs = JSONField(help_text='属性', null=True)
     alt = CharField(help_text='条目页URL', null=True)
-    tags = TextField(help_text='标签', null=True)
+    tags = JSONField(help_text='标签', null=True)
     version = IntegerField(help_text='当前版本')
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
-class MovieHistorical(Movie):
-    """
-    电影历史数据
-    """
-    class Meta:
-        table_name = 'movie_historical'
-    
-    douban_id = CharField(help_text='豆瓣ID')
-    movie = ForeignKeyField(Movie, field=Movie.id)
 
 
 class Book(BaseModel):
@@ -378,18 +1185,18 @@ class Book(BaseModel):
 
     douban_id = CharField(unique=True, help_text='豆瓣ID')
     title = CharField(help_text='标题', null=True)
-    rating = TextField(help_text='评分', null=True)
+    rating = JSONField(help_text='评分', null=True)
     subtitle = CharField(help_text='副标题', null=True)
-    author = TextField(help_text='作者', null=True)
+    author = JSONField(help_text='作者', null=True)
     pubdate = CharField(help_text='上映日期', null=True)
-    tags = TextField(help_text='标签', null=True)
+    tags = JSONField(help_text='标签', null=True)
     origin_title = CharField(help_text='标题', null=True)
     image = CharField(help_text='图片', null=True)
     binding = CharField(help_text='装帧', null=True)
-    translator = TextField(help_text='翻译', null=True)
+    translator = JSONField(help_text='翻译', null=True)
     catalog = TextField(help_text='目录', null=True)
     pages = CharField(help_text='页数', null=True)
-    images = TextField(help_text='图片', null=True)
+    images = JSONField(help_text='图片', null=True)
     alt = CharField(help_text='条目页URL', null=True)
     publisher = CharField(help_text='出版社', null=True)
     isbn10 = CharField(help_text='ISBN', null=True)
@@ -403,15 +1210,6 @@ class Book(BaseModel):
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
-class BookHistorical(Book):
-    """
-    书历史数据
-    """
-    class Meta:
-        table_name = 'book_historical'
-    
-    douban_id = CharField(help_text='豆瓣ID')
-    book = ForeignKeyField(Book, field=Book.id)
 
 
 class Music(BaseModel):
@@ -431,28 +1229,19 @@ class Music(BaseModel):
     ]
 
     douban_id = CharField(unique=True, help_text='豆瓣ID')
-    rating = TextField(help_text='评分', null=True)
-    author = TextField(help_text='作者', null=True)
+    rating = JSONField(help_text='评分', null=True)
+    author = JSONField(help_text='作者', null=True)
     alt_title = CharField(help_text='标题', null=True)
     image = CharField(help_text='图片', null=True)
     title = CharField(help_text='标题', null=True)
     summary = TextField(help_text='介绍', null=True)
-    attrs = TextField(help_text='属性', null=True)
+    attrs = JSONField(help_text='属性', null=True)
     alt = CharField(help_text='地址', null=True)
-    tags = TextField(help_text='标签', null=True)
+    tags = JSONField(help_text='标签', null=True)
     version = IntegerField(help_text='当前版本')
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
-class MusicHistorical(Music):
-    """
-    音乐历史数据
-    """
-    class Meta:
-        table_name = 'music_historical'
-    
-    douban_id = CharField(help_text='豆瓣ID')
-    music = ForeignKeyField(Music, field=Music.id)
 
 
 class BaseMyInterest(BaseModel):
@@ -472,8 +1261,8 @@ class BaseMyInterest(BaseModel):
 
     subject_id = CharField(help_text='豆瓣对象ID')
     user = ForeignKeyField(User, help_text='用户')
-    rating = CharField(null=True, help_text='评分')
-    tags = CharField(null=True, help_text='标签')
+    rating = JSONField(null=True, help_text='评分')
+    tags = JSONField(null=True, help_text='标签')
     create_time = CharField(null=True, help_text='创建时间')
     comment = CharField(null=True, help_text='评论')
     status = CharField(help_text='状态')
@@ -549,11 +1338,162 @@ class Setting(BaseModel):
     value = TextField(help_text='值')
 
 
+class TaskState(BaseModel):
+    """
+    任务队列，服务重启后据此恢复没有完成的任务
+    """
+    class Meta:
+        table_name = 'task_state'
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    task_type = CharField(help_text='任务类型名称')
+    account = ForeignKeyField(Account, help_text='执行任务的帐号')
+    state = CharField(index=True, default=QUEUED, help_text='状态：queued, running, done, failed')
+    priority = BooleanField(default=False, help_text='是否优先执行')
+    route = CharField(null=True, help_text='指定执行任务的代理，空字符串表示不使用代理的工作进程')
+    worker = CharField(null=True, help_text='执行任务的工作进程')
+    error = TextField(null=True, help_text='失败原因')
+    created_at = DateTimeField(default=datetime.datetime.now, help_text='加入队列时间')
+    started_at = DateTimeField(null=True, help_text='开始执行时间')
+    finished_at = DateTimeField(null=True, help_text='结束时间')
+
+
+class Revision(BaseModel):
+    """
+    对象的历史版本
+
+    只保存与后一个版本不同的字段的旧值（反向差异），从当前对象开始依次覆盖回去即可还原任意版本
+    """
+    class Meta:
+        indexes = (
+            (('target_type', 'target_id', 'version'), True),
+        )
+
+    target_type = CharField(help_text='对象所在的表')
+    target_id = IntegerField(help_text='对象ID')
+    version = IntegerField(help_text='版本')
+    changes = TextField(help_text='与后一个版本不同的字段的值，JSON')
+    created_at = DateTimeField(default=datetime.datetime.now, help_text='记录时间')
+
+
+class Counter(BaseModel):
+    """
+    计数的时间序列，计数有变化时记录一次
+
+    values 按模型 _counters_ 的顺序打包成 64 位整数，空值记为 -1
+    """
+    class Meta:
+        indexes = (
+            (('target_type', 'target_id', 'recorded_at'), False),
+        )
+
+    target_type = CharField(help_text='对象所在的表')
+    target_id = IntegerField(help_text='对象ID')
+    recorded_at = DateTimeField(default=datetime.datetime.now, help_text='记录时间')
+    values = BlobField(help_text='计数')
+
+    @staticmethod
+    def pack(values):
+        return struct.pack('<{0}q'.format(len(values)), *[-1 if value is None else value for value in values])
+
+    @staticmethod
+    def unpack(data):
+        return [None if value == -1 else value for value in struct.unpack('<{0}q'.format(len(data) // 8), data)]
+
+    @classmethod
+    def record(cls, model_class, names, samples):
+        """
+        记录 model_class 对象的计数，samples 是 (对象 id, 与 names 顺序一致的计数, 记录时间) 的列表。
+        names 不是模型的全部计数时，改为读取对象当前（已经更新过）的全部计数
+        """
+        if not samples:
+            return
+        counters = model_class._counters_
+        if list(names) != list(counters):
+            fields = model_class._meta.fields
+            current = {}
+            for chunk in chunked([sample[0] for sample in samples], SQLITE_MAX_VARIABLES):
+                query = model_class.select(model_class.id, *[fields[name] for name in counters]).where(model_class.id.in_(chunk))
+                current.update((row[0], row[1:]) for row in query.tuples())
+            samples = [(object_id, current[object_id], recorded_at) for object_id, _, recorded_at in samples if object_id in current]
+        now = datetime.datetime.now()
+        rows = [{
+            'target_type': model_class._meta.table_name,
+            'target_id': object_id,
+            'recorded_at': recorded_at or now,
+            'values': cls.pack(values),
+        } for object_id, values, recorded_at in samples]
+        for chunk in chunked(rows, SQLITE_MAX_VARIABLES // 4):
+            cls.insert_many(chunk).execute()
+
+    @classmethod
+    def series(cls, obj, since=None):
+        """
+        对象计数的变化，按时间顺序返回 (记录时间, {计数名称: 值}) 的列表
+        """
+        query = cls.select(cls.recorded_at, cls.values).where(
+            cls.target_type == obj._meta.table_name,
+            cls.target_id == obj.id
+        )
+        if since is not None:
+            query = query.where(cls.recorded_at >= since)
+        names = obj._counters_
+        return [
+            (recorded_at, dict(zip(names, cls.unpack(bytes(values)))))
+            for recorded_at, values in query.order_by(cls.recorded_at).tuples()
+        ]
+
+
+class CompressionDictionary(BaseModel):
+    """
+    压缩文本列使用的预设字典，见 CompressedTextField
+    """
+    class Meta:
+        table_name = 'compression_dictionary'
+
+    target_table = CharField(help_text='表')
+    target_column = CharField(help_text='列')
+    data = BlobField(help_text='字典内容')
+    created_at = DateTimeField(default=datetime.datetime.now, help_text='训练时间')
+
+
+class Checkpoint(BaseModel):
+    """
+    任务进度，任务中断后从这里继续
+    """
+    class Meta:
+        indexes = (
+            (('task_type', 'account', 'name'), True),
+        )
+
+    task_type = CharField(help_text='任务类型名称')
+    account = ForeignKeyField(Account, help_text='执行任务的帐号')
+    name = CharField(help_text='任务中的进度名称，一个任务可以有多个进度')
+    cursor = TextField(help_text='当前位置，JSON')
+    items = TextField(null=True, help_text='已经取得的列表，JSON')
+    updated_at = DateTimeField(default=datetime.datetime.now, help_text='更新时间')
+
+
+class CheckpointPage(BaseModel):
+    """
+    进度中逐页追加的列表，每页一行，抓取长列表时不必每页都重写整个列表
+    """
+    class Meta:
+        table_name = 'checkpoint_page'
+
+    checkpoint = ForeignKeyField(Checkpoint, index=True, help_text='所属进度')
+    items = TextField(help_text='这一页追加的项目，JSON')
+
+
 class Broadcast(BaseModel):
     """
     豆瓣广播
     """
-    _attrs_to_compare_ = [
+    _counters_ = [
         'reshared_count',
         'like_count',
         'comments_count',
@@ -573,7 +1513,7 @@ class Broadcast(BaseModel):
     like_count = IntegerField(null=True, help_text='点赞数')
     comments_count = IntegerField(null=True, help_text='回应数')
     created = CharField(null=True, help_text='发布时间')
-    content = TextField(null=True, help_text='原始HTML')
+    content = CompressedTextField(null=True, help_text='原始HTML')
     is_reshared = BooleanField(null=True, default=False, help_text='广播本身是一条转播')
     is_saying = BooleanField(null=True, default=False, help_text='发出的文字图片链接类型的广播')
     is_noreply = BooleanField(null=True, default=False, help_text='不能回复的广播')
@@ -587,10 +1527,12 @@ class Timeline(BaseModel):
     class Meta:
         indexes = (
             (('user', 'broadcast'), True),
+            (('user', 'sequence'), False),
         )
 
     user = ForeignKeyField(User, index=True, help_text='所属用户')
     broadcast = ForeignKeyField(Broadcast, help_text='对应广播')
+    sequence = BigIntegerField(null=True, help_text='排列顺序，越大越新')
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
@@ -600,8 +1542,8 @@ class Attachment(BaseModel):
     """
     url = CharField(unique=True, help_text='地址')
     mime_type = CharField(null=True, help_text='MIME类型')
-    local = CharField(unique=True, null=True, help_text='本地文件名')
-    ref_count = IntegerField(default=0, help_text='引用计数(预留，暂不使用)')
+    local = CharField(index=True, null=True, help_text='本地文件名，内容相同的附件共用一个文件')
+    ref_count = IntegerField(default=0, help_text='引用计数，即共用同一个本地文件的附件数')
     created_at = DateTimeField(help_text='创建时间', default=datetime.datetime.now())
 
 
@@ -614,6 +1556,8 @@ class Note(BaseModel):
         'created',
         'introduction',
         'content',
+    ]
+    _counters_ = [
         'views_count',
         'comments_count',
         'like_count',
@@ -626,7 +1570,7 @@ class Note(BaseModel):
     title = CharField(null=True, help_text='标题')
     created = CharField(null=True, help_text='发布时间')
     introduction = TextField(null=True, help_text='导读')
-    content = TextField(null=True, help_text='正文')
+    content = CompressedTextField(null=True, help_text='正文')
     attachments = TextField(null=True, help_text='附件')
     subjects = TextField(null=True, help_text='书影音对象')
     views_count = IntegerField(null=True, help_text='浏览人数')
@@ -638,15 +1582,6 @@ class Note(BaseModel):
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
-class NoteHistorical(Note):
-    """
-    日记历史数据
-    """
-    class Meta:
-        table_name = 'note_historical'
-    
-    douban_id = CharField(help_text='豆瓣ID')
-    note = ForeignKeyField(Note, field=Note.id)
 
 
 class Comment(BaseModel):
@@ -663,7 +1598,7 @@ class Comment(BaseModel):
     user = ForeignKeyField(User, help_text='用户')
     text = TextField(null=True, help_text='评论文本')
     quote = TextField(null=True, help_text='引用文本')
-    content = TextField(null=True, help_text='原始HTML')
+    content = CompressedTextField(null=True, help_text='原始HTML')
     created = CharField(null=True, help_text='创建时间')
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
@@ -681,6 +1616,8 @@ class PhotoAlbum(BaseModel):
         'cover',
         'photos_count',
         'last_updated',
+    ]
+    _counters_ = [
         'views_count',
         'like_count',
         'rec_count',
@@ -701,15 +1638,6 @@ class PhotoAlbum(BaseModel):
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
-class PhotoAlbumHistorical(Note):
-    """
-    相册历史数据
-    """
-    class Meta:
-        table_name = 'photo_album_historical'
-    
-    douban_id = CharField(help_text='豆瓣ID')
-    photo_album = ForeignKeyField(PhotoAlbum, field=PhotoAlbum.id)
 
 
 class PhotoPicture(BaseModel):
@@ -722,6 +1650,8 @@ class PhotoPicture(BaseModel):
     _attrs_to_compare_ = [
         'desc',
         'picture',
+    ]
+    _counters_ = [
         'views_count',
         'like_count',
         'rec_count',
@@ -741,15 +1671,6 @@ class PhotoPicture(BaseModel):
     updated_at = DateTimeField(help_text='抓取时间', default=datetime.datetime.now())
 
 
-class PhotoPictureHistorical(Note):
-    """
-    照片历史数据
-    """
-    class Meta:
-        table_name = 'photo_picture_historical'
-    
-    douban_id = CharField(help_text='豆瓣ID')
-    photo_picture = ForeignKeyField(PhotoPicture, field=PhotoPicture.id)
 
 
 class Favorite(BaseModel):
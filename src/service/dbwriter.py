@@ -0,0 +1,502 @@
+# encoding: utf-8
+import itertools
+import logging
+import os
+import pickle
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import Queue
+from multiprocessing.reduction import ForkingPickler
+
+
+# 一次提交最多合并的写入请求数
+WRITER_BATCH_SIZE = 500
+# 工作进程的事务超过这个时间（秒）没有新的请求则回滚，与连接的 busy_timeout 一致
+TRANSACTION_TIMEOUT = 60
+# 等待消息的超时（秒），用来检查事务是否超时
+POLL_INTERVAL = 1
+# 工作进程等待回复的最长时间（秒）。请求可能排在其他工作进程的事务之后，留出几次事务超时的余量
+REPLY_TIMEOUT = TRANSACTION_TIMEOUT * 5
+# 工作进程在本地只读连接上执行的语句
+READ_STATEMENTS = ('SELECT', 'PRAGMA')
+# 取出写入语句所写的表名
+WRITE_STATEMENT = re.compile(
+    r'\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+"?(\w+)',
+    re.IGNORECASE
+)
+
+
+def _error_reply(request_id, error):
+    return request_id, 'error', type(error).__name__, error.args
+
+
+def _param(value):
+    # peewee 的 BlobField 给出 memoryview，不能通过队列传递
+    if isinstance(value, (memoryview, bytearray)):
+        return bytes(value)
+    return value
+
+
+def _raise_error(name, args):
+    error_class = getattr(sqlite3, name, None)
+    if not isinstance(error_class, type) or not issubclass(error_class, sqlite3.Error):
+        error_class = sqlite3.DatabaseError
+    raise error_class(*args)
+
+
+class DatabaseWriter:
+    """
+    数据库写入线程
+
+    运行在服务进程中，是工作进程唯一的写入者。工作进程通过队列发来写入语句，
+    写入线程把一段时间内收到的语句合并到同一个事务中提交，提交后再回复执行结果（行、lastrowid、rowcount），
+    工作进程随后在自己的只读连接上就能读到写入的内容。
+    工作进程的事务在写入线程的事务中以 SAVEPOINT 执行，事务进行期间其他工作进程、
+    以及同一工作进程中其他线程的请求排队等待。事务属于 (客户端 id, 线程 id)。
+    每次提交成功后在写入线程中调用 on_commit，参数为这次提交写入过的表名。
+    """
+
+    def __init__(self, db_path, pragmas=(), on_commit=None):
+        self._db_path = db_path
+        self._pragmas = pragmas
+        self._on_commit = on_commit
+        self._requests = Queue()
+        # 客户端 id => 回复队列
+        self._replies = {}
+        self._client_ids = itertools.count(1)
+        self._thread = None
+        # 写入线程调用 SQLite 期间持有，fork 出的子进程才不会继承被占用的 SQLite 内部锁
+        self._lock = threading.Lock()
+
+        self._conn = None
+        self._group_size = 0
+        # 提交后才能回复的请求
+        self._waiting = []
+        # 正在执行事务的 (客户端 id, 线程 id)，其他请求暂存在 _deferred 中
+        self._owner = None
+        self._owner_active_at = 0
+        self._deferred = deque()
+        # 事务因为超时或出错被回滚的 (客户端 id, 线程 id)，在它结束事务之前拒绝它的请求
+        self._aborted = set()
+        # 当前合并的事务中写入过的表
+        self._written = set()
+
+    def client(self):
+        """
+        为一个工作进程创建客户端
+        """
+        client_id = next(self._client_ids)
+        replies = Queue()
+        self._replies[client_id] = replies
+        return WriterClient(client_id, self._requests, replies)
+
+    def release(self, client):
+        """
+        工作进程已经停止：回滚它未完成的事务，丢弃它的请求
+        """
+        if client is not None:
+            self._requests.put((client.id, None, None, 'release', None, None))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._requests.put(None)
+            self._thread.join()
+            self._thread = None
+
+    @contextmanager
+    def paused(self):
+        """
+        在上下文中暂停写入，用于启动工作进程
+        """
+        with self._lock:
+            yield
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, timeout=TRANSACTION_TIMEOUT, isolation_level=None)
+        for name, value in self._pragmas:
+            conn.execute('PRAGMA {0} = {1}'.format(name, value))
+        return conn
+
+    def _run(self):
+        with self._lock:
+            self._conn = self._connect()
+        while True:
+            try:
+                message = self._next_message()
+                if isinstance(message, bytes):
+                    message = pickle.loads(message)
+            except queue.Empty:
+                with self._lock:
+                    if self._owner is None:
+                        self._commit()
+                    elif time.time() - self._owner_active_at > TRANSACTION_TIMEOUT:
+                        logging.warn('数据库写入：工作进程的事务超时，已回滚')
+                        self._abort_owner()
+                continue
+            if message is None:
+                break
+            with self._lock:
+                try:
+                    self._handle(*message)
+                except sqlite3.Error as e:
+                    logging.error('数据库写入：执行失败: {0}'.format(e))
+                    self._reply(message[0], _error_reply(message[2], e))
+                if self._owner is None and self._group_size >= WRITER_BATCH_SIZE:
+                    self._commit()
+
+        with self._lock:
+            if self._owner is not None:
+                self._abort_owner()
+            self._commit()
+            self._conn.close()
+
+    def _next_message(self):
+        if self._owner is None and self._deferred:
+            return self._deferred.popleft()
+        if self._group_size and self._owner is None:
+            # 没有更多请求时立即提交
+            return self._requests.get_nowait()
+        return self._requests.get(timeout=POLL_INTERVAL)
+
+    def _reply(self, client_id, reply):
+        replies = self._replies.get(client_id)
+        if replies is not None:
+            replies.put(reply)
+
+    def _handle(self, client_id, thread_id, request_id, operation, sql, params):
+        if operation == 'release':
+            if self._owner is not None and self._owner[0] == client_id:
+                self._abort_owner()
+            self._aborted = set(key for key in self._aborted if key[0] != client_id)
+            self._deferred = deque(message for message in self._deferred if message[0] != client_id)
+            self._replies.pop(client_id, None)
+            return
+
+        key = (client_id, thread_id)
+        if self._owner is not None and self._owner != key:
+            self._deferred.append((client_id, thread_id, request_id, operation, sql, params))
+            return
+
+        if key in self._aborted:
+            if operation in ('commit', 'rollback'):
+                self._aborted.discard(key)
+            if operation != 'rollback':
+                self._reply(client_id, _error_reply(request_id, sqlite3.OperationalError('transaction has been rolled back')))
+                return
+            self._reply(client_id, (request_id, 'ok', [], None, None, -1))
+            return
+
+        self._begin_group()
+        self._group_size += 1
+        if operation == 'begin':
+            self._owner = key
+            self._owner_active_at = time.time()
+            self._conn.execute('SAVEPOINT "worker"')
+            self._reply(client_id, (request_id, 'ok', [], None, None, -1))
+        elif operation == 'commit':
+            if self._owner == key:
+                self._conn.execute('RELEASE "worker"')
+                self._owner = None
+            self._waiting.append((client_id, (request_id, 'ok', [], None, None, -1)))
+        elif operation == 'rollback':
+            if self._owner == key:
+                self._conn.execute('ROLLBACK TO "worker"')
+                self._conn.execute('RELEASE "worker"')
+                self._owner = None
+            self._reply(client_id, (request_id, 'ok', [], None, None, -1))
+        elif self._owner == key:
+            self._owner_active_at = time.time()
+            try:
+                self._reply(client_id, (request_id, 'ok') + self._execute(operation, sql, params))
+            except sqlite3.Error as e:
+                self._reply(client_id, _error_reply(request_id, e))
+        else:
+            # 事务外的语句单独用一个 SAVEPOINT，失败时不影响同一批中的其他语句
+            self._conn.execute('SAVEPOINT "statement"')
+            try:
+                result = self._execute(operation, sql, params)
+            except sqlite3.Error as e:
+                self._conn.execute('ROLLBACK TO "statement"')
+                self._conn.execute('RELEASE "statement"')
+                self._reply(client_id, _error_reply(request_id, e))
+                return
+            self._conn.execute('RELEASE "statement"')
+            self._waiting.append((client_id, (request_id, 'ok') + result))
+
+    def _execute(self, operation, sql, params):
+        match = WRITE_STATEMENT.match(sql)
+        if match:
+            self._written.add(match.group(1))
+        cursor = self._conn.cursor()
+        try:
+            if operation == 'executemany':
+                cursor.executemany(sql, params)
+            else:
+                cursor.execute(sql, params)
+            rows = cursor.fetchall() if cursor.description else []
+            return rows, cursor.description, cursor.lastrowid, cursor.rowcount
+        finally:
+            cursor.close()
+
+    def _abort_owner(self):
+        self._conn.execute('ROLLBACK TO "worker"')
+        self._conn.execute('RELEASE "worker"')
+        self._aborted.add(self._owner)
+        self._owner = None
+
+    def _begin_group(self):
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN IMMEDIATE')
+
+    def _commit(self):
+        """
+        提交合并的事务，然后回复等待提交的请求
+        """
+        waiting = self._waiting
+        self._waiting = []
+        self._group_size = 0
+        written = self._written
+        self._written = set()
+        if self._conn.in_transaction:
+            try:
+                self._conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                logging.error('数据库写入：提交失败: {0}'.format(e))
+                self._conn.execute('ROLLBACK')
+                for client_id, reply in waiting:
+                    self._reply(client_id, _error_reply(reply[0], e))
+                return
+        if written and self._on_commit is not None:
+            try:
+                self._on_commit(written)
+            except Exception:
+                logging.exception('数据库写入：提交通知失败')
+        for client_id, reply in waiting:
+            self._reply(client_id, reply)
+
+
+class WriterClient:
+    """
+    工作进程一侧的写入客户端，随工作进程的设置传入工作进程
+
+    工作进程中的多个线程共用一个回复队列：同一时间只有一个线程从队列中取回复，
+    取到别的线程的回复时放入 _pending 并唤醒等待的线程
+    """
+
+    def __init__(self, client_id, requests, replies):
+        self._id = client_id
+        self._requests = requests
+        self._replies = replies
+        self._request_ids = None
+        self._condition = threading.Condition()
+        # 请求 id => 已经取到、还没有被请求的线程取走的回复
+        self._pending = {}
+        # 等待超时、不再需要的回复
+        self._abandoned = set()
+        self._receiving = False
+
+    @property
+    def id(self):
+        return self._id
+
+    def request(self, operation, sql=None, params=None):
+        """
+        发送请求并等待回复，返回 (行, description, lastrowid, rowcount)
+        """
+        with self._condition:
+            if self._request_ids is None:
+                # 重新启动的工作进程可能收到上一个进程没有取走的回复，用进程号区分
+                self._request_ids = zip(itertools.repeat(os.getpid()), itertools.count())
+            request_id = next(self._request_ids)
+        # 在这里序列化，无法发送的请求立即报错。交给队列的后台线程序列化时，出错的请求会被丢弃
+        try:
+            message = ForkingPickler.dumps((self._id, threading.get_ident(), request_id, operation, sql, params))
+        except Exception as e:
+            raise sqlite3.InterfaceError('cannot send request to database writer: {0}'.format(e))
+        self._requests.put(bytes(message))
+        reply = self._wait_reply(request_id)
+        if reply[1] == 'error':
+            _raise_error(reply[2], reply[3])
+        return reply[2:]
+
+    def _wait_reply(self, request_id):
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        with self._condition:
+            while request_id not in self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # 之后才到的回复直接丢弃
+                    self._abandoned.add(request_id)
+                    raise sqlite3.OperationalError('database writer did not reply in {0} seconds'.format(REPLY_TIMEOUT))
+                if self._receiving:
+                    self._condition.wait(remaining)
+                    continue
+                self._receiving = True
+                self._condition.release()
+                try:
+                    reply = self._replies.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                finally:
+                    self._condition.acquire()
+                    self._receiving = False
+                    self._condition.notify_all()
+                if reply[0][0] != request_id[0]:
+                    continue
+                if reply[0] in self._abandoned:
+                    self._abandoned.discard(reply[0])
+                else:
+                    self._pending[reply[0]] = reply
+            return self._pending.pop(request_id)
+
+    def connect(self, conn):
+        return WriterConnection(conn, self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_request_ids'] = None
+        state['_pending'] = {}
+        state['_abandoned'] = set()
+        state['_receiving'] = False
+        del state['_condition']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._condition = threading.Condition()
+
+
+class WriterConnection:
+    """
+    工作进程的数据库连接：事务外的查询使用本地只读连接，写入和事务中的所有语句交给写入线程
+    """
+
+    def __init__(self, conn, client):
+        self._conn = conn
+        self._client = client
+        self.in_transaction = False
+
+    def cursor(self):
+        return WriterCursor(self)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self._client.request('commit')
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self._client.request('rollback')
+
+    def close(self):
+        self.rollback()
+        self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class WriterCursor:
+    """
+    与 sqlite3.Cursor 接口一致
+    """
+
+    arraysize = 1
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = None
+        self._rows = deque()
+        self._description = None
+        self._lastrowid = None
+        self._rowcount = -1
+
+    def _reset(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+        self._rows = deque()
+        self._description = None
+        self._lastrowid = None
+        self._rowcount = -1
+
+    def _remote(self, operation, sql, params):
+        rows, self._description, self._lastrowid, self._rowcount = self._connection._client.request(operation, sql, params)
+        self._rows = deque(rows)
+        return self
+
+    def execute(self, sql, params=()):
+        self._reset()
+        connection = self._connection
+        words = sql.split(None, 2)
+        keyword = words[0].rstrip(';').upper() if words else ''
+        if keyword == 'BEGIN':
+            connection._client.request('begin')
+            connection.in_transaction = True
+            return self
+        if keyword in ('COMMIT', 'END'):
+            connection.commit()
+            return self
+        if keyword == 'ROLLBACK' and (len(words) == 1 or words[1].rstrip(';').upper() == 'TRANSACTION'):
+            connection.rollback()
+            return self
+        if not connection.in_transaction and keyword in READ_STATEMENTS:
+            self._cursor = connection._conn.cursor()
+            self._cursor.execute(sql, params)
+            return self
+        return self._remote('execute', sql, [_param(value) for value in params])
+
+    def executemany(self, sql, params):
+        self._reset()
+        return self._remote('executemany', sql, [[_param(value) for value in row] for row in params])
+
+    @property
+    def description(self):
+        return self._cursor.description if self._cursor is not None else self._description
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid if self._cursor is not None else self._lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount if self._cursor is not None else self._rowcount
+
+    def fetchone(self):
+        if self._cursor is not None:
+            return self._cursor.fetchone()
+        return self._rows.popleft() if self._rows else None
+
+    def fetchmany(self, size=None):
+        if self._cursor is not None:
+            return self._cursor.fetchmany(size or self.arraysize)
+        return [self._rows.popleft() for _ in range(min(size or self.arraysize, len(self._rows)))]
+
+    def fetchall(self):
+        if self._cursor is not None:
+            return self._cursor.fetchall()
+        rows = list(self._rows)
+        self._rows.clear()
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self._reset()
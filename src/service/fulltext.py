@@ -0,0 +1,305 @@
+# encoding: utf-8
+import logging
+import re
+import sqlite3
+from collections import OrderedDict, namedtuple
+from html import escape
+
+import lxml.html
+from lxml.etree import ParserError
+
+import db
+
+
+TABLE_NAME = 'search_index'
+# 每种对象占用一段 rowid：类型编号 * ROWID_SPAN + 对象 id，按类型筛选时只需要比较 rowid 范围
+ROWID_SPAN = 10 ** 12
+SNIPPET_LENGTH = 120
+TITLE_WEIGHT = 5.0
+BODY_WEIGHT = 1.0
+
+# 中日韩文字没有分词，连续的文字按相邻两字切分
+_CJK_RANGES = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_TOKEN = re.compile('([{0}]+)|([^\\W_{0}]+)'.format(_CJK_RANGES))
+
+
+def _fts5_supported():
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE fts5_test USING fts5(content)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+AVAILABLE = _fts5_supported()
+_ready = None
+
+
+def _reader():
+    # 界面中搜索时使用只读连接，单独运行（没有初始化只读连接）时使用默认连接
+    return db.dbo if db.dbo_reader.deferred else db.dbo_reader
+
+
+def _html_text(html):
+    if not html:
+        return ''
+    try:
+        return lxml.html.fragment_fromstring(html, create_parent='div').text_content()
+    except (ParserError, ValueError):
+        return html
+
+
+def _text(value):
+    # 豆瓣接口中的作者、标签是字符串或 {'name': ...} 组成的列表，只取名字
+    if isinstance(value, dict):
+        return _text(value.get('name'))
+    if isinstance(value, (list, tuple)):
+        return ' '.join(filter(None, (_text(item) for item in value)))
+    return str(value) if value else ''
+
+
+def _join(*texts):
+    return '\n'.join(filter(None, (_text(text) for text in texts)))
+
+
+def _extract_broadcast(obj):
+    return '', _join(_html_text(obj.blockquote), _html_text(obj.content)), 'broadcast', obj.douban_id
+
+
+def _extract_note(obj):
+    return obj.title or '', _join(obj.introduction, _html_text(obj.content)), 'note', obj.douban_id
+
+
+def _extract_comment(obj):
+    route = obj.target_type if obj.target_type in ('broadcast', 'note', 'photo') else None
+    return '', _join(obj.text, obj.quote), route, obj.target_douban_id
+
+
+def _extract_movie(obj):
+    return _join(obj.title, obj.alt_title), _join(obj.author, obj.summary, obj.tags), 'movie', obj.douban_id
+
+
+def _extract_book(obj):
+    return _join(obj.title, obj.subtitle, obj.origin_title), _join(obj.author, obj.publisher, obj.summary, obj.author_intro, obj.tags), 'book', obj.douban_id
+
+
+def _extract_music(obj):
+    return _join(obj.title, obj.alt_title), _join(obj.author, obj.summary, obj.tags), 'music', obj.douban_id
+
+
+def _extract_photo_album(obj):
+    return obj.title or '', obj.desc or '', 'photo.album', obj.douban_id
+
+
+def _extract_user(obj):
+    return obj.name or '', _join(obj.unique_name, obj.signature, obj.desc, obj.loc_name), 'user', obj.douban_id
+
+
+Kind = namedtuple('Kind', ['code', 'label', 'model', 'extract'])
+
+KINDS = OrderedDict([
+    ('broadcast', Kind(1, '广播', db.Broadcast, _extract_broadcast)),
+    ('note', Kind(2, '日记', db.Note, _extract_note)),
+    ('comment', Kind(3, '评论', db.Comment, _extract_comment)),
+    ('movie', Kind(4, '影视', db.Movie, _extract_movie)),
+    ('book', Kind(5, '书', db.Book, _extract_book)),
+    ('music', Kind(6, '音乐', db.Music, _extract_music)),
+    ('photo_album', Kind(7, '相册', db.PhotoAlbum, _extract_photo_album)),
+    ('user', Kind(8, '用户', db.User, _extract_user)),
+])
+
+
+def init():
+    """
+    创建全文索引表，当前 SQLite 不支持 FTS5 时跳过
+    """
+    global _ready
+    if not AVAILABLE:
+        logging.warn('SQLite FTS5 is not available, full-text search is disabled')
+        _ready = False
+        return
+    db.dbo.execute_sql(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5('
+        'title_tokens, body_tokens, '
+        'kind UNINDEXED, route UNINDEXED, route_arg UNINDEXED, title UNINDEXED, body UNINDEXED, '
+        'tokenize = \'unicode61\')'.format(TABLE_NAME)
+    )
+    _ready = True
+
+
+def is_ready():
+    """
+    全文索引是否可用
+    """
+    global _ready
+    if _ready is None:
+        _ready = AVAILABLE and TABLE_NAME in db.dbo.get_tables()
+    return _ready
+
+
+def tokenize(text):
+    """
+    把文本切分成以空格分隔的词：中日韩文字切成相邻两字，并补上每段的最后一个字，其他文字按单词切分
+    """
+    tokens = []
+    for cjk, word in _TOKEN.findall(text or ''):
+        if cjk:
+            tokens.extend(cjk[index:index + 2] for index in range(len(cjk) - 1))
+            tokens.append(cjk[-1])
+        else:
+            tokens.append(word.lower())
+    return ' '.join(tokens)
+
+
+def keywords(text):
+    return [cjk or word for cjk, word in _TOKEN.findall(text or '')]
+
+
+def build_query(text):
+    """
+    把用户输入转换成 FTS5 查询，所有关键词都必须出现
+    """
+    terms = []
+    for cjk, word in _TOKEN.findall(text or ''):
+        if len(cjk) == 1:
+            terms.append('"{0}"*'.format(cjk))
+        elif cjk:
+            terms.append('"{0}"'.format(' '.join(cjk[index:index + 2] for index in range(len(cjk) - 1))))
+        else:
+            terms.append('"{0}"*'.format(word.lower()))
+    return ' AND '.join(terms)
+
+
+def _rowid_range(kind):
+    code = KINDS[kind].code
+    return code * ROWID_SPAN, (code + 1) * ROWID_SPAN - 1
+
+
+def index(kind, ids):
+    """
+    把指定 id 的对象写入全文索引，已有的索引记录会被替换
+    """
+    ids = [object_id for object_id in ids if object_id]
+    if not ids or not is_ready():
+        return
+    spec = KINDS[kind]
+    base = spec.code * ROWID_SPAN
+    rows = []
+    for chunk in db.chunked(ids, db.SQLITE_MAX_VARIABLES):
+        for obj in spec.model.select().where(spec.model.id.in_(chunk)):
+            title, body, route, route_arg = spec.extract(obj)
+            title = ' '.join(title.split())
+            rows.append((base + obj.id, tokenize(title), tokenize(body), kind, route, route_arg, title, body))
+
+    with db.dbo.atomic():
+        for chunk in db.chunked(ids, db.SQLITE_MAX_VARIABLES):
+            db.dbo.execute_sql(
+                'DELETE FROM {0} WHERE rowid IN ({1})'.format(TABLE_NAME, ', '.join(['?'] * len(chunk))),
+                [base + object_id for object_id in chunk]
+            )
+        db.dbo.cursor().executemany(
+            'INSERT INTO {0} (rowid, title_tokens, body_tokens, kind, route, route_arg, title, body) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(TABLE_NAME),
+            rows
+        )
+
+
+def rebuild(kind, batch_size=500):
+    """
+    重建某种对象的全文索引，返回索引的对象数
+    """
+    if not is_ready():
+        return 0
+    model = KINDS[kind].model
+    lower, upper = _rowid_range(kind)
+    db.dbo.execute_sql('DELETE FROM {0} WHERE rowid BETWEEN ? AND ?'.format(TABLE_NAME), [lower, upper])
+    indexed_count = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in model.select(model.id).where(model.id > last_id).order_by(model.id).limit(batch_size).tuples()]
+        if not ids:
+            break
+        index(kind, ids)
+        indexed_count += len(ids)
+        last_id = ids[-1]
+    return indexed_count
+
+
+def match(kind, field, text, fallback=None):
+    """
+    返回“field 对应的对象匹配 text”的查询条件，用于在列表页中筛选。
+    全文索引不可用时返回 fallback
+    """
+    query = build_query(text)
+    if not query or not is_ready():
+        return fallback
+    lower, upper = _rowid_range(kind)
+    return field.in_(db.SQL(
+        '(SELECT rowid - ? FROM {0} WHERE {0} MATCH ? AND rowid BETWEEN ? AND ?)'.format(TABLE_NAME),
+        [lower, query, lower, upper]
+    ))
+
+
+def highlight(text, words, length=SNIPPET_LENGTH):
+    """
+    截取 text 中第一个关键词附近的片段，关键词用 <mark> 标出。返回 HTML
+    """
+    text = ' '.join((text or '').split())
+    pattern = re.compile('|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True)), re.I) if words else None
+    first_match = pattern.search(text) if pattern else None
+    start = max(0, first_match.start() - length // 4) if first_match and len(text) > length else 0
+    fragment = text[start:start + length]
+
+    parts = []
+    position = 0
+    if pattern:
+        for word_match in pattern.finditer(fragment):
+            parts.append(escape(fragment[position:word_match.start()]))
+            parts.append('<mark>{0}</mark>'.format(escape(word_match.group())))
+            position = word_match.end()
+    parts.append(escape(fragment[position:]))
+    return '{0}{1}{2}'.format('…' if start > 0 else '', ''.join(parts), '…' if start + length < len(text) else '')
+
+
+def search(text, kind=None, offset=0, limit=20):
+    """
+    按相关度搜索，返回 (结果列表, 各类型的命中数)
+    """
+    facets = OrderedDict()
+    query = build_query(text)
+    if not query or not is_ready():
+        return [], facets
+
+    codes = {spec.code: name for name, spec in KINDS.items()}
+    database = _reader()
+    counts = dict(database.execute_sql(
+        'SELECT rowid / ? AS code, COUNT(*) FROM {0} WHERE {0} MATCH ? GROUP BY code'.format(TABLE_NAME),
+        [ROWID_SPAN, query]
+    ).fetchall())
+    for code, name in codes.items():
+        if counts.get(code):
+            facets[name] = counts[code]
+
+    sql = 'SELECT kind, route, route_arg, title, body FROM {0} WHERE {0} MATCH ?'.format(TABLE_NAME)
+    params = [query]
+    if kind in KINDS:
+        sql += ' AND rowid BETWEEN ? AND ?'
+        params.extend(_rowid_range(kind))
+    sql += ' ORDER BY bm25({0}, ?, ?) LIMIT ? OFFSET ?'.format(TABLE_NAME)
+    params.extend([TITLE_WEIGHT, BODY_WEIGHT, limit, offset])
+
+    words = keywords(text)
+    results = []
+    for row_kind, route, route_arg, title, body in database.execute_sql(sql, params):
+        results.append({
+            'kind': row_kind,
+            'label': KINDS[row_kind].label,
+            'route': route,
+            'route_arg': route_arg,
+            'title': highlight(title, words, len(title)),
+            'snippet': highlight(body, words),
+        })
+    return results, facets
@@ -42,6 +42,7 @@ class AddTask(BaseRequestHandler):
         tasks = json.loads(self.get_argument('tasks'))
         task_names = tasks['tasks']
         account_ids = tasks['accounts']
+        route = tasks.get('route')
 
         if isinstance(task_names, list) and isinstance(account_ids, list):
             for task_name in task_names:
@@ -50,7 +51,7 @@ class AddTask(BaseRequestHandler):
                     try:
                         account = Account.get(Account.id == account_id)
                         task = task_type(account)
-                        self.server.add_task(task)
+                        self.server.add_task(task, route=route)
                     except Account.DoesNotExist:
                         pass
             self.server.push_task()
@@ -1,13 +1,228 @@
 # encoding: utf-8
-import ast
+import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import tornado
 from openpyxl import Workbook
 
 import db
 from .handlers import BaseRequestHandler
 
 
+# 推送导出进度的最小间隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+# 导出在这个线程中执行，不阻塞 IOLoop。同时只执行一个导出，后提交的排队等待
+_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def _join(values):
+    return ' / '.join(values) if values else None
+
+
+def _textify_starts(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return ''
+
+    return ('★' * value) + '☆' * (5 - value)
+
+
+def _rating_columns(subject, mine):
+    """
+    豆瓣评分、评分人数、链接、我的评分、我的短评、评价时间、标签
+    """
+    rating = subject.rating or {}
+    my_rating = mine.rating or {}
+    return [
+        rating.get('average'),
+        rating.get('numRaters'),
+        subject.alt,
+        _textify_starts(my_rating['value']) if my_rating else None,
+        mine.comment,
+        mine.create_time,
+        _join(mine.tags),
+    ]
+
+
+MOVIE_HEADERS = [
+    'ID', '标题', '又名', '导演', '编剧', '主演', '类型', '国家地区', '语言', '首播', '集数', '单集片长',
+    '豆瓣评分', '评分人数', '链接', '我的评分', '我的短评', '评价时间', '标签',
+]
+
+
+def _movie_row(my_movie):
+    movie = my_movie.movie
+    attrs = movie.attrs or {}
+    return [
+        movie.douban_id,
+        movie.title,
+        movie.alt_title,
+    ] + [_join(attrs.get(name)) for name in (
+        'director', 'writer', 'cast', 'movie_type', 'country', 'language', 'pubdate', 'episodes', 'movie_duration',
+    )] + _rating_columns(movie, my_movie)
+
+
+MUSIC_HEADERS = [
+    'ID', '标题', '又名', '表演者', '专辑类型', '介质', '发行时间', '出版者', '唱片数',
+    '豆瓣评分', '评分人数', '链接', '我的评分', '我的短评', '评价时间', '标签',
+]
+
+
+def _music_row(my_music):
+    music = my_music.music
+    attrs = music.attrs or {}
+    return [
+        music.douban_id,
+        music.title,
+        music.alt_title,
+    ] + [_join(attrs.get(name)) for name in (
+        'singer', 'version', 'media', 'pubdate', 'publisher', 'discs',
+    )] + _rating_columns(music, my_music)
+
+
+BOOK_HEADERS = [
+    'ID', '标题', '副标题', '又名', '作者', '译者', '出版社', '原作名', '出版日期', 'ISBN', '价格', '页数', '装帧',
+    '豆瓣评分', '评分人数', '链接', '我的评分', '我的短评', '评价时间', '标签',
+]
+
+
+def _book_row(my_book):
+    book = my_book.book
+    return [
+        book.douban_id,
+        book.title,
+        book.subtitle,
+        book.alt_title,
+        _join(book.author),
+        _join(book.translator),
+        book.publisher,
+        book.origin_title,
+        book.pubdate,
+        '{0} / {1}'.format(book.isbn10, book.isbn13),
+        book.price,
+        book.pages,
+        book.binding,
+    ] + _rating_columns(book, my_book)
+
+
+USER_HEADERS = ['ID', '域名', '名号', '注册时间', '常居地', '用户主页']
+
+
+def _user_row(user):
+    return [user.douban_id, user.unique_name, user.name, user.created, user.loc_name, user.alt]
+
+
+BROADCAST_HEADERS = ['ID', '用户ID', '用户域名', '用户名号', '文字内容', '完整内容', '地址', '发表时间', '回应', '推荐', '转播']
+
+
+def _broadcast_row(timeline):
+    broadcast = timeline.broadcast
+    user = broadcast.user
+    return [
+        broadcast.douban_id,
+        user.douban_id if user else None,
+        user.unique_name if user else None,
+        user.name if user else None,
+        broadcast.blockquote,
+        broadcast.content,
+        broadcast.status_url,
+        broadcast.created,
+        broadcast.comments_count,
+        broadcast.like_count,
+        broadcast.reshared_count,
+    ]
+
+
+def _interest_sheets(user, model, subject_model, subject_field, headers, to_row, statuses):
+    for title, status in statuses:
+        query = model.select(model, subject_model).join(
+            subject_model, on=subject_field
+        ).where(model.user == user, model.status == status).order_by(model.id.desc())
+        yield title, headers, query, to_row
+
+
+def _friend_sheets(user):
+    for title, model, field in (
+        ('我关注的人', db.Following, db.Following.following_user),
+        ('关注我的人', db.Follower, db.Follower.follower),
+        ('黑名单', db.BlockUser, db.BlockUser.block_user),
+    ):
+        query = model.select(model, db.User).join(
+            db.User, on=field
+        ).where(model.user == user).order_by(model.id.desc())
+        yield title, USER_HEADERS, query, lambda row, name=field.name: _user_row(getattr(row, name))
+
+
+def _broadcast_sheets(user):
+    query = db.Timeline.select(
+        db.Timeline,
+        db.Broadcast,
+        db.User
+    ).join(db.Broadcast).join(db.User, db.JOIN.LEFT_OUTER, on=db.Timeline.broadcast.user).where(db.Timeline.user == user).order_by(db.Timeline.sequence.desc())
+    yield '广播', BROADCAST_HEADERS, query, _broadcast_row
+
+
+# 导出项目：名称 => 生成 (工作表名称, 表头, 查询, 转换为一行的函数) 的函数
+EXPORT_ITEMS = [
+    ('friend', _friend_sheets),
+    ('movie', lambda user: _interest_sheets(
+        user, db.MyMovie, db.Movie, db.MyMovie.movie, MOVIE_HEADERS, _movie_row,
+        [('看过的电影', 'done'), ('想看的电影', 'wish'), ('在看的电视剧', 'doing')]
+    )),
+    ('music', lambda user: _interest_sheets(
+        user, db.MyMusic, db.Music, db.MyMusic.music, MUSIC_HEADERS, _music_row,
+        [('听过的唱片', 'done'), ('想听的唱片', 'wish')]
+    )),
+    ('book', lambda user: _interest_sheets(
+        user, db.MyBook, db.Book, db.MyBook.book, BOOK_HEADERS, _book_row,
+        [('读过的书', 'done'), ('想读的书', 'wish'), ('在读的书', 'doing')]
+    )),
+    ('broadcast', _broadcast_sheets),
+]
+
+
+def export(filename, user, items, progress):
+    """
+    把选中的项目写入 Excel 文件，在导出线程中执行
+
+    工作簿使用 write_only 模式，逐行追加后立即写入临时文件；查询用 iterator() 逐行读取，
+    不缓存模型对象。导出的行数再多，占用的内存也基本不变。
+    progress(已导出行数, 总行数) 在导出过程中定期调用
+    """
+    try:
+        sheets = []
+        for name, make_sheets in EXPORT_ITEMS:
+            if name in items:
+                sheets.extend(make_sheets(user))
+        total = sum(query.count() for _, _, query, _ in sheets)
+
+        workbook = Workbook(write_only=True)
+        done = 0
+        reported_at = 0
+        for title, headers, query, to_row in sheets:
+            worksheet = workbook.create_sheet(title)
+            worksheet.append(headers)
+            for row in query.iterator():
+                worksheet.append(to_row(row))
+                done += 1
+                now = time.monotonic()
+                if now - reported_at >= PROGRESS_INTERVAL:
+                    progress(done, total)
+                    reported_at = now
+        progress(done, total)
+        workbook.save(filename)
+        return done
+    finally:
+        # 导出线程中打开的连接
+        for database in (db.dbo, db.dbo_reader):
+            if not database.is_closed():
+                database.close()
+
+
 class Index(BaseRequestHandler):
     """
     导出主页
@@ -15,372 +230,25 @@ class Index(BaseRequestHandler):
     def get(self):
         self.render('exports.html')
 
-    def post(self):
+    def notify(self, event, **kwargs):
+        kwargs.update(sender='exporter', event=event)
+        self.application.broadcast(json.dumps(kwargs))
+
+    async def post(self):
         filename = self.get_argument('filename')
         items = set(self.get_argument('items').split(','))
-        workbook = Workbook()
-        workbook.remove(workbook.active)
-        for item in items:
-            if item == 'friend':
-                self._export_friend(workbook)
-            elif item == 'movie':
-                self._export_movie(workbook)
-            elif item == 'music':
-                self._export_music(workbook)
-            elif item == 'book':
-                self._export_book(workbook)
-            elif item == 'broadcast':
-                self._export_broadcast(workbook)
-                
-        workbook.save(filename)
-        self.write('OK')
+        user = self.get_current_user()
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        def progress(done, total):
+            ioloop.add_callback(self.notify, 'progress', filename=filename, done=done, total=total)
 
-    def _textify_starts(self, value):
         try:
-            value = int(value)
-        except ValueError:
-            return ''
-
-        return ('★' * value) + '☆' * (5 - value)
-
-    def _export_movie(self, workbook):
-        def fill_thead(ws):
-            ws.cell(row=1, column=1, value='ID')
-            ws.cell(row=1, column=2, value='标题')
-            ws.cell(row=1, column=3, value='又名')
-            ws.cell(row=1, column=4, value='导演')
-            ws.cell(row=1, column=5, value='编剧')
-            ws.cell(row=1, column=6, value='主演')
-            ws.cell(row=1, column=7, value='类型')
-            ws.cell(row=1, column=8, value='国家地区')
-            ws.cell(row=1, column=9, value='语言')
-            ws.cell(row=1, column=10, value='首播')
-            ws.cell(row=1, column=11, value='集数')
-            ws.cell(row=1, column=12, value='单集片长')
-            ws.cell(row=1, column=13, value='豆瓣评分')
-            ws.cell(row=1, column=14, value='评分人数')
-            ws.cell(row=1, column=15, value='链接')
-            ws.cell(row=1, column=16, value='我的评分')
-            ws.cell(row=1, column=17, value='我的短评')
-            ws.cell(row=1, column=18, value='评价时间')
-            ws.cell(row=1, column=19, value='标签')
-
-        def fill_my_movie(ws, row, my_movie):
-            movie = my_movie.movie
-            attrs = ast.literal_eval(movie.attrs)
-            ws.cell(row=row, column=1, value=movie.douban_id)
-            ws.cell(row=row, column=2, value=movie.title)
-            ws.cell(row=row, column=3, value=movie.alt_title)
-            if 'director' in attrs and attrs['director']:
-                ws.cell(row=row, column=4, value=' / '.join(attrs['director']))
-            if 'writer' in attrs and attrs['writer']:
-                ws.cell(row=row, column=5, value=' / '.join(attrs['writer']))
-            if 'cast' in attrs and attrs['cast']:
-                ws.cell(row=row, column=6, value=' / '.join(attrs['cast']))
-            if 'movie_type' in attrs and attrs['movie_type']:
-                ws.cell(row=row, column=7, value=' / '.join(attrs['movie_type']))
-            if 'country' in attrs and attrs['country']:
-                ws.cell(row=row, column=8, value=' / '.join(attrs['country']))
-            if 'language' in attrs and attrs['language']:
-                ws.cell(row=row, column=9, value=' / '.join(attrs['language']))
-            if 'pubdate' in attrs and attrs['pubdate']:
-                ws.cell(row=row, column=10, value=' / '.join(attrs['pubdate']))
-            if 'episodes' in attrs and attrs['episodes']:
-                ws.cell(row=row, column=11, value=' / '.join(attrs['episodes']))
-            if 'movie_duration' in attrs and attrs['movie_duration']:
-                ws.cell(row=row, column=12, value=' / '.join(attrs['movie_duration']))
-            if movie.rating:
-                rating = ast.literal_eval(movie.rating)
-                ws.cell(row=row, column=13, value=rating['average'])
-                ws.cell(row=row, column=14, value=rating['numRaters'])
-            ws.cell(row=row, column=15, value=movie.alt)
-            if my_movie.rating:
-                my_rating = ast.literal_eval(my_movie.rating)
-                ws.cell(row=row, column=16, value=self._textify_starts(my_rating['value']))
-            ws.cell(row=row, column=17, value=my_movie.comment)
-            ws.cell(row=row, column=18, value=my_movie.create_time)
-            if my_movie.tags:
-                tags = ast.literal_eval(my_movie.tags)
-                if len(tags):
-                    ws.cell(row=row, column=19, value=' / '.join(tags))
-
-        worksheet = workbook.create_sheet('看过的电影')
-        fill_thead(worksheet)
-        query = db.MyMovie.select(db.MyMovie, db.Movie).join(
-            db.Movie, on=db.MyMovie.movie
-        ).where(db.MyMovie.user == self.get_current_user(), db.MyMovie.status == 'done').order_by(db.MyMovie.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_movie(worksheet, row_num, row)
-            row_num += 1
-
-        worksheet = workbook.create_sheet('想看的电影')
-        fill_thead(worksheet)
-        query = db.MyMovie.select(db.MyMovie, db.Movie).join(
-            db.Movie, on=db.MyMovie.movie
-        ).where(db.MyMovie.user == self.get_current_user(), db.MyMovie.status == 'wish').order_by(db.MyMovie.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_movie(worksheet, row_num, row)
-            row_num += 1
-
-        worksheet = workbook.create_sheet('在看的电视剧')
-        fill_thead(worksheet)
-        query = db.MyMovie.select(db.MyMovie, db.Movie).join(
-            db.Movie, on=db.MyMovie.movie
-        ).where(db.MyMovie.user == self.get_current_user(), db.MyMovie.status == 'doing').order_by(db.MyMovie.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_movie(worksheet, row_num, row)
-            row_num += 1
-
-
-    def _export_music(self, workbook):
-        def fill_thead(ws):
-            ws.cell(row=1, column=1, value='ID')
-            ws.cell(row=1, column=2, value='标题')
-            ws.cell(row=1, column=3, value='又名')
-            ws.cell(row=1, column=4, value='表演者')
-            ws.cell(row=1, column=5, value='专辑类型')
-            ws.cell(row=1, column=6, value='介质')
-            ws.cell(row=1, column=7, value='发行时间')
-            ws.cell(row=1, column=8, value='出版者')
-            ws.cell(row=1, column=9, value='唱片数')
-            ws.cell(row=1, column=10, value='豆瓣评分')
-            ws.cell(row=1, column=11, value='评分人数')
-            ws.cell(row=1, column=12, value='链接')
-            ws.cell(row=1, column=13, value='我的评分')
-            ws.cell(row=1, column=14, value='我的短评')
-            ws.cell(row=1, column=15, value='评价时间')
-            ws.cell(row=1, column=16, value='标签')
-
-        def fill_my_music(ws, row, my_music):
-            music = my_music.music
-            attrs = ast.literal_eval(music.attrs)
-            ws.cell(row=row, column=1, value=music.douban_id)
-            ws.cell(row=row, column=2, value=music.title)
-            ws.cell(row=row, column=3, value=music.alt_title)
-            if 'singer' in attrs and attrs['singer']:
-                ws.cell(row=row, column=4, value=' / '.join(attrs['singer']))
-            if 'version' in attrs and attrs['version']:
-                ws.cell(row=row, column=5, value=' / '.join(attrs['version']))
-            if 'media' in attrs and attrs['media']:
-                ws.cell(row=row, column=6, value=' / '.join(attrs['media']))
-            if 'pubdate' in attrs and attrs['pubdate']:
-                ws.cell(row=row, column=7, value=' / '.join(attrs['pubdate']))
-            if 'publisher' in attrs and attrs['publisher']:
-                ws.cell(row=row, column=8, value=' / '.join(attrs['publisher']))
-            if 'discs' in attrs and attrs['discs']:
-                ws.cell(row=row, column=9, value=' / '.join(attrs['discs']))
-            if music.rating:
-                rating = ast.literal_eval(music.rating)
-                ws.cell(row=row, column=10, value=rating['average'])
-                ws.cell(row=row, column=11, value=rating['numRaters'])
-            ws.cell(row=row, column=12, value=music.alt)
-            if my_music.rating:
-                my_rating = ast.literal_eval(my_music.rating)
-                ws.cell(row=row, column=13, value=self._textify_starts(my_rating['value']))
-            ws.cell(row=row, column=14, value=my_music.comment)
-            ws.cell(row=row, column=15, value=my_music.create_time)
-            if my_music.tags:
-                tags = ast.literal_eval(my_music.tags)
-                if len(tags):
-                    ws.cell(row=row, column=16, value=' / '.join(tags))
-                
-
-        worksheet = workbook.create_sheet('听过的唱片')
-        fill_thead(worksheet)
-        query = db.MyMusic.select(db.MyMusic, db.Music).join(
-            db.Music, on=db.MyMusic.music
-        ).where(db.MyMusic.user == self.get_current_user(), db.MyMusic.status == 'done').order_by(db.MyMusic.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_music(worksheet, row_num, row)
-            row_num += 1
-
-        worksheet = workbook.create_sheet('想听的唱片')
-        fill_thead(worksheet)
-        query = db.MyMusic.select(db.MyMusic, db.Music).join(
-            db.Music, on=db.MyMusic.music
-        ).where(db.MyMusic.user == self.get_current_user(), db.MyMusic.status == 'wish').order_by(db.MyMusic.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_music(worksheet, row_num, row)
-            row_num += 1
-
-
-    def _export_book(self, workbook):
-        def fill_thead(ws):
-            ws.cell(row=1, column=1, value='ID')
-            ws.cell(row=1, column=2, value='标题')
-            ws.cell(row=1, column=3, value='副标题')
-            ws.cell(row=1, column=4, value='又名')
-            ws.cell(row=1, column=5, value='作者')
-            ws.cell(row=1, column=6, value='译者')
-            ws.cell(row=1, column=7, value='出版社')
-            ws.cell(row=1, column=8, value='原作名')
-            ws.cell(row=1, column=9, value='出版日期')
-            ws.cell(row=1, column=10, value='ISBN')
-            ws.cell(row=1, column=11, value='价格')
-            ws.cell(row=1, column=12, value='页数')
-            ws.cell(row=1, column=13, value='装帧')
-            ws.cell(row=1, column=14, value='豆瓣评分')
-            ws.cell(row=1, column=15, value='评分人数')
-            ws.cell(row=1, column=16, value='链接')
-            ws.cell(row=1, column=17, value='我的评分')
-            ws.cell(row=1, column=18, value='我的短评')
-            ws.cell(row=1, column=19, value='评价时间')
-            ws.cell(row=1, column=20, value='标签')
-
-        def fill_my_book(ws, row, my_book):
-            book = my_book.book
-            ws.cell(row=row, column=1, value=book.douban_id)
-            ws.cell(row=row, column=2, value=book.title)
-            ws.cell(row=row, column=3, value=book.subtitle)
-            ws.cell(row=row, column=4, value=book.alt_title)
-            if book.author:
-                author = ast.literal_eval(book.author)
-                if len(author):
-                    ws.cell(row=row, column=5, value=' / '.join(author))
-            if book.translator:
-                translator = ast.literal_eval(book.translator)
-                if len(translator):
-                    ws.cell(row=row, column=6, value=' / '.join(translator))
-            ws.cell(row=row, column=7, value=book.publisher)
-            ws.cell(row=row, column=8, value=book.origin_title)
-            ws.cell(row=row, column=9, value=book.pubdate)
-            ws.cell(row=row, column=10, value='{0} / {1}'.format(book.isbn10, book.isbn13))
-            ws.cell(row=row, column=11, value=book.price)
-            ws.cell(row=row, column=12, value=book.pages)
-            ws.cell(row=row, column=13, value=book.binding)
-            if book.rating:
-                rating = ast.literal_eval(book.rating)
-                ws.cell(row=row, column=14, value=rating['average'])
-                ws.cell(row=row, column=15, value=rating['numRaters'])
-            ws.cell(row=row, column=16, value=book.alt)
-            if my_book.rating:
-                my_rating = ast.literal_eval(my_book.rating)
-                ws.cell(row=row, column=17, value=self._textify_starts(my_rating['value']))
-            ws.cell(row=row, column=18, value=my_book.comment)
-            ws.cell(row=row, column=19, value=my_book.create_time)
-            if my_book.tags:
-                tags = ast.literal_eval(my_book.tags)
-                if len(tags):
-                    ws.cell(row=row, column=20, value=' / '.join(tags))
-
-        worksheet = workbook.create_sheet('读过的书')
-        fill_thead(worksheet)
-        query = db.MyBook.select(db.MyBook, db.Book).join(
-            db.Book, on=db.MyBook.book
-        ).where(db.MyBook.user == self.get_current_user(), db.MyBook.status == 'done').order_by(db.MyBook.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_book(worksheet, row_num, row)
-            row_num += 1
-
-        worksheet = workbook.create_sheet('想读的书')
-        fill_thead(worksheet)
-        query = db.MyBook.select(db.MyBook, db.Book).join(
-            db.Book, on=db.MyBook.book
-        ).where(db.MyBook.user == self.get_current_user(), db.MyBook.status == 'wish').order_by(db.MyBook.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_book(worksheet, row_num, row)
-            row_num += 1
-
-        worksheet = workbook.create_sheet('在读的书')
-        fill_thead(worksheet)
-        query = db.MyBook.select(db.MyBook, db.Book).join(
-            db.Book, on=db.MyBook.book
-        ).where(db.MyBook.user == self.get_current_user(), db.MyBook.status == 'doing').order_by(db.MyBook.id.desc())
-        row_num = 2
-        for row in query:
-            fill_my_book(worksheet, row_num, row)
-            row_num += 1
-
-
-    def _export_friend(self, workbook):
-        def fill_thead(ws):
-            ws.cell(row=1, column=1, value='ID')
-            ws.cell(row=1, column=2, value='域名')
-            ws.cell(row=1, column=3, value='名号')
-            ws.cell(row=1, column=4, value='注册时间')
-            ws.cell(row=1, column=5, value='常居地')
-            ws.cell(row=1, column=6, value='用户主页')
-
-        def fill_user(ws, row, user):
-            ws.cell(row=row, column=1, value=user.douban_id)
-            ws.cell(row=row, column=2, value=user.unique_name)
-            ws.cell(row=row, column=3, value=user.name)
-            ws.cell(row=row, column=4, value=user.created)
-            ws.cell(row=row, column=5, value=user.loc_name)
-            ws.cell(row=row, column=6, value=user.alt)
-
-        worksheet = workbook.create_sheet('我关注的人')
-        fill_thead(worksheet)
-        query = db.Following.select(db.Following, db.User).join(
-            db.User, on=db.Following.following_user
-        ).where(db.Following.user == self.get_current_user()).order_by(db.Following.id.desc())
-        row_num = 2
-        for row in query:
-            fill_user(worksheet, row_num, row.following_user)
-            row_num += 1
-        
-        worksheet = workbook.create_sheet('关注我的人')
-        fill_thead(worksheet)
-        query = db.Follower.select(db.Follower, db.User).join(
-            db.User, on=db.Follower.follower
-        ).where(db.Follower.user == self.get_current_user()).order_by(db.Follower.id.desc())
-        row_num = 2
-        for row in query:
-            fill_user(worksheet, row_num, row.follower)
-            row_num += 1
-
-        worksheet = workbook.create_sheet('黑名单')
-        fill_thead(worksheet)
-        query = db.BlockUser.select(db.BlockUser, db.User).join(
-            db.User, on=db.BlockUser.block_user
-        ).where(db.BlockUser.user == self.get_current_user()).order_by(db.BlockUser.id.desc())
-        row_num = 2
-        for row in query:
-            fill_user(worksheet, row_num, row.block_user)
-            row_num += 1
-
-
-    def _export_broadcast(self, workbook):
-        def fill_thead(ws):
-            ws.cell(row=1, column=1, value='ID')
-            ws.cell(row=1, column=2, value='用户ID')
-            ws.cell(row=1, column=3, value='用户域名')
-            ws.cell(row=1, column=4, value='用户名号')
-            ws.cell(row=1, column=5, value='文字内容')
-            ws.cell(row=1, column=6, value='完整内容')
-            ws.cell(row=1, column=7, value='地址')
-            ws.cell(row=1, column=8, value='发表时间')
-            ws.cell(row=1, column=9, value='回应')
-            ws.cell(row=1, column=10, value='推荐')
-            ws.cell(row=1, column=11, value='转播')
-
-        worksheet = workbook.create_sheet('广播')
-        fill_thead(worksheet)
-        query = db.Timeline.select(
-            db.Timeline, 
-            db.Broadcast, 
-            db.User
-        ).join(db.Broadcast).join(db.User, db.JOIN.LEFT_OUTER, on=db.Timeline.broadcast.user).where(db.Timeline.user == self.get_current_user()).order_by(db.Timeline.id.desc())
-        row_num = 2
-        for row in query:
-            broadcast = row.broadcast
-            worksheet.cell(row=row_num, column=1, value=broadcast.douban_id)
-            if broadcast.user:
-                worksheet.cell(row=row_num, column=2, value=broadcast.user.douban_id)
-                worksheet.cell(row=row_num, column=3, value=broadcast.user.unique_name)
-                worksheet.cell(row=row_num, column=4, value=broadcast.user.name)
-            worksheet.cell(row=row_num, column=5, value=broadcast.blockquote)
-            worksheet.cell(row=row_num, column=6, value=broadcast.content)
-            worksheet.cell(row=row_num, column=7, value=broadcast.status_url)
-            worksheet.cell(row=row_num, column=8, value=broadcast.created)
-            worksheet.cell(row=row_num, column=9, value=broadcast.comments_count)
-            worksheet.cell(row=row_num, column=10, value=broadcast.like_count)
-            worksheet.cell(row=row_num, column=11, value=broadcast.reshared_count)
-            row_num += 1
\ No newline at end of file
+            rows = await ioloop.run_in_executor(_executor, export, filename, user, items, progress)
+        except Exception as e:
+            logging.exception('导出失败: {0}'.format(e))
+            self.notify('error', filename=filename, message=str(e))
+            raise
+        logging.info('导出 {0} 行到 {1}'.format(rows, filename))
+        self.notify('done', filename=filename, total=rows)
+        self.write('OK')
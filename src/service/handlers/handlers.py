@@ -27,7 +27,6 @@ class BaseRequestHandler(RequestHandler):
     def server(self):
         return self.application.server
 
-    
     def get_current_user(self):
         """
         获取当前用户，没有则返回None
@@ -105,12 +104,12 @@ class Book(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.Book.get(db.Book.douban_id == douban_id)
-            history = db.BookHistorical.select().where(db.BookHistorical.id == subject.id)
+            subject = db.read_only(db.Book.select().where(db.Book.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.Book.DoesNotExist:
             raise tornado.web.HTTPError(404)
         try:
-            mine = db.MyBook.get(db.MyBook.book == subject, db.MyBook.user == self.get_current_user())
+            mine = db.read_only(db.MyBook.select().where(db.MyBook.book == subject, db.MyBook.user == self.get_current_user())).get()
         except db.MyBook.DoesNotExist:
             mine = None
         self.render('book.html', subject=subject, history=history, mine=mine)
@@ -122,12 +121,12 @@ class Music(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.Music.get(db.Music.douban_id == douban_id)
-            history = db.MusicHistorical.select().where(db.MusicHistorical.id == subject.id)
+            subject = db.read_only(db.Music.select().where(db.Music.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.Music.DoesNotExist:
             raise tornado.web.HTTPError(404)
         try:
-            mine = db.MyMusic.get(db.MyMusic.music == subject, db.MyMusic.user == self.get_current_user())
+            mine = db.read_only(db.MyMusic.select().where(db.MyMusic.music == subject, db.MyMusic.user == self.get_current_user())).get()
         except db.MyMusic.DoesNotExist:
             mine = None
         self.render('music.html', subject=subject, history=history, mine=mine)
@@ -139,12 +138,12 @@ class Movie(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.Movie.get(db.Movie.douban_id == douban_id)
-            history = db.MovieHistorical.select().where(db.MovieHistorical.id == subject.id)
+            subject = db.read_only(db.Movie.select().where(db.Movie.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.Movie.DoesNotExist:
             raise tornado.web.HTTPError(404)
         try:
-            mine = db.MyMovie.get(db.MyMovie.movie == subject, db.MyMovie.user == self.get_current_user())
+            mine = db.read_only(db.MyMovie.select().where(db.MyMovie.movie == subject, db.MyMovie.user == self.get_current_user())).get()
         except db.MyMovie.DoesNotExist:
             mine = None
         self.render('movie.html', subject=subject, history=history, mine=mine)
@@ -156,14 +155,14 @@ class Broadcast(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.Broadcast.get(db.Broadcast.douban_id == douban_id)
+            subject = db.read_only(db.Broadcast.select().where(db.Broadcast.douban_id == douban_id)).get()
         except db.Broadcast.DoesNotExist:
             raise tornado.web.HTTPError(404)
 
-        comments = db.Comment.select().join(db.User).where(
+        comments = db.read_only(db.Comment.select().join(db.User).where(
             db.Comment.target_type == 'broadcast',
             db.Comment.target_douban_id == subject.douban_id
-        )
+        ))
 
         self.render('broadcast.html', subject=subject, comments=comments)
 
@@ -175,20 +174,20 @@ class User(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.User.get(db.User.douban_id == douban_id)
-            history = db.UserHistorical.select().where(db.UserHistorical.id == subject.id)
+            subject = db.read_only(db.User.select().where(db.User.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.User.DoesNotExist:
             raise tornado.web.HTTPError(404)
 
-        is_follower = db.Follower.select().where(
+        is_follower = db.read_only(db.Follower.select().where(
             db.Follower.follower == subject,
             db.Follower.user == self.get_current_user()
-        ).exists()
+        )).exists()
 
-        is_following = db.Following.select().where(
+        is_following = db.read_only(db.Following.select().where(
             db.Following.following_user == subject,
             db.Following.user == self.get_current_user()
-        ).exists()
+        )).exists()
 
         self.render('user.html', subject=subject, history=history, is_follower=is_follower, is_following=is_following)
 
@@ -200,7 +199,7 @@ class Attachment(BaseRequestHandler):
 
     def get(self, url):
         try:
-            attachment = db.Attachment.get(db.Attachment.url == url)
+            attachment = db.read_only(db.Attachment.select().where(db.Attachment.url == url)).get()
             if attachment.local:
                 self.redirect(self.reverse_url('cache', attachment.local))
                 return
@@ -216,15 +215,15 @@ class Note(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.Note.get(db.Note.douban_id == douban_id)
-            history = db.NoteHistorical.select().where(db.NoteHistorical.id == subject.id)
+            subject = db.read_only(db.Note.select().where(db.Note.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.Note.DoesNotExist:
             raise tornado.web.HTTPError(404)
 
-        comments = db.Comment.select().join(db.User).where(
+        comments = db.read_only(db.Comment.select().join(db.User).where(
             db.Comment.target_type == 'note',
             db.Comment.target_douban_id == subject.douban_id
-        )
+        ))
 
         dom = PyQuery(subject.content)
         dom_iframe = dom('iframe')
@@ -241,15 +240,15 @@ class PhotoPicture(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.PhotoPicture.get(db.PhotoPicture.douban_id == douban_id)
-            history = db.PhotoPictureHistorical.select().where(db.PhotoPictureHistorical.id == subject.id)
+            subject = db.read_only(db.PhotoPicture.select().where(db.PhotoPicture.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.PhotoPicture.DoesNotExist:
             raise tornado.web.HTTPError(404)
 
-        comments = db.Comment.select().join(db.User).where(
+        comments = db.read_only(db.Comment.select().join(db.User).where(
             db.Comment.target_type == 'photo',
             db.Comment.target_douban_id == subject.douban_id
-        )
+        ))
 
         self.render('photo.html', photo=subject, comments=comments)
 
@@ -260,12 +259,12 @@ class PhotoAlbum(BaseRequestHandler):
     """
     def get(self, douban_id):
         try:
-            subject = db.PhotoAlbum.get(db.PhotoAlbum.douban_id == douban_id)
-            history = db.PhotoAlbumHistorical.select().where(db.PhotoAlbumHistorical.id == subject.id)
+            subject = db.read_only(db.PhotoAlbum.select().where(db.PhotoAlbum.douban_id == douban_id)).get()
+            history = db.read_only(subject.revisions())
         except db.PhotoAlbum.DoesNotExist:
             raise tornado.web.HTTPError(404)
 
-        photos = db.PhotoPicture.select().where(db.PhotoPicture.photo_album == subject)
+        photos = db.read_only(db.PhotoPicture.select().where(db.PhotoPicture.photo_album == subject))
 
         self.render('album.html', album=subject, photos=photos)
 
@@ -1,13 +1,32 @@
 # encoding: utf-8
 import math
+from collections import OrderedDict
 
 import handlers
 import db
+import fulltext
 
 import tornado
 
 
 _PAGE_SIZE_ = 50
+_PAGE_INDEX_CAPACITY_ = 64
+
+# 列表查询的总行数和已经定位过的页第一行的键，以查询语句为键缓存，写入相关的表后失效
+_page_indexes = OrderedDict()
+
+
+def invalidate_list_cache(tables=None):
+    """
+    清除列表缓存。tables 为被写入的表名，为 None 时全部清除
+    """
+    if tables is None:
+        _page_indexes.clear()
+        return
+    quoted_tables = ['"{0}"'.format(table) for table in tables]
+    for cache_key in list(_page_indexes):
+        if any(quoted_table in cache_key[0] for quoted_table in quoted_tables):
+            del _page_indexes[cache_key]
 
 
 def require_login(func):
@@ -35,6 +54,7 @@ class BaseRequestHandler(handlers.BaseRequestHandler):
     基础类
     """
     def prepare(self):
+        super().prepare()
         try:
             db.Account.get_default()
         except db.Account.DoesNotExist:
@@ -44,15 +64,72 @@ class BaseRequestHandler(handlers.BaseRequestHandler):
             # 已登录，未抓取
             self.redirect(self.reverse_url('dashboard'))
 
-    def list(self, query, template, **kwargs):
+    def page_index(self, query, key=None):
+        """
+        返回查询的总行数和 {页码: 该页第一行的键}。key 为查询按降序排列所依据的唯一字段，
+        为 None 时只统计总行数。建立索引时只记下第一页的键，其他页在翻到时再定位
+        """
+        sql, params = query.sql()
+        cache_key = (sql, tuple(params), key is not None)
+        try:
+            _page_indexes.move_to_end(cache_key)
+            return _page_indexes[cache_key]
+        except KeyError:
+            pass
+
+        total_rows = query.count()
+        if key is None:
+            page_index = (total_rows, None)
+        else:
+            page_keys = {}
+            for row_key, in query.select(key).limit(1).tuples():
+                page_keys[1] = row_key
+            page_index = (total_rows, page_keys)
+
+        _page_indexes[cache_key] = page_index
+        while len(_page_indexes) > _PAGE_INDEX_CAPACITY_:
+            _page_indexes.popitem(last=False)
+        return page_index
+
+    def page_key(self, query, key, page_keys, page):
+        """
+        返回第 page 页第一行的键，从前面最近一个已经定位过的页往后数，找到的键记入 page_keys。
+        页不存在时返回 None
+        """
+        if page not in page_keys:
+            known_pages = [known_page for known_page in page_keys if known_page < page]
+            if not known_pages:
+                return None
+            known_page = max(known_pages)
+            rows = query.select(key).where(key <= page_keys[known_page]).offset(
+                (page - known_page) * _PAGE_SIZE_
+            ).limit(1).tuples()
+            for row_key, in rows:
+                page_keys[page] = row_key
+        return page_keys.get(page)
+
+    def list(self, query, template, key=None, **kwargs):
+        """
+        分页显示查询结果，查询使用只读连接。指定 key 时按键定位每一页：
+        第一页不设下界，总能看到最新写入的行；后面的页从第一页的键往后数，顺序翻页只需读一页的行
+        """
+        query = db.read_only(query)
         try:
             page = int(self.get_query_argument('page', 1))
         except:
             page = 1
-        total_rows = query.count()
+        total_rows, page_keys = self.page_index(query, key)
         total_pages = int(math.ceil(total_rows / _PAGE_SIZE_))
 
-        rows = query.paginate(page, _PAGE_SIZE_)
+        if page_keys is None:
+            rows = query.paginate(page, _PAGE_SIZE_)
+        elif page == 1:
+            rows = query.limit(_PAGE_SIZE_)
+        elif 1 < page <= total_pages:
+            page_key = self.page_key(query, key, page_keys, page)
+            rows = [] if page_key is None else query.where(key <= page_key).limit(_PAGE_SIZE_)
+        else:
+            rows = []
         self.render(template, rows=rows, page=page, total_pages=total_pages, total_rows=total_rows, page_size=_PAGE_SIZE_, **kwargs)
 
 
@@ -72,7 +149,7 @@ class Following(BaseRequestHandler):
         query = db.Following.select(db.Following, db.User).join(
             db.User, on=db.Following.following_user
         ).where(where_condition).order_by(db.Following.id.desc())
-        self.list(query, 'my/following.html', search=search)
+        self.list(query, 'my/following.html', key=db.Following.id, search=search)
 
 
 class Followers(BaseRequestHandler):
@@ -86,7 +163,7 @@ class Followers(BaseRequestHandler):
         query = db.Follower.select(db.Follower, db.User).join(
             db.User, on=db.Follower.follower
         ).where(where_condition).order_by(db.Follower.id.desc())
-        self.list(query, 'my/followers.html', search=search)
+        self.list(query, 'my/followers.html', key=db.Follower.id, search=search)
 
 
 class Blocklist(BaseRequestHandler):
@@ -100,7 +177,7 @@ class Blocklist(BaseRequestHandler):
         query = db.BlockUser.select(db.BlockUser, db.User).join(
             db.User, on=db.BlockUser.block_user
         ).where(where_condition).order_by(db.BlockUser.id.desc())
-        self.list(query, 'my/blocklist.html', search=search)
+        self.list(query, 'my/blocklist.html', key=db.BlockUser.id, search=search)
 
 
 class FollowingHistorical(BaseRequestHandler):
@@ -114,7 +191,7 @@ class FollowingHistorical(BaseRequestHandler):
         query = db.FollowingHistorical.select(db.FollowingHistorical, db.User).join(
             db.User, on=db.FollowingHistorical.following_user
         ).where(where_condition).order_by(db.FollowingHistorical.id.desc())
-        self.list(query, 'my/following_historical.html', search=search)
+        self.list(query, 'my/following_historical.html', key=db.FollowingHistorical.id, search=search)
 
 
 class FollowersHistorical(BaseRequestHandler):
@@ -128,7 +205,7 @@ class FollowersHistorical(BaseRequestHandler):
         query = db.FollowerHistorical.select(db.FollowerHistorical, db.User).join(
             db.User, on=db.FollowerHistorical.follower
         ).where(where_condition).order_by(db.FollowerHistorical.id.desc())
-        self.list(query, 'my/followers_historical.html', search=search)
+        self.list(query, 'my/followers_historical.html', key=db.FollowerHistorical.id, search=search)
 
 
 class BlocklistHistorical(BaseRequestHandler):
@@ -142,7 +219,7 @@ class BlocklistHistorical(BaseRequestHandler):
         query = db.BlockUserHistorical.select(db.BlockUserHistorical, db.User).join(
             db.User, on=db.BlockUserHistorical.block_user
         ).where(where_condition).order_by(db.BlockUserHistorical.id.desc())
-        self.list(query, 'my/blocklist_historical.html', search=search)
+        self.list(query, 'my/blocklist_historical.html', key=db.BlockUserHistorical.id, search=search)
 
 
 class Movie(BaseRequestHandler):
@@ -153,10 +230,28 @@ class Movie(BaseRequestHandler):
         if search:
             where_condition &= (db.Movie.title.contains(search) | db.Movie.alt_title.contains(search))
 
+        # 按导演、年份和豆瓣评分筛选，需要 SQLite 的 JSON1 扩展
+        director = self.get_query_argument('director', None)
+        year = self.get_query_argument('year', None)
+        try:
+            min_rating = float(self.get_query_argument('rating', None))
+        except (TypeError, ValueError):
+            min_rating = None
+        if db.SQLITE_SUPPORTS_JSON:
+            if director:
+                where_condition &= db.Movie.attrs.has_element('$.director', director)
+            if year:
+                where_condition &= (db.Movie.attrs.extract('$.year[0]') == year)
+            if min_rating is not None:
+                where_condition &= (db.Movie.rating.extract('$.average') >= min_rating)
+        else:
+            director = year = min_rating = None
+
         query = db.MyMovie.select(db.MyMovie, db.Movie).join(
             db.Movie, on=db.MyMovie.movie
         ).where(where_condition, db.MyMovie.status == status).order_by(db.MyMovie.id.desc())
-        self.list(query, 'my/movie.html', status=status, search=search)
+        self.list(query, 'my/movie.html', key=db.MyMovie.id, status=status, search=search,
+                  director=director, year=year, min_rating=min_rating)
 
 
 class MovieHistorical(BaseRequestHandler):
@@ -170,7 +265,7 @@ class MovieHistorical(BaseRequestHandler):
         query = db.MyMovieHistorical.select(db.MyMovieHistorical, db.Movie).join(
             db.Movie, on=db.MyMovieHistorical.movie
         ).where(where_condition).order_by(db.MyMovieHistorical.id.desc())
-        self.list(query, 'my/movie_historical.html', search=search)
+        self.list(query, 'my/movie_historical.html', key=db.MyMovieHistorical.id, search=search)
 
 
 class Book(BaseRequestHandler):
@@ -184,7 +279,7 @@ class Book(BaseRequestHandler):
         query = db.MyBook.select(db.MyBook, db.Book).join(
             db.Book, on=db.MyBook.book
         ).where(where_condition, db.MyBook.status == status).order_by(db.MyBook.id.desc())
-        self.list(query, 'my/book.html', status=status, search=search)
+        self.list(query, 'my/book.html', key=db.MyBook.id, status=status, search=search)
 
 
 class BookHistorical(BaseRequestHandler):
@@ -198,7 +293,7 @@ class BookHistorical(BaseRequestHandler):
         query = db.MyBookHistorical.select(db.MyBookHistorical, db.Book).join(
             db.Book, on=db.MyBookHistorical.book
         ).where(where_condition).order_by(db.MyBookHistorical.id.desc())
-        self.list(query, 'my/book_historical.html', search=search)
+        self.list(query, 'my/book_historical.html', key=db.MyBookHistorical.id, search=search)
 
 
 class Music(BaseRequestHandler):
@@ -212,7 +307,7 @@ class Music(BaseRequestHandler):
         query = db.MyMusic.select(db.MyMusic, db.Music).join(
             db.Music, on=db.MyMusic.music
         ).where(where_condition, db.MyMusic.status == status).order_by(db.MyMusic.id.desc())
-        self.list(query, 'my/music.html', status=status, search=search)
+        self.list(query, 'my/music.html', key=db.MyMusic.id, status=status, search=search)
 
 
 class MusicHistorical(BaseRequestHandler):
@@ -226,7 +321,7 @@ class MusicHistorical(BaseRequestHandler):
         query = db.MyMusicHistorical.select(db.MyMusicHistorical, db.Music).join(
             db.User, on=db.MyMusicHistorical.music
         ).where(where_condition).order_by(db.MyMusicHistorical.id.desc())
-        self.list(query, 'my/music_historical.html', search=search)
+        self.list(query, 'my/music_historical.html', key=db.MyMusicHistorical.id, search=search)
 
 
 class Broadcast(BaseRequestHandler):
@@ -235,14 +330,17 @@ class Broadcast(BaseRequestHandler):
 
         search = self.get_query_argument('s', None)
         if search:
-            where_condition &= (db.Broadcast.blockquote.contains(search) | db.Broadcast.content.contains(search))
+            where_condition &= fulltext.match(
+                'broadcast', db.Broadcast.id, search,
+                db.Broadcast.blockquote.contains(search) | db.fn.decompress_text(db.Broadcast.content).contains(search)
+            )
 
         query = db.Timeline.select(
             db.Timeline, 
             db.Broadcast, 
             db.User
-        ).join(db.Broadcast).join(db.User, db.JOIN.LEFT_OUTER, on=db.Timeline.broadcast.user).where(where_condition).order_by(db.Timeline.id.desc())
-        self.list(query, 'my/broadcast.html', search=search)
+        ).join(db.Broadcast).join(db.User, db.JOIN.LEFT_OUTER, on=db.Timeline.broadcast.user).where(where_condition).order_by(db.Timeline.sequence.desc())
+        self.list(query, 'my/broadcast.html', key=db.Timeline.sequence, search=search)
 
 
 class Note(BaseRequestHandler):
@@ -251,7 +349,10 @@ class Note(BaseRequestHandler):
 
         search = self.get_query_argument('s', None)
         if search:
-            where_condition &= (db.Note.title.contains(search) | db.Note.introduction.contains(search) | db.Note.content.contains(search))
+            where_condition &= fulltext.match(
+                'note', db.Note.id, search,
+                db.Note.title.contains(search) | db.Note.introduction.contains(search) | db.fn.decompress_text(db.Note.content).contains(search)
+            )
 
         query = db.Note.select().where(where_condition).order_by(db.Note.created.desc())
         self.list(query, 'my/note.html', search=search)
@@ -263,7 +364,10 @@ class Photo(BaseRequestHandler):
 
         search = self.get_query_argument('s', None)
         if search:
-            where_condition &= (db.PhotoAlbum.title.contains(search) | db.PhotoAlbum.desc.contains(search))
+            where_condition &= fulltext.match(
+                'photo_album', db.PhotoAlbum.id, search,
+                db.PhotoAlbum.title.contains(search) | db.PhotoAlbum.desc.contains(search)
+            )
 
         query = db.PhotoAlbum.select().where(where_condition)
         self.list(query, 'my/photo.html', search=search)
@@ -289,7 +393,10 @@ class Favorite(BaseRequestHandler):
         if category == 'note':
             where_condition = ((db.Favorite.user == self.get_current_user()) & (db.Favorite.target_type == target_type))
             if search:
-                where_condition &= (db.Note.title.contains(search) | db.Note.introduction.contains(search) | db.Note.content.contains(search))
+                where_condition &= fulltext.match(
+                    'note', db.Note.id, search,
+                    db.Note.title.contains(search) | db.Note.introduction.contains(search) | db.fn.decompress_text(db.Note.content).contains(search)
+                )
 
             query = db.Favorite.select(
                 db.Favorite,
@@ -303,7 +410,10 @@ class Favorite(BaseRequestHandler):
         elif category == 'photo':
             where_condition = ((db.Favorite.user == self.get_current_user()) & (db.Favorite.target_type == target_type))
             if search:
-                where_condition &= (db.PhotoAlbum.title.contains(search) | db.PhotoAlbum.desc.contains(search))
+                where_condition &= fulltext.match(
+                    'photo_album', db.PhotoAlbum.id, search,
+                    db.PhotoAlbum.title.contains(search) | db.PhotoAlbum.desc.contains(search)
+                )
 
             query = db.Favorite.select(
                 db.Favorite,
@@ -316,5 +426,5 @@ class Favorite(BaseRequestHandler):
         elif category == 'picture':
             query.join(db.PhotoAlbum, db.JOIN.INNER)
 
-        self.list(query, 'my/favorite/{0}.html'.format(category), search=search)
+        self.list(query, 'my/favorite/{0}.html'.format(category), key=db.Favorite.id, search=search)
 
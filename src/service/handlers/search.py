@@ -1,13 +1,41 @@
 # encoding: utf-8
 import logging
+import math
 
+import fulltext
 from .handlers import BaseRequestHandler
 
 
+_PAGE_SIZE_ = 20
+
+
 class Index(BaseRequestHandler):
     """
     搜索主页
     """
     def get(self):
-        
-        self.render('search.html')
\ No newline at end of file
+        search = self.get_query_argument('q', '').strip()
+        kind = self.get_query_argument('type', None)
+        if kind not in fulltext.KINDS:
+            kind = None
+        try:
+            page = max(1, int(self.get_query_argument('page', 1)))
+        except ValueError:
+            page = 1
+
+        results, facets = fulltext.search(search, kind, (page - 1) * _PAGE_SIZE_, _PAGE_SIZE_)
+        total_rows = facets.get(kind, 0) if kind else sum(facets.values())
+        total_pages = int(math.ceil(total_rows / _PAGE_SIZE_))
+
+        self.render(
+            'search.html',
+            search=search,
+            kind=kind,
+            kinds=fulltext.KINDS,
+            results=results,
+            facets=facets,
+            page=page,
+            total_pages=total_pages,
+            total_rows=total_rows,
+            available=fulltext.is_ready()
+        )
@@ -1,7 +1,7 @@
 # encoding: utf-8
 from ..handlers import BaseRequestHandler
 import setting
-from worker import REQUESTS_PER_MINUTE, LOCAL_OBJECT_DURATION, BROADCAST_ACTIVE_DURATION, BROADCAST_INCREMENTAL_BACKUP, IMAGE_LOCAL_CACHE
+from worker import REQUESTS_PER_MINUTE, CONCURRENT_REQUESTS, LOCAL_OBJECT_DURATION, BROADCAST_ACTIVE_DURATION, BROADCAST_INCREMENTAL_BACKUP, IMAGE_LOCAL_CACHE, HTTP_CACHE, PARSE_PROCESSES
 
 
 class General(BaseRequestHandler):
@@ -11,17 +11,23 @@ class General(BaseRequestHandler):
 
     def get(self, flash=''):
         requests_per_minute = setting.get('worker.requests-per-minute', int, REQUESTS_PER_MINUTE)
+        concurrent_requests = setting.get('worker.concurrent-requests', int, CONCURRENT_REQUESTS)
+        parse_processes = setting.get('worker.parse-processes', int, PARSE_PROCESSES)
         local_object_duration = setting.get('worker.local-object-duration', int, LOCAL_OBJECT_DURATION)
         broadcast_active_duration = setting.get('worker.broadcast-active-duration', int, BROADCAST_ACTIVE_DURATION)
         broadcast_incremental_backup = setting.get('worker.broadcast-incremental-backup', bool, BROADCAST_INCREMENTAL_BACKUP)
         image_local_cache = setting.get('worker.image-local-cache', bool, IMAGE_LOCAL_CACHE)
+        http_cache = setting.get('worker.http-cache', bool, HTTP_CACHE)
         self.render(
             'settings/general.html',
             requests_per_minute=requests_per_minute,
+            concurrent_requests=concurrent_requests,
+            parse_processes=parse_processes,
             local_object_duration=int(local_object_duration / (60 * 60 *24)),
             broadcast_active_duration=int(broadcast_active_duration / (60 * 60 *24)),
             broadcast_incremental_backup=broadcast_incremental_backup,
             image_local_cache=image_local_cache,
+            http_cache=http_cache,
             flash=flash
         )
 
@@ -29,6 +35,12 @@ class General(BaseRequestHandler):
         requests_per_minute = self.get_argument('requests-per-minute')
         setting.set('worker.requests-per-minute', requests_per_minute, int)
 
+        concurrent_requests = self.get_argument('concurrent-requests')
+        setting.set('worker.concurrent-requests', concurrent_requests, int)
+
+        parse_processes = self.get_argument('parse-processes')
+        setting.set('worker.parse-processes', parse_processes, int)
+
         local_object_duration_days = int(self.get_argument('local-object-duration'))
         local_object_duration = local_object_duration_days * 60 * 60 *24
         setting.set('worker.local-object-duration', local_object_duration, int)
@@ -43,6 +55,9 @@ class General(BaseRequestHandler):
         image_local_cache = int(self.get_argument('image-local-cache'))
         setting.set('worker.image-local-cache', image_local_cache, bool)
 
+        http_cache = int(self.get_argument('http-cache'))
+        setting.set('worker.http-cache', http_cache, bool)
+
         return self.get('需要重启工作进程或者程序才能使设置生效')
 
 
@@ -0,0 +1,82 @@
+# encoding: utf-8
+import json
+from collections import deque
+
+import tornado.ioloop
+
+
+# 合并发送日志的间隔（毫秒）
+FLUSH_INTERVAL = 250
+# 保留最近的日志，新连接的客户端先收到这些日志
+HISTORY_SIZE = 1000
+# 等待发送的日志超过这个数量时丢弃 DEBUG 日志
+PRESSURE_THRESHOLD = 500
+# 等待发送的日志上限，超过后丢弃最旧的日志
+PENDING_LIMIT = 5000
+
+
+class LogStream:
+    """
+    向客户端推送日志
+
+    工作进程的日志先放入缓冲区，每隔 FLUSH_INTERVAL 毫秒合并成一帧发给所有客户端，
+    而不是每条日志发送一次。日志过多时先丢弃 DEBUG 日志，丢弃的条数随下一帧告知客户端。
+    """
+
+    def __init__(self, clients, interval=FLUSH_INTERVAL, history_size=HISTORY_SIZE):
+        self._clients = clients
+        self._pending = deque(maxlen=PENDING_LIMIT)
+        self._history = deque(maxlen=history_size)
+        self._dropped = 0
+        self._callback = tornado.ioloop.PeriodicCallback(self.flush, interval)
+
+    @property
+    def history(self):
+        return list(self._history)
+
+    def start(self):
+        self._callback.start()
+
+    def stop(self):
+        self._callback.stop()
+        self.flush()
+
+    def append(self, message, level):
+        """
+        添加一条日志
+        """
+        if level == 'DEBUG' and len(self._pending) >= PRESSURE_THRESHOLD:
+            self._dropped += 1
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self._dropped += 1
+        self._pending.append({
+            'message': message,
+            'level': level,
+        })
+
+    def flush(self):
+        """
+        把缓冲区中的日志合并成一帧发给所有客户端
+        """
+        if not self._pending and not self._dropped:
+            return
+        entries = list(self._pending)
+        dropped = self._dropped
+        self._pending.clear()
+        self._dropped = 0
+        self._history.extend(entries)
+        for client in list(self._clients.values()):
+            client.send_logs(entries, dropped)
+
+
+def log_frame(entries, dropped=0, history=False):
+    """
+    生成日志帧
+    """
+    return json.dumps({
+        'sender': 'logger',
+        'messages': entries,
+        'dropped': dropped,
+        'history': history,
+    })
@@ -4,14 +4,26 @@ import logging
 import os
 import sys
 import time
+from collections import OrderedDict
 
 import db
+import fulltext
 import version
 from server import Server
 from worker import Worker
 from setting import settings, DEFAULT_SERVICE_PORT, DEFAULT_DATEBASE, DEFAULT_CACHE_PATH, DEFAULT_SERVICE_HOST, DEFAULT_LOG_PATH, DEFAULT_DEBUG_MODE, DEFAULT_SILENT_MODE
 
 
+def pragma_arg(text):
+    """
+    解析形如 name=value 的数据库连接参数
+    """
+    name, _, value = text.partition('=')
+    if not name.strip() or not value.strip():
+        raise argparse.ArgumentTypeError('invalid pragma "{0}"'.format(text))
+    return name.strip().lower(), value.strip()
+
+
 def parse_args(args):
     """
     解析命令参数
@@ -34,6 +46,8 @@ def parse_args(args):
                         metavar='log', dest='log', help='specify the log files path')
     parser.add_argument('-q', '--quiet', action='store_true',
                         default=DEFAULT_SILENT_MODE, help='switch on silent mode')
+    parser.add_argument('--pragma', action='append', default=[], type=pragma_arg,
+                        metavar='name=value', dest='pragmas', help='override a sqlite pragma, e.g. mmap_size=0')
                         
     return parser.parse_args(args)
 
@@ -70,6 +84,26 @@ def init_logger():
     )
 
 
+def parse_pragmas(overrides):
+    """
+    用命令行参数覆盖默认的数据库连接参数
+    """
+    pragmas = OrderedDict(db.DEFAULT_PRAGMAS)
+    pragmas.update(overrides)
+    return list(pragmas.items())
+
+
+def report_database():
+    """
+    输出数据库连接实际生效的参数
+    """
+    report = db.pragma_report()
+    logging.info('database pragmas: ' + ', '.join('{0}={1}'.format(name, value) for name, value in report.items()))
+    expected = dict(db.DATEBASE_PRAGMAS).get('journal_mode')
+    if expected and str(report.get('journal_mode')).lower() != str(expected).lower():
+        logging.warn('database journal mode is "{0}" instead of "{1}"'.format(report.get('journal_mode'), expected))
+
+
 def main(args):
     """
     程序主函数
@@ -88,7 +122,10 @@ def main(args):
     init_env()
     init_logger()
     
-    db.init(parsed_args.database)
+    db.init(parsed_args.database, pragmas=parse_pragmas(parsed_args.pragmas))
+    fulltext.init()
+    db.init_reader()
+    report_database()
 
     server = Server(parsed_args.port, DEFAULT_SERVICE_HOST, parsed_args.cache)
     server.run()
@@ -0,0 +1,64 @@
+# encoding: utf-8
+from multiprocessing import Array, Lock
+from time import sleep, time
+from urllib.parse import urlparse
+
+
+DEFAULT_BURST = 5
+
+# 按目标主机分别限流，豆瓣图片 CDN 的各个子域名共用一个配额
+HOSTS = (
+    'www.douban.com',
+    'm.douban.com',
+    'api.douban.com',
+    'doubanio.com',
+    '*',
+)
+
+
+def host_key(url):
+    """
+    返回 URL 对应的限流主机
+    """
+    host = urlparse(url).hostname or ''
+    if host in HOSTS:
+        return host
+    if host.endswith('.doubanio.com'):
+        return 'doubanio.com'
+    return '*'
+
+
+class TokenBucket:
+    """
+    跨进程共享的令牌桶
+
+    状态保存在共享内存中，由 Server 创建后传给所有工作进程，
+    因此无论有多少个工作进程，每个主机的总请求频率都不会超过 requests_per_minute。
+    桶内最多积攒 burst 个令牌，空闲之后允许短时间的突发请求。
+    """
+
+    def __init__(self, requests_per_minute, burst=DEFAULT_BURST):
+        self._rate = requests_per_minute / 60
+        self._capacity = max(1, burst)
+        now = time()
+        # 每个主机占两个槽位：剩余令牌数，最后一次计算的时间
+        state = []
+        for _ in HOSTS:
+            state.extend([self._capacity, now])
+        self._state = Array('d', state, lock=False)
+        self._lock = Lock()
+
+    def acquire(self, url):
+        """
+        为请求预订一个令牌，令牌不足时阻塞到轮到自己为止
+        """
+        offset = HOSTS.index(host_key(url)) * 2
+        with self._lock:
+            now = time()
+            tokens = self._state[offset] + (now - self._state[offset + 1]) * self._rate
+            tokens = min(self._capacity, tokens) - 1
+            self._state[offset] = tokens
+            self._state[offset + 1] = now
+        # 令牌数为负表示已经预订了未来的令牌，等到它生成为止
+        if tokens < 0:
+            sleep(-tokens / self._rate)
@@ -0,0 +1,91 @@
+# encoding: utf-8
+import heapq
+import itertools
+from collections import OrderedDict
+
+
+# 不通过代理连接的工作进程
+DIRECT = ''
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class Scheduler:
+    """
+    任务调度
+
+    等待的任务按帐号分组，每个帐号内按优先级和加入顺序排成堆，
+    取任务时在帐号之间轮转，避免先加入的帐号长时间占满工作进程。
+    任务按 (任务类型, 帐号 id) 建立索引，重复的任务可以直接判断。
+    任务可以指定由某个代理的工作进程执行，未指定的任务交给任意空闲的工作进程。
+    """
+
+    def __init__(self):
+        # (任务类型, 帐号 id) => 条目
+        self._index = {}
+        # 帐号 id => {route => 堆}，顺序即轮转顺序
+        self._accounts = OrderedDict()
+        self._sequence = itertools.count()
+
+    @staticmethod
+    def key(task):
+        return type(task), task.account_id
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, task):
+        return self.key(task) in self._index
+
+    @property
+    def tasks(self):
+        """
+        等待中的任务，按优先级和加入顺序排列
+        """
+        return [entry[2] for entry in sorted(self._index.values())]
+
+    def push(self, task, priority=False, route=None):
+        """
+        加入任务。相同类型、相同帐号的任务已在等待时返回 False；
+        route 为代理地址时只由该代理的工作进程执行，DIRECT 表示不使用代理的工作进程
+        """
+        key = self.key(task)
+        if key in self._index:
+            return False
+        entry = [PRIORITY_HIGH if priority else PRIORITY_NORMAL, next(self._sequence), task, route]
+        self._index[key] = entry
+        heapq.heappush(self._accounts.setdefault(key[1], {}).setdefault(route, []), entry)
+        return True
+
+    def pop(self, route=DIRECT):
+        """
+        为 route 对应的工作进程取出下一个任务，没有可执行的任务时返回 None
+        """
+        chosen = None
+        for account_id, heaps in self._accounts.items():
+            for heap_route in (None, route):
+                heap = heaps.get(heap_route)
+                if heap and (chosen is None or heap[0][0] < chosen[2][0][0]):
+                    chosen = (account_id, heap_route, heap)
+            if chosen is not None and chosen[2][0][0] == PRIORITY_HIGH:
+                break
+        if chosen is None:
+            return None
+
+        account_id, heap_route, heap = chosen
+        entry = heapq.heappop(heap)
+        task = entry[2]
+        del self._index[self.key(task)]
+        heaps = self._accounts[account_id]
+        if not heap:
+            del heaps[heap_route]
+        if heaps:
+            self._accounts.move_to_end(account_id)
+        else:
+            del self._accounts[account_id]
+        return task
+
+    def clear(self):
+        self._index.clear()
+        self._accounts.clear()
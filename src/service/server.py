@@ -3,6 +3,8 @@ import logging
 import os
 import sys
 import json
+import threading
+import datetime
 from collections import deque
 from multiprocessing import Queue
 from multiprocessing import queues
@@ -13,10 +15,23 @@ import db
 import urls
 import setting
 import uimodules
-from worker import Worker, REQUESTS_PER_MINUTE, LOCAL_OBJECT_DURATION, BROADCAST_ACTIVE_DURATION, BROADCAST_INCREMENTAL_BACKUP, IMAGE_LOCAL_CACHE
+from ratelimit import TokenBucket
+from dbwriter import DatabaseWriter
+from logstream import LogStream, log_frame
+from scheduler import Scheduler, DIRECT
+from worker import Worker, REQUESTS_PER_MINUTE, CONCURRENT_REQUESTS, LOCAL_OBJECT_DURATION, BROADCAST_ACTIVE_DURATION, BROADCAST_INCREMENTAL_BACKUP, IMAGE_LOCAL_CACHE, HTTP_CACHE, PARSE_PROCESSES
 from setting import settings
-from tasks import Task
+from tasks import Task, TASK_TYPES
 from handlers import NotFound
+from handlers.my import invalidate_list_cache
+
+
+# 每次交给 IOLoop 处理的工作进程消息的最大条数，避免一次处理太多阻塞界面请求
+RESULT_BATCH_SIZE = 500
+# 客户端来不及接收时最多积压的日志条数
+CLIENT_LOG_BACKLOG = 2000
+# 已结束的任务记录保留的时间
+TASK_HISTORY_DURATION = 60 * 60 * 24 * 30
 
 
 class Client:
@@ -33,13 +48,47 @@ class Client:
             raise Exception('Invalid handler type')
 
         self.handler = handler
+        self._writing = None
+        self._log_backlog = deque(maxlen=CLIENT_LOG_BACKLOG)
+        self._log_dropped = 0
 
     def send_websocket(self, message):
-        self.handler.write_message(message)
+        try:
+            return self.handler.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            return None
 
     def send_http_request(self, message):
         self.handler.write(message)
 
+    def send_logs(self, entries, dropped=0, history=False):
+        """
+        发送一批日志。上一帧还没有写完时先积压起来，积压过多时丢弃最旧的日志
+        """
+        if history:
+            self._log_backlog.clear()
+            self._log_dropped = 0
+        overflow = len(self._log_backlog) + len(entries) - self._log_backlog.maxlen
+        self._log_dropped += dropped + max(0, overflow)
+        self._log_backlog.extend(entries)
+        self._flush_logs(history)
+
+    def _flush_logs(self, history=False):
+        if self._writing is not None and not self._writing.done():
+            return
+        if not self._log_backlog and not self._log_dropped and not history:
+            return
+        frame = log_frame(list(self._log_backlog), self._log_dropped, history)
+        self._log_backlog.clear()
+        self._log_dropped = 0
+        self._writing = self.send(frame)
+        if self._writing is not None:
+            tornado.ioloop.IOLoop.current().add_future(self._writing, self._written)
+
+    def _written(self, future):
+        if future.exception() is None:
+            self._flush_logs()
+
 
 class Application(tornado.web.Application):
     """
@@ -51,6 +100,7 @@ class Application(tornado.web.Application):
 
         self._clients = dict()
         self._server = kwargs['server']
+        self._log_stream = LogStream(self._clients)
 
     @property
     def server(self):
@@ -59,11 +109,19 @@ class Application(tornado.web.Application):
         """
         return self._server
 
+    @property
+    def log_stream(self):
+        """
+        获得日志推送对象
+        """
+        return self._log_stream
+
     def register_client(self, handler):
         """
         注册客户端
         """
-        self._clients[handler] = Client(handler)
+        client = self._clients[handler] = Client(handler)
+        client.send_logs(self._log_stream.history, history=True)
 
     def unregister_client(self, handler):
         """
@@ -75,9 +133,9 @@ class Application(tornado.web.Application):
         """
         向所有在线客户端发送广播
         """
-        for client in self._clients:
+        for client in list(self._clients.values()):
             try:
-                client.write_message(message)
+                client.send(message)
             except:
                 pass
 
@@ -112,9 +170,13 @@ class Server:
         self.application = application
 
         self._worker_output = Queue()
-        self._worker_input = Queue()
+        self._ioloop = tornado.ioloop.IOLoop.current()
+        # 工作进程只读取数据库，写入都交给这个线程
+        self._db_writer = DatabaseWriter(db.DATEBASE_PATH, db.DATEBASE_PRAGMAS, self._tables_written)
         self._workers = dict()
-        self._tasks = deque()
+        self._scheduler = Scheduler()
+        # 任务 => (任务队列表中的记录 id, 指定的 route)
+        self._task_states = dict()
 
     @property
     def workers(self):
@@ -125,154 +187,271 @@ class Server:
 
     @property
     def tasks(self):
-        return list(self._tasks)
+        return self._scheduler.tasks
 
     def _create_workers(self):
         self._workers.clear()
         requests_per_minute = setting.get('worker.requests-per-minute', int, REQUESTS_PER_MINUTE)
+        concurrent_requests = setting.get('worker.concurrent-requests', int, CONCURRENT_REQUESTS)
         local_object_duration = setting.get('worker.local-object-duration', int, LOCAL_OBJECT_DURATION)
         broadcast_incremental_backup = setting.get('worker.broadcast-incremental-backup', bool, BROADCAST_INCREMENTAL_BACKUP)
         broadcast_active_duration = setting.get('worker.broadcast-active-duration', int, BROADCAST_ACTIVE_DURATION)
         image_local_cache = setting.get('worker.image-local-cache', bool, IMAGE_LOCAL_CACHE)
-        
-        self._worker_input = Queue()
+        http_cache = setting.get('worker.http-cache', bool, HTTP_CACHE)
+        proxies = setting.get('worker.proxies', 'json')
+        parse_processes = setting.get('worker.parse-processes', int, PARSE_PROCESSES)
+        if parse_processes <= 0:
+            parse_processes = max(1, (os.cpu_count() or 1) // (1 + len(proxies or [])))
+
         worker_args = {
             'debug': settings.get('debug'),
-            'queue_in': self._worker_input,
             'queue_out': self._worker_output,
             'requests_per_minute': requests_per_minute,
+            'rate_limiter': TokenBucket(requests_per_minute),
+            'concurrent_requests': concurrent_requests,
             'local_object_duration': local_object_duration,
             'broadcast_incremental_backup': broadcast_incremental_backup,
             'image_local_cache': image_local_cache,
             'broadcast_active_duration': broadcast_active_duration,
+            'http_cache': http_cache,
+            'parse_processes': parse_processes,
+            'cache_path': settings.get('cache'),
             'db_path': db.DATEBASE_PATH,
+            'db_pragmas': db.DATEBASE_PRAGMAS,
         }
-        worker = Worker(**worker_args)
+        # 每个工作进程使用自己的任务队列，由 Server 决定任务交给哪个工作进程
+        worker = Worker(queue_in=Queue(), db_writer=self._db_writer.client(), **worker_args)
         self._workers[worker.name] = worker
-        proxies = setting.get('worker.proxies', 'json')
         if not proxies:
             return
         for proxy in proxies:
             worker_args['proxy'] = proxy
-            worker = Worker(**worker_args)
+            worker = Worker(queue_in=Queue(), db_writer=self._db_writer.client(), **worker_args)
             self._workers[worker.name] = worker
 
-    def _launch_task(self):
-        try:
-            task = self._tasks.popleft()
-            self._worker_input.put(task)
-            self.application.broadcast(json.dumps({
-                'sender': 'logger',
-                'message': '开始执行"{0}"任务'.format(task),
-                'level': 'INFO',
-            }))
-        except IndexError:
-            pass
+    def _tables_written(self, tables):
+        """
+        写入线程提交后调用：任务还在运行时写入的行也要马上在列表中显示
+        """
+        self._ioloop.add_callback(invalidate_list_cache, tables)
 
-    @tornado.gen.coroutine
-    def _watch_worker(self):
+    def _save_task_state(self, task, **fields):
+        state_id, _ = self._task_states.get(task, (None, None))
+        if state_id is not None:
+            db.TaskState.update(**fields).where(db.TaskState.id == state_id).execute()
+
+    def _task_finished(self, worker_name, error=None):
         """
-        监控工作队列
+        记录任务结果，并清除任务写入过的表的列表缓存
+        """
+        worker = self._workers.get(worker_name)
+        if worker is None:
+            # 已经重启的工作进程
+            invalidate_list_cache()
+            return
+        task = worker.current_task
+        self._save_task_state(
+            task,
+            state=db.TaskState.FAILED if error else db.TaskState.DONE,
+            error=error,
+            finished_at=datetime.datetime.now()
+        )
+        self._task_states.pop(task, None)
+        tables = getattr(task, 'tables', None)
+        invalidate_list_cache([model._meta.table_name for model in tables] if tables else None)
+        worker.toggle_task()
+
+    def _launch_task(self, worker):
+        task = self._scheduler.pop(worker.proxy or DIRECT)
+        if task is None:
+            return False
+        worker.toggle_task(task)
+        self._save_task_state(task, state=db.TaskState.RUNNING, worker=worker.name, started_at=datetime.datetime.now())
+        worker.queue_in.put(task)
+        self.application.log_stream.append('开始执行"{0}"任务'.format(task), 'INFO')
+        return True
+
+    def _watch_worker(self, ioloop):
+        """
+        监控工作队列：后台线程阻塞等待工作进程的消息，把已到达的消息成批交给 IOLoop 处理
         """
         while True:
+            ret = self._worker_output.get()
+            if ret is None:
+                break
+            batch = [ret]
             try:
-                ret = self._worker_output.get_nowait()
-                if isinstance(ret, logging.LogRecord):
-                    logging.root.handle(ret)
-                    self.application.broadcast(json.dumps({
-                        'sender': 'logger',
-                        'message': ret.getMessage(),
-                        'level': ret.levelname,
-                    }))
-                elif isinstance(ret, Worker.ReturnReady):
-                    logging.info('"{0}" is ready'.format(ret.name))
-                    self.application.broadcast(json.dumps({
-                        'sender': 'worker',
-                        'src': ret.name,
-                        'event': 'ready',
-                    }))
-                    self._launch_task()
-                elif isinstance(ret, Worker.ReturnDone):
-                    logging.info('"{0}" has done'.format(ret.name))
-                    self._workers[ret.name].toggle_task()
-                    self.application.broadcast(json.dumps({
-                        'sender': 'worker',
-                        'src': ret.name,
-                        'event': 'done',
-                    }))
-                    self._launch_task()
-                elif isinstance(ret, Worker.ReturnWorking):
-                    logging.info('"{0}" is working for "{1}"'.format(ret.name, ret.task))
-                    self._workers[ret.name].toggle_task(ret.task)
-                    self.application.broadcast(json.dumps({
-                        'sender': 'worker',
-                        'src': ret.name,
-                        'event': 'working',
-                        'target': str(ret.task),
-                    }))
-                elif isinstance(ret, Worker.ReturnError):
-                    logging.error('"{0}" error: {1}\n{2}'.format(ret.name, ret.exception, ret.traceback))
-                    self._workers[ret.name].toggle_task()
-                    self.application.broadcast(json.dumps({
-                        'sender': 'worker',
-                        'src': ret.name,
-                        'event': 'error',
-                        'message': str(ret.exception),
-                    }))
-                    self._launch_task()
-                elif isinstance(ret, Worker.ReturnHeartbeat):
-                    logging.info('"{0}" heartbeat:{1}'.format(ret.name, ret.sequence))
+                while len(batch) < RESULT_BATCH_SIZE:
+                    batch.append(self._worker_output.get_nowait())
             except queues.Empty:
                 pass
-            # 每隔0.1秒读取一下队列
-            yield tornado.gen.sleep(0.1)
+            stopped = batch[-1] is None
+            if stopped:
+                batch.pop()
+            ioloop.add_callback(self._handle_results, batch)
+            if stopped:
+                break
+
+    def _stop_watching(self):
+        self._worker_output.put(None)
+        self._watcher.join()
+
+    def _handle_results(self, batch):
+        for ret in batch:
+            try:
+                self._handle_result(ret)
+            except Exception as e:
+                logging.exception('处理工作进程消息失败: {0}'.format(e))
+
+    def _handle_result(self, ret):
+        if isinstance(ret, logging.LogRecord):
+            logging.root.handle(ret)
+            self.application.log_stream.append(ret.getMessage(), ret.levelname)
+        elif isinstance(ret, Worker.ReturnReady):
+            logging.info('"{0}" is ready'.format(ret.name))
+            self.application.broadcast(json.dumps({
+                'sender': 'worker',
+                'src': ret.name,
+                'event': 'ready',
+            }))
+            self.push_task()
+        elif isinstance(ret, Worker.ReturnDone):
+            logging.info('"{0}" has done'.format(ret.name))
+            self._task_finished(ret.name)
+            self.application.broadcast(json.dumps({
+                'sender': 'worker',
+                'src': ret.name,
+                'event': 'done',
+            }))
+            self.push_task()
+        elif isinstance(ret, Worker.ReturnWorking):
+            logging.info('"{0}" is working for "{1}"'.format(ret.name, ret.task))
+            self.application.broadcast(json.dumps({
+                'sender': 'worker',
+                'src': ret.name,
+                'event': 'working',
+                'target': str(ret.task),
+            }))
+        elif isinstance(ret, Worker.ReturnError):
+            logging.error('"{0}" error: {1}\n{2}'.format(ret.name, ret.exception, ret.traceback))
+            self._task_finished(ret.name, str(ret.exception))
+            self.application.broadcast(json.dumps({
+                'sender': 'worker',
+                'src': ret.name,
+                'event': 'error',
+                'message': str(ret.exception),
+            }))
+            self.push_task()
+        elif isinstance(ret, Worker.ReturnHeartbeat):
+            logging.info('"{0}" heartbeat:{1}'.format(ret.name, ret.sequence))
 
-    def add_task(self, task, priority=False):
+    def add_task(self, task, priority=False, route=None):
         """
-        添加任务
+        添加任务。route 为代理地址时任务只交给使用该代理的工作进程，DIRECT 表示不使用代理的工作进程
         """
         if not isinstance(task, Task):
             raise RuntimeError('task 参数必须是 Task 对象')
-        if list(filter(lambda t: task.equals(t), self._tasks)):
+        if not self._scheduler.push(task, priority, route):
             logging.warn('添加任务 "{0}" 失败: 任务重复'.format(task))
             return False
-
-        if priority:
-            self._tasks.appendleft(task)
-        else:
-            self._tasks.append(task)
+        state = db.TaskState.create(
+            task_type=type(task)._name,
+            account=task.account_id,
+            priority=priority,
+            route=route
+        )
+        self._task_states[task] = (state.id, route)
         logging.info('添加任务 "{0}" 到任务队列'.format(task))
         return True
 
     def push_task(self):
         """
-        尝试推送任务到工作进程
+        把等待的任务分配给空闲的工作进程
         """
-        if len(self._tasks) > 0:
-            for worker in self._workers.values():
-                if worker.is_suspended():
-                    self._launch_task()
+        for worker in self._workers.values():
+            if len(self._scheduler) == 0:
+                break
+            if worker.is_running() and worker.is_suspended():
+                self._launch_task(worker)
 
 
     def start_workers(self):
         self._create_workers()
         for worker in self._workers.values():
             if worker.is_pending():
-                worker.start()
+                with self._db_writer.paused():
+                    worker.start()
 
     def stop_workers(self):
         """
-        停止工作进程
+        停止工作进程，正在执行的任务放回队列优先执行
         """
         for worker in self._workers.values():
             if worker.is_running():
                 worker.stop()
+                self._db_writer.release(worker.db_writer)
+            task = worker.current_task
+            if task is not None:
+                worker.toggle_task()
+                self._requeue_task(task)
+
+    def _requeue_task(self, task):
+        _, route = self._task_states.get(task, (None, None))
+        if self._scheduler.push(task, True, route):
+            self._save_task_state(task, state=db.TaskState.QUEUED, priority=True, worker=None, started_at=None)
+        else:
+            self._save_task_state(task, state=db.TaskState.FAILED, error='任务重复', finished_at=datetime.datetime.now())
+            self._task_states.pop(task, None)
+
+    def restore_tasks(self):
+        """
+        恢复上次运行时没有完成的任务，被中断的任务优先执行
+        """
+        now = datetime.datetime.now()
+        db.TaskState.delete().where(
+            db.TaskState.state.in_([db.TaskState.DONE, db.TaskState.FAILED]),
+            db.TaskState.finished_at < now - datetime.timedelta(seconds=TASK_HISTORY_DURATION)
+        ).execute()
+
+        restored_count = 0
+        states = db.TaskState.select().where(
+            db.TaskState.state.in_([db.TaskState.QUEUED, db.TaskState.RUNNING])
+        ).order_by(db.TaskState.id)
+        for state in states:
+            task_type = TASK_TYPES.get(state.task_type)
+            try:
+                account = state.account
+            except db.Account.DoesNotExist:
+                account = None
+            if task_type is None or account is None or account.is_invalid:
+                db.TaskState.update(
+                    state=db.TaskState.FAILED,
+                    error='无法恢复的任务',
+                    finished_at=now
+                ).where(db.TaskState.id == state.id).execute()
+                continue
+
+            task = task_type(account)
+            self._task_states[task] = (state.id, state.route)
+            if state.state == db.TaskState.RUNNING:
+                self._requeue_task(task)
+            elif not self._scheduler.push(task, state.priority, state.route):
+                self._save_task_state(task, state=db.TaskState.FAILED, error='任务重复', finished_at=now)
+                self._task_states.pop(task, None)
+                continue
+            restored_count += 1
+        if restored_count:
+            logging.info('恢复了{0}个未完成的任务'.format(restored_count))
 
     def run(self):
         ioloop = tornado.ioloop.IOLoop.current()
-        ioloop.add_callback(self._watch_worker)
+        self._watcher = threading.Thread(target=self._watch_worker, args=(ioloop,), name='worker-watcher', daemon=True)
+        self._watcher.start()
+        self._db_writer.start()
+        self.application.log_stream.start()
 
         try:
+            self.restore_tasks()
             logging.debug('start workers')
             self.start_workers()
             logging.debug('start ioloop')
@@ -280,6 +459,9 @@ class Server:
         except KeyboardInterrupt:
             logging.debug('stop workers')
             self.stop_workers()
+            self._db_writer.stop()
+            self._stop_watching()
+            self.application.log_stream.stop()
             logging.debug('stop ioloop')
             ioloop.stop()
             raise
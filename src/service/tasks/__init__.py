@@ -1,2 +1,3 @@
 # encoding: utf-8
-from .tasks import *
\ No newline at end of file
+from .tasks import *
+from .parsepool import ParsePool
\ No newline at end of file
@@ -5,4 +5,10 @@ class Forbidden(Exception):
     """
     登录会话或IP被屏蔽了
     """
-    pass
\ No newline at end of file
+    pass
+
+class FetchError(Exception):
+    """
+    页面抓取失败：重试次数用完或服务器返回错误
+    """
+    pass
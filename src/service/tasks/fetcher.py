@@ -0,0 +1,51 @@
+# encoding: utf-8
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Engine:
+    """
+    异步抓取引擎
+
+    在 asyncio 事件循环中把阻塞的请求调度到线程池执行，同时进行的请求数不超过 concurrency。
+    请求频率仍由令牌桶控制，并发只是让多个请求的网络等待时间互相重叠。
+    """
+
+    def __init__(self, concurrency=1):
+        self._concurrency = max(1, int(concurrency))
+        self._executor = None
+        self._loop = None
+
+    @property
+    def concurrency(self):
+        return self._concurrency
+
+    def map(self, func, items):
+        """
+        并发执行 func(item)，按 items 的顺序返回结果
+        """
+        items = list(items)
+        if self._concurrency == 1 or len(items) <= 1:
+            return [func(item) for item in items]
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self._concurrency)
+        return self._loop.run_until_complete(self._gather(func, items))
+
+    async def _gather(self, func, items):
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def run(item):
+            async with semaphore:
+                return await self._loop.run_in_executor(self._executor, func, item)
+
+        return await asyncio.gather(*[run(item) for item in items])
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
@@ -0,0 +1,97 @@
+# encoding: utf-8
+import hashlib
+import json
+import os
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class HttpCache:
+    """
+    磁盘上的 HTTP 响应缓存
+
+    只缓存带有 ETag 或 Last-Modified 的响应。再次请求同一个 URL 时带上
+    If-None-Match/If-Modified-Since，服务器返回 304 则直接用缓存的内容重建响应。
+    每个条目一个文件：第一行是 JSON 格式的元数据，其后是响应正文。
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    def _filename(self, url):
+        hash_str = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self._path, hash_str[0:2], hash_str[2:4], hash_str[4:])
+
+    def _load(self, url):
+        try:
+            with open(self._filename(url), 'rb') as f:
+                meta = json.loads(f.readline().decode())
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        if meta.get('url') != url:
+            return None, None
+        return meta, body
+
+    def validators(self, url):
+        """
+        返回条件请求需要附加的请求头
+        """
+        meta, _ = self._load(url)
+        headers = {}
+        if meta is None:
+            return headers
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, response):
+        """
+        保存带有验证信息的响应
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return False
+
+        meta = {
+            'url': url,
+            'final_url': response.url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'encoding': response.encoding,
+            'headers': dict(response.headers),
+        }
+        filename = self._filename(url)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        temp_filename = '{0}.{1}.{2}.tmp'.format(filename, os.getpid(), threading.get_ident())
+        with open(temp_filename, 'wb') as f:
+            f.write(json.dumps(meta).encode())
+            f.write(b'\n')
+            f.write(response.content)
+        os.replace(temp_filename, filename)
+        return True
+
+    def revive(self, url, not_modified):
+        """
+        用缓存内容重建 304 响应对应的完整响应，缓存缺失时返回 None
+        """
+        meta, body = self._load(url)
+        if meta is None:
+            return None
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response.url = meta['final_url']
+        response.encoding = meta['encoding']
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.request = not_modified.request
+        response.from_cache = True
+        return response
@@ -0,0 +1,92 @@
+# encoding: utf-8
+from collections import OrderedDict
+
+import db
+
+
+DEFAULT_CAPACITY = 2000
+
+
+class IdentityMap:
+    """
+    任务内的模型对象缓存
+
+    每个模型一个 LRU 表，对象按它的各个唯一字段（如 douban_id、unique_name）登记，
+    同一个任务中反复查询同一个用户或条目时不再访问数据库。对象入库后重新登记即可使旧的缓存失效。
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self._capacity = capacity
+        # model_class => OrderedDict((field_name, value) => obj)
+        self._entries = {}
+        # model_class => {id => [(field_name, value), ...]}
+        self._keys = {}
+
+    @staticmethod
+    def _key_fields(model_class):
+        return [field for field in model_class._meta.sorted_fields if field.unique]
+
+    @staticmethod
+    def _key(model_class, field_name, value):
+        return field_name, model_class._meta.fields[field_name].db_value(value)
+
+    def get(self, model_class, field_name, value):
+        """
+        按唯一字段取缓存的对象，没有则返回None
+        """
+        entries = self._entries.get(model_class)
+        if not entries:
+            return None
+        key = self._key(model_class, field_name, value)
+        obj = entries.get(key)
+        if obj is not None:
+            entries.move_to_end(key)
+        return obj
+
+    def put(self, obj):
+        """
+        登记对象，替换掉同一 id 原来登记的对象
+        """
+        if obj is None or not obj.id:
+            return obj
+        model_class = type(obj)
+        self.invalidate(model_class, obj.id)
+        entries = self._entries.setdefault(model_class, OrderedDict())
+        keys = [(field.name, field.db_value(obj.__data__.get(field.name))) for field in self._key_fields(model_class)]
+        for key in keys:
+            entries[key] = obj
+        self._keys.setdefault(model_class, {})[obj.id] = keys
+
+        while len(entries) > self._capacity:
+            _, evicted = entries.popitem(last=False)
+            self.invalidate(model_class, evicted.id)
+        return obj
+
+    def invalidate(self, model_class, obj_id):
+        """
+        移除指定 id 的对象
+        """
+        keys = self._keys.get(model_class, {}).pop(obj_id, None)
+        if not keys:
+            return
+        entries = self._entries[model_class]
+        for key in keys:
+            if key in entries and entries[key].id == obj_id:
+                del entries[key]
+
+    def warm(self, model_class, field_name, values):
+        """
+        用一条 IN 查询预先载入一批对象，已经缓存的跳过
+        """
+        field = model_class._meta.fields[field_name]
+        missing = list(set(
+            value for value in (field.db_value(value) for value in values if value is not None)
+            if self.get(model_class, field_name, value) is None
+        ))
+        for chunk in db.chunked(missing, db.SQLITE_MAX_VARIABLES):
+            for obj in model_class.select().where(field.in_(chunk)):
+                self.put(obj)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
@@ -0,0 +1,122 @@
+# encoding: utf-8
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from .exceptions import FetchError
+
+
+class ParsePool:
+    """
+    页面解析进程池
+
+    解析 HTML 占用 CPU，和抓取放在同一个线程时，解析期间不会发出新的请求。
+    响应正文交给独立的进程解析，工作进程只负责抓取和入库。
+    解析函数必须是 parsers 模块中的函数，参数和返回值都是普通的字符串、字典和列表。
+    processes 为 0 时在当前进程中直接解析。
+    """
+
+    def __init__(self, processes=0):
+        self._processes = max(0, int(processes))
+        self._executor = None
+
+    @property
+    def processes(self):
+        return self._processes
+
+    @property
+    def backlog(self):
+        """
+        预先抓取、等待解析的页面数
+        """
+        return max(2, self._processes * 2)
+
+    def submit(self, parse_page, *args):
+        """
+        提交解析，返回 Future
+        """
+        if self._processes == 0:
+            future = Future()
+            try:
+                future.set_result(parse_page(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._processes)
+        return self._executor.submit(parse_page, *args)
+
+    def map(self, parse_page, texts, *args):
+        """
+        并行解析多个页面，按顺序返回结果
+        """
+        futures = [self.submit(parse_page, text, *args) for text in texts]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class Prefetcher:
+    """
+    在后台线程中顺序抓取页面，把响应正文交给解析进程池
+
+    主线程按顺序取出解析结果并入库，同时后台线程继续抓取后面的页面，
+    最多领先 backlog 页。主线程停止迭代后后台线程不再发起新的请求。
+    """
+
+    _STOP_POLL_INTERVAL = 0.5
+
+    def __init__(self, fetch, parse_pool, parse_page):
+        self._fetch = fetch
+        self._parse_pool = parse_pool
+        self._parse_page = parse_page
+        self._results = queue.Queue(maxsize=parse_pool.backlog)
+        self._stopped = threading.Event()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._results.put(item, timeout=self._STOP_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, requests):
+        try:
+            for key, url in requests:
+                if self._stopped.is_set():
+                    return
+                response = self._fetch(url)
+                if not response:
+                    # 抓取失败不是列表的结尾，交给主线程抛出
+                    self._put(FetchError('抓取"{0}"失败'.format(url)))
+                    return
+                if not self._put((key, self._parse_pool.submit(self._parse_page, response.text))):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def __call__(self, requests):
+        """
+        requests 依次给出 (key, url)，返回 (key, 解析结果)。requests 用完时结束，抓取失败时抛出 FetchError
+        """
+        thread = threading.Thread(target=self._run, args=(requests,), name='prefetcher', daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = self._results.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                key, future = item
+                yield key, future.result()
+        finally:
+            self._stopped.set()
+            thread.join()
@@ -0,0 +1,603 @@
+# encoding: utf-8
+import re
+from html import escape
+
+import lxml.html
+from lxml.cssselect import CSSSelector
+from lxml.etree import tostring
+
+
+_BLOCK_TAGS = frozenset([
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'fieldset',
+    'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+    'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul',
+])
+
+# 每种页面的选择器在模块载入时编译一次。解析函数只接受 HTML 文本，返回由字典、列表组成的普通数据，
+# 不访问网络和数据库
+_RE_USERNAME = re.compile(r'http(?:s?)://www\.douban\.com/people/(.+)/')
+_RE_SUBJECT = re.compile(r'https://([a-z]+)\.douban\.com/subject/([0-9]+)/')
+_RE_LIKE_COUNT = re.compile(r'赞\((.*)\)')
+_RE_PEOPLE_COUNT = re.compile(r'(\d+)人')
+_RE_VIEWS_COUNT = re.compile(r'(\d+)人浏览')
+_RE_PHOTO_COMMENTS_COUNT = re.compile(r'(\d+)回应')
+_RE_PHOTO_VIEWS_COUNT = re.compile(r'(\d+)浏览')
+_RE_PHOTO_ID = re.compile(r'http(?:s?)://www\.douban\.com/photos/photo/(.+)/')
+_RE_ALBUM_UPDATED = re.compile(r'(\d+\-\d+\-\d+)(?:创建|更新)')
+
+
+def document(text):
+    """
+    解析 HTML 文本
+    """
+    return lxml.html.document_fromstring(text)
+
+
+def first(elements):
+    return elements[0] if elements else None
+
+
+def attr(element, name):
+    return element.get(name) if element is not None else None
+
+
+def has_class(element, class_name):
+    return class_name in (element.get('class') or '').split()
+
+
+def _extract_text(element, parts):
+    if not isinstance(element.tag, str):
+        # 注释和处理指令
+        return
+    is_block = element.tag in _BLOCK_TAGS
+    if is_block:
+        parts.append('\n')
+    if element.text:
+        parts.append(element.text)
+    for child in element:
+        _extract_text(child, parts)
+        if child.tail:
+            parts.append(child.tail)
+    if is_block:
+        parts.append('\n')
+
+
+def text(elements):
+    """
+    与 PyQuery.text() 一致：合并空白，块级元素之间换行，多个元素之间用空格连接
+    """
+    if elements is None:
+        return ''
+    if not isinstance(elements, list):
+        elements = [elements]
+    texts = []
+    for element in elements:
+        parts = []
+        _extract_text(element, parts)
+        lines = (' '.join(line.split()) for line in ''.join(parts).split('\n'))
+        texts.append('\n'.join(line for line in lines if line))
+    return ' '.join(texts)
+
+
+def inner_html(element):
+    """
+    与 PyQuery.html() 一致，元素不存在时返回 None
+    """
+    if element is None:
+        return None
+    return escape(element.text or '', quote=False) + ''.join(
+        tostring(child, encoding='unicode') for child in element
+    )
+
+
+def outer_html(element):
+    return tostring(element, encoding='unicode', with_tail=False)
+
+
+def username(link):
+    """
+    从用户主页链接中取出用户名
+    """
+    match = _RE_USERNAME.match(attr(link, 'href') or '')
+    return match[1] if match else None
+
+
+def _search(pattern, text):
+    match = pattern.search(text or '')
+    return match[1] if match else None
+
+
+class Paginator:
+    """
+    分页器
+    """
+
+    def __init__(self, selector):
+        self._this_page = CSSSelector(selector + ' .thispage')
+        self._next_link = CSSSelector(selector + '>.next>a')
+
+    def __call__(self, doc):
+        try:
+            total_pages = int(attr(first(self._this_page(doc)), 'data-total-page'))
+        except (TypeError, ValueError):
+            total_pages = None
+        return {
+            'total_pages': total_pages,
+            'next': attr(first(self._next_link(doc)), 'href'),
+        }
+
+
+# 列表页
+
+_LIST_NEXT = CSSSelector('#content .article>.paginator>.next>a')
+_NOTE_LIST_ITEMS = CSSSelector('#content .article>.note-container')
+_ALBUM_LIST_ITEMS = CSSSelector('#content .article>.wr>.albumlst')
+_ALBUM_LIST_MISC = CSSSelector('.albumlst_r>.pl')
+_ALBUM_LIST_LINK = CSSSelector('.album_photo')
+_ALBUM_LIST_COVER = CSSSelector('.album')
+_LIKE_LIST_ITEMS = CSSSelector('#content .article>.fav-list>li')
+_LIKE_AUTHOR_TAGS = CSSSelector('.author-tags>.tag-add')
+_LIKE_DELETE_LINK = CSSSelector('.gact.lnk-delete')
+_LIKE_TIME = CSSSelector('.status-item .time')
+_LIKE_ALBUM_COVER = CSSSelector('.status-item .block .content .album-photos img')
+
+
+def _list_page(doc, items):
+    return {
+        'items': items,
+        'next': attr(first(_LIST_NEXT(doc)), 'href'),
+    }
+
+
+def parse_note_list_page(html):
+    """
+    日记列表，返回日记地址
+    """
+    doc = document(html)
+    return _list_page(doc, [note_item.get('data-url') for note_item in _NOTE_LIST_ITEMS(doc)])
+
+
+def parse_photo_album_list_page(html):
+    """
+    相册列表，返回 (相册地址, 封面地址, 最后更新日期)
+    """
+    doc = document(html)
+    albums = []
+    for album_item in _ALBUM_LIST_ITEMS(doc):
+        albums.append((
+            attr(first(_ALBUM_LIST_LINK(album_item)), 'href'),
+            attr(first(_ALBUM_LIST_COVER(album_item)), 'src'),
+            _search(_RE_ALBUM_UPDATED, text(_ALBUM_LIST_MISC(album_item))),
+        ))
+    return _list_page(doc, albums)
+
+
+def parse_like_list_page(html):
+    """
+    喜欢列表
+    """
+    doc = document(html)
+    items = []
+    for item in _LIKE_LIST_ITEMS(doc):
+        author_tags = first(_LIKE_AUTHOR_TAGS(item))
+        douban_id = attr(author_tags, 'data-id')
+        if not douban_id:
+            # 喜欢的对象不存在了
+            continue
+        lnk_delete = first(_LIKE_DELETE_LINK(item))
+        items.append({
+            'douban_id': douban_id,
+            'target_type': attr(lnk_delete, 'data-tkind'),
+            'target_douban_id': attr(lnk_delete, 'data-tid'),
+            'created': text(_LIKE_TIME(item)),
+            'tags': attr(author_tags, 'data-tags'),
+            'url': attr(lnk_delete, 'href'),
+            'cover': attr(first(_LIKE_ALBUM_COVER(item)), 'src'),
+        })
+    return _list_page(doc, items)
+
+
+# 广播
+
+_STATUS_ITEMS = CSSSelector('.stream-items>.new-status.status-wrapper')
+_STATUS_USERS = CSSSelector('.stream-items [data-uid]')
+_STATUS_CREATED = CSSSelector('.actions>.created_at')
+_STATUS_LINKS = CSSSelector('.actions a')
+_STATUS_ITEM = CSSSelector('.status-item')
+_STATUS_BLOCKQUOTE = CSSSelector('blockquote')
+_STATUS_REPLY = CSSSelector('.actions>.new-reply')
+_STATUS_LIKE = CSSSelector('.actions>.like-count')
+_STATUS_RESHARED = CSSSelector('.actions>.reshared-count')
+_STATUS_REAL = CSSSelector('.status-real-wrapper')
+_STATUS_GROUP_PICS = CSSSelector('.attachments-saying.group-pics a.view-large')
+_STATUS_PICS = CSSSelector('.attachments-saying.attachments-pic img')
+
+
+def parse_status(status_div):
+    """
+    解析一条广播，返回 (广播, 被转播的广播)，广播已被删除时返回 (None, None)。
+    广播中的用户只给出 douban_user_id，由调用者关联
+    """
+    reshared_count = 0
+    like_count = 0
+    comments_count = 0
+    created_at = None
+    target_type = None
+    object_kind = None
+    object_id = None
+    reshared_detail = None
+    blockquote = None
+    douban_user_id = status_div.get('data-uid')
+    douban_id = status_div.get('data-sid')
+    is_saying = has_class(status_div, 'saying')
+    is_reshared = has_class(status_div, 'status-reshared-wrapper')
+
+    created_span = first(_STATUS_CREATED(status_div))
+    is_noreply = created_span is None
+    status_url = attr(first(_STATUS_LINKS(status_div)), 'href')
+
+    status_item = first(_STATUS_ITEM(status_div))
+    if status_item is not None:
+        target_type = status_item.get('data-target-type')
+        object_kind = status_item.get('data-object-kind')
+        object_id = status_item.get('data-object-id')
+        if not douban_user_id:
+            douban_user_id = status_item.get('data-uid')
+        blockquote = inner_html(first(_STATUS_BLOCKQUOTE(status_item)))
+
+    if not is_noreply:
+        created_at = created_span.get('title')
+        if status_item is not None:
+            comments_count = attr(first(_STATUS_REPLY(status_item)), 'data-count')
+            like_span = first(_STATUS_LIKE(status_item))
+            reshared_count = attr(first(_STATUS_RESHARED(status_item)), 'data-count')
+        else:
+            comments_count = None
+            like_span = None
+            reshared_count = None
+        like_count = attr(like_span, 'data-count')
+        if like_count is None:
+            try:
+                like_count = int(_RE_LIKE_COUNT.match(text(like_span).strip())[1])
+            except (TypeError, ValueError):
+                like_count = 0
+        if reshared_count is None:
+            reshared_count = 0
+
+    if not douban_id or douban_id == 'None':
+        # 原广播已被删除
+        return None, None
+
+    detail = {
+        'douban_id': douban_id,
+        'douban_user_id': douban_user_id,
+        'content': outer_html(status_div),
+        'created': created_at,
+        'is_reshared': is_reshared,
+        'is_saying': is_saying,
+        'is_noreply': is_noreply,
+        'reshared_count': reshared_count,
+        'like_count': like_count,
+        'comments_count': comments_count,
+        'status_url': status_url,
+        'target_type': target_type,
+        'object_kind': object_kind,
+        'object_id': object_id,
+        'blockquote': blockquote,
+    }
+
+    if is_reshared:
+        reshared_status_div = first(_STATUS_REAL(status_div))
+        if reshared_status_div is not None:
+            reshared_detail, _ = parse_status(reshared_status_div)
+        if reshared_detail:
+            detail['reshared_id'] = reshared_detail['douban_id']
+
+    if target_type == 'sns':
+        attachments = [{
+            'type': 'image',
+            'url': img_lnk.get('href'),
+        } for img_lnk in _STATUS_GROUP_PICS(status_div)]
+        attachments.extend({
+            'type': 'image',
+            'url': img.get('data-raw-src'),
+        } for img in _STATUS_PICS(status_div) if img.get('data-raw-src'))
+        if attachments:
+            detail['attachments'] = attachments
+
+    return detail, reshared_detail
+
+
+def parse_status_page(html):
+    """
+    广播列表的一页，返回该页的广播和出现的所有用户 id。页面上没有广播时 statuses 为 None
+    """
+    doc = document(html)
+    status_divs = _STATUS_ITEMS(doc)
+    if not status_divs:
+        return {'statuses': None, 'user_ids': []}
+    statuses = []
+    for status_div in status_divs:
+        status_detail, reshared_detail = parse_status(status_div)
+        if status_detail:
+            statuses.append((status_detail, reshared_detail))
+    return {
+        'statuses': statuses,
+        'user_ids': [item.get('data-uid') for item in _STATUS_USERS(doc)],
+    }
+
+
+_BROADCAST_COMMENT_ITEMS = CSSSelector('#comments>.comment-item')
+_BROADCAST_COMMENT_USER = CSSSelector('.pic>a')
+_BROADCAST_COMMENT_TEXT = CSSSelector('.content>p.text')
+_BROADCAST_COMMENT_CREATED = CSSSelector('.content>.author>.created_at')
+_COMMENTS_PAGINATOR = Paginator('#comments>.paginator')
+
+
+def parse_broadcast_comments_page(html):
+    """
+    广播回应的一页，回应的用户只给出 user_name
+    """
+    doc = document(html)
+    comments = []
+    for comment_item in _BROADCAST_COMMENT_ITEMS(doc):
+        comments.append({
+            'content': outer_html(comment_item),
+            'douban_id': comment_item.get('data-cid'),
+            'user_name': attr(first(_BROADCAST_COMMENT_USER(comment_item)), 'data-uid'),
+            'text': text(_BROADCAST_COMMENT_TEXT(comment_item)),
+            'created': text(_BROADCAST_COMMENT_CREATED(comment_item)),
+        })
+    return {
+        'comments': comments,
+        'paginator': _COMMENTS_PAGINATOR(doc),
+    }
+
+
+# 日记
+
+_NOTE_COMMENT_ITEMS = CSSSelector('#comments .comment-item')
+_NOTE_COMMENT_USER = CSSSelector('.pic>a')
+_NOTE_COMMENT_QUOTE_USER = CSSSelector('.content>.reply-quote>.pubdate>a')
+_NOTE_COMMENT_QUOTE_TEXT = CSSSelector('.content>.reply-quote>.all')
+_NOTE_COMMENT_TEXT = CSSSelector('.content>p')
+_NOTE_COMMENT_CREATED = CSSSelector('.content>.author>span')
+
+_NOTE_CONTAINER = CSSSelector('#content .article>.note-container')
+_NOTE_IMAGES = CSSSelector('.image-wrapper>img')
+_NOTE_SUBJECTS = CSSSelector('.subject-wrapper>a')
+_NOTE_VIEWS = CSSSelector('.note-footer-stat-pv')
+_NOTE_LIKE = CSSSelector('.sns-bar .action-react .react-num')
+_NOTE_REC = CSSSelector('.rec-sec .rec-num')
+_NOTE_AUTHOR = CSSSelector('.note-author')
+_NOTE_TITLE = CSSSelector('.note-header.note-header-container>h1')
+_NOTE_CREATED = CSSSelector('.note-header.note-header-container .pub-date')
+_NOTE_INTRODUCTION = CSSSelector('.introduction')
+_NOTE_CONTENT = CSSSelector('#link-report')
+
+_SITE_NOTE_CONTAINER = CSSSelector('#content .note-item')
+_SITE_NOTE_LIKE = CSSSelector('.sns-bar-fav .fav-num>a')
+_SITE_NOTE_REC = CSSSelector('.sns-bar-rec .rec-num')
+_SITE_NOTE_IMAGES = CSSSelector('#link-report img')
+_SITE_NOTE_TITLE = CSSSelector('.note-hd>h1')
+_SITE_NOTE_CREATED = CSSSelector('.datetime')
+_SITE_NOTE_SUMMARY = CSSSelector('.summary')
+
+
+def _note_comments(doc):
+    comments = []
+    for comment_item in _NOTE_COMMENT_ITEMS(doc):
+        quote_user_link = first(_NOTE_COMMENT_QUOTE_USER(comment_item))
+        if quote_user_link is not None:
+            blockquote = '{0}({1}):{2}'.format(
+                text(quote_user_link),
+                username(quote_user_link),
+                text(_NOTE_COMMENT_QUOTE_TEXT(comment_item))
+            )
+        else:
+            blockquote = None
+        comments.append({
+            'douban_id': comment_item.get('data-cid'),
+            'content': outer_html(comment_item),
+            'user_name': username(first(_NOTE_COMMENT_USER(comment_item))),
+            'text': text(_NOTE_COMMENT_TEXT(comment_item)),
+            'created': text(_NOTE_COMMENT_CREATED(comment_item)),
+            'quote': blockquote,
+        })
+    return comments
+
+
+def parse_note_comments_page(html):
+    """
+    日记回应的一页，回应的用户只给出 user_name
+    """
+    doc = document(html)
+    return {
+        'comments': _note_comments(doc),
+        'paginator': _COMMENTS_PAGINATOR(doc),
+    }
+
+
+def _scoped(selector, container):
+    return selector(container) if container is not None else []
+
+
+def parse_note_page(html, site=False):
+    """
+    日记页面，site 为 True 时是小站日记。返回日记、第一页回应和回应的分页器，
+    日记作者只给出 user_name，引用的条目在 subjects 中
+    """
+    doc = document(html)
+    attachments = []
+    subjects = []
+    if site:
+        note_container = first(_SITE_NOTE_CONTAINER(doc))
+        like_count_text = text(_scoped(_SITE_NOTE_LIKE, note_container))
+        rec_count_text = text(_scoped(_SITE_NOTE_REC, note_container))
+        for img in _scoped(_SITE_NOTE_IMAGES, note_container):
+            attachments.append({
+                'type': 'image',
+                'url': img.get('src'),
+            })
+        note = {
+            'is_original': True,
+            'title': text(_scoped(_SITE_NOTE_TITLE, note_container)),
+            'created': text(_scoped(_SITE_NOTE_CREATED, note_container)),
+            'introduction': text(_scoped(_SITE_NOTE_SUMMARY, note_container)),
+            'content': inner_html(first(_scoped(_NOTE_CONTENT, note_container))),
+            'attachments': attachments,
+            'subjects': subjects,
+            'views_count': None,
+            'like_count': like_count_text[:-1] if like_count_text else None,
+            'rec_count': rec_count_text[:-1] if rec_count_text else None,
+            'user_name': None,
+        }
+        return {
+            'note': note,
+            'comments': [],
+            'paginator': {'total_pages': None, 'next': None},
+        }
+
+    note_container = first(_NOTE_CONTAINER(doc))
+    for img in _scoped(_NOTE_IMAGES, note_container):
+        attachments.append({
+            'type': 'image',
+            'url': img.get('src'),
+        })
+    for subject_link in _scoped(_NOTE_SUBJECTS, note_container):
+        re_match = _RE_SUBJECT.match(subject_link.get('href') or '')
+        if re_match:
+            subjects.append({
+                'type': re_match[1],
+                'douban_id': re_match[2],
+            })
+
+    views_count = text(_scoped(_NOTE_VIEWS, note_container))[0:-3]
+    like_count = text(_scoped(_NOTE_LIKE, note_container))
+    rec_count = text(_scoped(_NOTE_REC, note_container))
+    note = {
+        'is_original': attr(note_container, 'data-is-original') == '1',
+        'title': text(_scoped(_NOTE_TITLE, note_container)),
+        'created': text(_scoped(_NOTE_CREATED, note_container)),
+        'introduction': text(_scoped(_NOTE_INTRODUCTION, note_container)),
+        'content': inner_html(first(_scoped(_NOTE_CONTENT, note_container))),
+        'attachments': attachments,
+        'subjects': subjects,
+        'views_count': views_count if views_count else None,
+        'like_count': like_count if like_count else None,
+        'rec_count': rec_count if rec_count else None,
+        'user_name': username(first(_scoped(_NOTE_AUTHOR, note_container))),
+    }
+    return {
+        'note': note,
+        'comments': _note_comments(doc),
+        'paginator': _COMMENTS_PAGINATOR(doc),
+    }
+
+
+# 相册
+
+_ALBUM_REC = CSSSelector('.rec>a')
+_ALBUM_OWNER = CSSSelector('#db-usr-profile>.pic>a')
+_ALBUM_LIKE = CSSSelector('.action-react .react-num')
+_ALBUM_REC_COUNT = CSSSelector('.rec-num')
+_ALBUM_VIEWS = CSSSelector('.album-edit>span:last-child')
+_ALBUM_DESC = CSSSelector('#content .article>.description')
+_ALBUM_PHOTOS = CSSSelector('.photolst>.photo_wrap')
+_ALBUM_PHOTO_LINK = CSSSelector('.photolst_photo')
+_ALBUM_PHOTO_IMG = CSSSelector('.photolst_photo>img')
+_ALBUM_PHOTO_STAT = CSSSelector('div[style="color:#999"]')
+_ALBUM_PAGINATOR = Paginator('#content .article>.paginator')
+
+_SITE_ALBUM_LIKE = CSSSelector('.fav-num>a')
+_SITE_ALBUM_INFO = CSSSelector('#content .main .album-info')
+_SITE_ALBUM_INFO_EXTRA = CSSSelector('.sns-bar-top, .wr')
+_SITE_ALBUM_PHOTOS = CSSSelector('#content .list-s>li>.photo-item')
+_SITE_ALBUM_PHOTO_LINK = CSSSelector('.album_photo')
+_SITE_ALBUM_PHOTO_IMG = CSSSelector('.album_photo>img')
+_SITE_ALBUM_PHOTO_DESC = CSSSelector('.desc>a')
+_SITE_ALBUM_PAGINATOR = Paginator('#content .bd>.paginator')
+
+
+def _album_photos(doc, site):
+    pictures = []
+    if site:
+        for photo_item in _SITE_ALBUM_PHOTOS(doc):
+            photo_link = first(_SITE_ALBUM_PHOTO_LINK(photo_item))
+            img_src = attr(first(_SITE_ALBUM_PHOTO_IMG(photo_item)), 'src').replace('/photo/thumb/public/', '/photo/l/public/', 1)
+            pictures.append({
+                'douban_id': photo_link.get('id')[1:],
+                'desc': photo_link.get('title'),
+                'url': photo_link.get('href'),
+                'picture': img_src,
+                'views_count': None,
+                'comments_count': _search(_RE_PHOTO_COMMENTS_COUNT, text(_SITE_ALBUM_PHOTO_DESC(photo_item))),
+            })
+    else:
+        for photo_item in _ALBUM_PHOTOS(doc):
+            photo_link = first(_ALBUM_PHOTO_LINK(photo_item))
+            img_src = attr(first(_ALBUM_PHOTO_IMG(photo_item)), 'src').replace('/photo/m/public/', '/photo/l/public/', 1)
+            comments_views_count_text = text(_ALBUM_PHOTO_STAT(photo_item))
+            photo_url = photo_link.get('href')
+            pictures.append({
+                'douban_id': _RE_PHOTO_ID.match(photo_url)[1],
+                'desc': photo_link.get('title'),
+                'url': photo_url,
+                'picture': img_src,
+                'views_count': _search(_RE_PHOTO_VIEWS_COUNT, comments_views_count_text),
+                'comments_count': _search(_RE_PHOTO_COMMENTS_COUNT, comments_views_count_text),
+            })
+    return pictures
+
+
+def parse_photo_album_page(html, site=False):
+    """
+    相册页面，site 为 True 时是小站相册。返回相册、第一页照片和照片的分页器，
+    相册作者只给出 user_name（小站相册为 None）
+    """
+    doc = document(html)
+    btn_rec = first(_ALBUM_REC(doc))
+    if site:
+        album_info_div = first(_SITE_ALBUM_INFO(doc))
+        if album_info_div is not None:
+            for extra in _SITE_ALBUM_INFO_EXTRA(album_info_div):
+                extra.drop_tree()
+        album = {
+            'douban_id': attr(btn_rec, 'data-object_id'),
+            'title': attr(btn_rec, 'data-name'),
+            'desc': text(album_info_div),
+            'user_name': None,
+            'views_count': None,
+            'like_count': _search(_RE_PEOPLE_COUNT, text(_SITE_ALBUM_LIKE(doc))),
+            'rec_count': _search(_RE_PEOPLE_COUNT, text(_ALBUM_REC_COUNT(doc))),
+        }
+        paginator = _SITE_ALBUM_PAGINATOR(doc)
+    else:
+        like_count = text(_ALBUM_LIKE(doc))
+        rec_count = text(_ALBUM_REC_COUNT(doc))
+        album = {
+            'douban_id': attr(btn_rec, 'data-object_id'),
+            'title': attr(btn_rec, 'data-name'),
+            'desc': text(_ALBUM_DESC(doc)),
+            'user_name': username(first(_ALBUM_OWNER(doc))),
+            'views_count': _search(_RE_VIEWS_COUNT, text(_ALBUM_VIEWS(doc))),
+            'like_count': like_count if like_count else None,
+            'rec_count': rec_count if rec_count else None,
+        }
+        paginator = _ALBUM_PAGINATOR(doc)
+    return {
+        'album': album,
+        'pictures': _album_photos(doc, site),
+        'paginator': paginator,
+    }
+
+
+def parse_photo_album_photos_page(html, site=False):
+    """
+    相册照片的后续页面
+    """
+    doc = document(html)
+    return {
+        'pictures': _album_photos(doc, site),
+        'paginator': (_SITE_ALBUM_PAGINATOR if site else _ALBUM_PAGINATOR)(doc),
+    }
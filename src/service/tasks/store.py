@@ -0,0 +1,115 @@
+# encoding: utf-8
+import hashlib
+import os
+import re
+import threading
+from time import time
+
+
+_BLOB_NAME = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{36}(\.[^/]*)?$')
+_HEX_DIR = re.compile(r'^[0-9a-f]{2}$')
+# 超过这个时间的文件才会被清理，以免删掉其他工作进程刚写入、还没来得及入库的文件
+GRACE_PERIOD = 60 * 60
+
+
+class AttachmentStore:
+    """
+    按内容寻址的附件存储
+
+    文件名由内容的 SHA1 决定（ab/cd/剩余部分+扩展名），写入时边下载边计算摘要，
+    相同内容不论来自哪个 URL 都只保存一份。
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @staticmethod
+    def is_blob_name(local_filename):
+        """
+        是否是按内容寻址的文件名，旧版本按 URL 命名的文件不是
+        """
+        return bool(_BLOB_NAME.match(local_filename))
+
+    def full_path(self, local_filename):
+        return os.path.join(self._path, local_filename)
+
+    def _commit(self, temp_filename, digest, file_ext):
+        local_filename = '{0}/{1}/{2}{3}'.format(digest[0:2], digest[2:4], digest[4:], file_ext)
+        full_path_filename = self.full_path(local_filename)
+        if os.path.exists(full_path_filename):
+            # 内容已经存在，丢弃重复的副本。刷新修改时间，避免刚被引用就被清理
+            os.remove(temp_filename)
+            os.utime(full_path_filename)
+        else:
+            os.makedirs(os.path.dirname(full_path_filename), exist_ok=True)
+            os.replace(temp_filename, full_path_filename)
+        return local_filename
+
+    def save(self, chunks, file_ext=''):
+        """
+        保存分块的内容，返回本地文件名
+        """
+        os.makedirs(self._path, exist_ok=True)
+        temp_filename = os.path.join(self._path, '{0}.{1}.tmp'.format(os.getpid(), threading.get_ident()))
+        sha1 = hashlib.sha1()
+        try:
+            with open(temp_filename, 'wb') as f:
+                for chunk in chunks:
+                    if chunk:
+                        sha1.update(chunk)
+                        f.write(chunk)
+            return self._commit(temp_filename, sha1.hexdigest(), file_ext)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def adopt(self, local_filename):
+        """
+        把旧版本按 URL 命名的文件移入按内容寻址的存储，返回新的本地文件名
+        """
+        full_path_filename = self.full_path(local_filename)
+        _, file_ext = os.path.splitext(local_filename)
+        sha1 = hashlib.sha1()
+        with open(full_path_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                sha1.update(chunk)
+        return self._commit(full_path_filename, sha1.hexdigest(), file_ext)
+
+    def collect_garbage(self, referenced):
+        """
+        删除没有被引用的文件，referenced 为仍被引用的本地文件名集合。
+        返回删除的文件数和释放的字节数
+        """
+        removed_count = 0
+        removed_bytes = 0
+        if not os.path.isdir(self._path):
+            return removed_count, removed_bytes
+
+        expired = time() - GRACE_PERIOD
+        for entry in os.listdir(self._path):
+            if entry.endswith('.tmp'):
+                # 异常退出时残留的临时文件
+                temp_filename = os.path.join(self._path, entry)
+                if os.path.getmtime(temp_filename) > expired:
+                    continue
+                removed_bytes += os.path.getsize(temp_filename)
+                os.remove(temp_filename)
+                removed_count += 1
+                continue
+            if not _HEX_DIR.match(entry):
+                continue
+            for sub_entry in os.listdir(os.path.join(self._path, entry)):
+                directory = os.path.join(self._path, entry, sub_entry)
+                if not _HEX_DIR.match(sub_entry) or not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    local_filename = '{0}/{1}/{2}'.format(entry, sub_entry, filename)
+                    if local_filename in referenced:
+                        continue
+                    full_path_filename = os.path.join(directory, filename)
+                    if os.path.getmtime(full_path_filename) > expired:
+                        continue
+                    removed_bytes += os.path.getsize(full_path_filename)
+                    os.remove(full_path_filename)
+                    removed_count += 1
+        return removed_count, removed_bytes
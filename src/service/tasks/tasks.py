@@ -1,30 +1,44 @@
 # encoding: utf-8
 import datetime
+import itertools
 import json
 import logging
 import re
 import os
-import hashlib
 from abc import abstractmethod
 from collections import OrderedDict
-from time import sleep, time
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlparse, parse_qsl, urlencode
 from http import cookies
 
 from pyquery import PyQuery
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import TooManyRedirects
 
 import db
+import fulltext
 from db import dbo
 from setting import settings
+from ratelimit import TokenBucket
 from .exceptions import *
+from .fetcher import Engine
+from .httpcache import HttpCache
+from .identitymap import IdentityMap
+from .parsepool import ParsePool, Prefetcher
+from . import parsers
+from .store import AttachmentStore
 
 
 DOUBAN_URL = 'https://www.douban.com/'
 REQUEST_TIMEOUT = 5
 REQUEST_RETRY_TIMES = 5
 FAKE_API_KEY = '04f1ddfc67bddc4a0ed599f5373994de'
+ATTACHMENT_BATCH_SIZE = 50
+# 超过这个时间的任务进度不再继续，重新开始
+CHECKPOINT_DURATION = 60 * 60 * 24 * 7
+# 时间轴序号：每次备份以开始时间为基数，向后每页、每条依次减小
+TIMELINE_SEQUENCE_STRIDE = 10 ** 9
+TIMELINE_PAGE_STRIDE = 1000
 
 # type: {music|book|movie}; status: {mark|doing|done}
 URL_INTERESTS_API = 'https://m.douban.com/rexxar/api/v2/user/{uid}/interests?type={type}&status={status}&start={{start}}&count=50&ck={ck}&for_mobile=1'
@@ -41,6 +55,8 @@ class Task:
     """
     _id = 1
     _name = '任务'
+    # 任务可能写入的表，任务结束后界面据此清除相关的列表缓存。同步帐号时会写入帐号和用户
+    _tables = (db.Account, db.User, db.Revision)
 
     def __init__(self, account):
         class_type = type(self)
@@ -53,6 +69,14 @@ class Task:
     def name(self):
         return self._name
 
+    @property
+    def account_id(self):
+        return self._account.id
+
+    @property
+    def tables(self):
+        return type(self)._tables
+
     def __str__(self):
         return self.name
 
@@ -62,14 +86,26 @@ class Task:
             'http': kwargs['proxy'],
             'https': kwargs['proxy'],
         } if 'proxy' in kwargs else None
-        requests_per_minute = kwargs['requests_per_minute']
-        self._min_request_interval = 60 / requests_per_minute
+        # 由 Server 创建的令牌桶在所有工作进程间共享，单独运行任务时使用本地令牌桶
+        rate_limiter = self.get_setting('rate_limiter')
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(kwargs['requests_per_minute'])
+        self._rate_limiter = rate_limiter
+        self._fetch_engine = Engine(self.get_setting('concurrent_requests', 1))
+        # 工作进程创建的解析进程池在任务之间共用，单独运行任务时在当前进程中解析
+        parse_pool = self.get_setting('parse_pool')
+        self._parse_pool = parse_pool if parse_pool is not None else ParsePool()
         self._local_object_duration = kwargs['local_object_duration']
         self._broadcast_incremental_backup = kwargs['broadcast_incremental_backup']
         self._image_local_cache = kwargs['image_local_cache']
         self._broadcast_active_duration = kwargs['broadcast_active_duration']
-        self._last_request_at = time()
+        self._cache_path = self.get_setting('cache_path', settings.get('cache'))
+        self._http_cache = HttpCache(os.path.join(self._cache_path, 'http')) if self.get_setting('http_cache', False) else None
+        self._identity_map = IdentityMap()
         session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self._fetch_engine.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
         session.headers.update({
             'Cookie': self._account.session,
             'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.105 Safari/537.36',
@@ -97,6 +133,7 @@ class Task:
         #    logging.debug(e)
         #    return False
         finally:
+            self._fetch_engine.close()
             session.close()
     
     def is_oject_expired(self, obj):
@@ -106,24 +143,139 @@ class Task:
     def get_setting(self, name, default=None):
         return self._settings.get(name, default)
 
+    def get_local_object(self, model_class, field_name, value):
+        """
+        按唯一字段取本地对象，优先使用任务内的缓存。不存在时抛出 DoesNotExist
+        """
+        obj = self._identity_map.get(model_class, field_name, value)
+        if obj is None:
+            obj = self._identity_map.put(model_class.get(model_class._meta.fields[field_name] == value))
+        return obj
+
+    def _checkpoint_where(self, name):
+        return (
+            (db.Checkpoint.task_type == type(self)._name) &
+            (db.Checkpoint.account == self._account.id) &
+            (db.Checkpoint.name == name)
+        )
+
+    def load_checkpoint(self, name):
+        """
+        读取任务上次中断时的进度，返回 (cursor, items)。没有进度或进度已过期时返回 (None, None)
+        """
+        try:
+            checkpoint = db.Checkpoint.get(self._checkpoint_where(name))
+        except db.Checkpoint.DoesNotExist:
+            return None, None
+        if (datetime.datetime.now() - checkpoint.updated_at).total_seconds() > CHECKPOINT_DURATION:
+            self.clear_checkpoint(name)
+            return None, None
+        items = json.loads(checkpoint.items) if checkpoint.items is not None else None
+        pages = db.CheckpointPage.select(db.CheckpointPage.items).where(
+            db.CheckpointPage.checkpoint == checkpoint.id
+        ).order_by(db.CheckpointPage.id).tuples()
+        for page_items, in pages:
+            items = (items or []) + json.loads(page_items)
+        return json.loads(checkpoint.cursor), items
+
+    def save_checkpoint(self, name, cursor, items=None, appended=None):
+        """
+        记录任务进度。items 为 None 时保留原来记录的列表，否则替换整个列表；
+        appended 是追加到列表末尾的一页项目，只写入这一页
+        """
+        row = {
+            'task_type': type(self)._name,
+            'account': self._account.id,
+            'name': name,
+            'cursor': json.dumps(cursor),
+            'updated_at': datetime.datetime.now(),
+        }
+        update = ['cursor', 'updated_at']
+        if items is not None:
+            row['items'] = json.dumps(items)
+            update.append('items')
+        with dbo.atomic():
+            checkpoint_id, = db.Checkpoint.bulk_upsert([row], key=('task_type', 'account', 'name'), update=update)
+            if items is not None:
+                db.CheckpointPage.delete().where(db.CheckpointPage.checkpoint == checkpoint_id).execute()
+            if appended:
+                db.CheckpointPage.insert(checkpoint=checkpoint_id, items=json.dumps(appended)).execute()
+
+    def clear_checkpoint(self, name):
+        with dbo.atomic():
+            db.CheckpointPage.delete().where(
+                db.CheckpointPage.checkpoint.in_(db.Checkpoint.select(db.Checkpoint.id).where(self._checkpoint_where(name)))
+            ).execute()
+            db.Checkpoint.delete().where(self._checkpoint_where(name)).execute()
+
+    def fetch_list_pages(self, name, url, parse_page, reverse=False):
+        """
+        逐页抓取列表，每一页的结果和下一页的地址都记入进度，中断后从记录的位置继续。
+        某一页抓取失败时抛出 FetchError，进度停在失败的这一页。
+        返回 (列表, 进度)，进度中的 done 为已经处理完的项目数
+        """
+        cursor, items = self.load_checkpoint(name)
+        if cursor is None:
+            cursor, items = {'url': url, 'done': 0}, []
+        elif cursor['url'] or cursor['done']:
+            logging.info('从上次中断的位置继续"{0}"'.format(name))
+        items = items or []
+        if cursor['url'] is None:
+            return items, cursor
+
+        while cursor['url']:
+            response = self.fetch_required_url_content(cursor['url'])
+            parsed = parse_page(response.text)
+            items.extend(parsed['items'])
+            cursor['url'] = parsed['next']
+            if cursor['url']:
+                self.save_checkpoint(name, cursor, appended=parsed['items'])
+
+        # 最后一页和整理好顺序的完整列表一起记录
+        if reverse:
+            items.reverse()
+        self.save_checkpoint(name, cursor, items)
+        return items, cursor
+
+    def iter_unfinished(self, name, items, cursor):
+        """
+        依次返回还没有处理的项目，每处理完一项记入进度
+        """
+        for index in range(cursor['done'], len(items)):
+            yield items[index]
+            cursor['done'] = index + 1
+            self.save_checkpoint(name, cursor)
+
     def fetch_url_content(self, url, base_url=DOUBAN_URL):
         url = urljoin(base_url, url)
 
         error_count = 0
+        conditional = self._http_cache is not None
         while error_count < REQUEST_RETRY_TIMES:
-            now = time()
-            remaining = self._min_request_interval + self._last_request_at - now
-            if remaining > 0:
-                sleep(remaining)
-            self._last_request_at = now
+            self._rate_limiter.acquire(url)
 
             try:
                 logging.info('fetch URL {0}'.format(url))
-                response = self._request_session.get(url, proxies=self._proxy, timeout=REQUEST_TIMEOUT)
+                headers = self._http_cache.validators(url) if conditional else None
+                response = self._request_session.get(url, headers=headers, proxies=self._proxy, timeout=REQUEST_TIMEOUT)
+                if response.status_code == 304 and conditional:
+                    cached_response = self._http_cache.revive(url, response)
+                    if cached_response is not None:
+                        logging.debug('URL not modified: {0}'.format(url))
+                        return cached_response
+                    # 缓存文件已经丢失，重新发起不带条件的请求
+                    conditional = False
+                    continue
+                response.from_cache = False
                 response.raise_for_status()
                 if response.history and response.url.startswith('https://www.douban.com/accounts/login'):
                     response.status_code = 403
                     raise requests.exceptions.HTTPError()
+                if self._http_cache is not None:
+                    try:
+                        self._http_cache.store(url, response)
+                    except OSError as e:
+                        logging.warn('cache URL "{0}" error: {1}'.format(url, e))
                 return response
             except requests.exceptions.HTTPError as e:
                 if response.status_code == 403:
@@ -141,61 +293,179 @@ class Task:
 
         logging.error('fetch URL "{0}" error: retries exceeded'.format(url))
 
-    @dbo.atomic()
-    def fetch_attachment(self):
+    def fetch_required_url_content(self, url, base_url=DOUBAN_URL):
         """
-        将附件下载到本地
+        同 fetch_url_content，但抓取失败时抛出 FetchError。用于列表的分页等不能跳过的页面，
+        以免把抓取失败当成列表已经结束
         """
-        def prepare_file(url, retries):
-            _, file_ext = os.path.splitext(url)
-            hash_str = hashlib.md5('{0}|{1}'.format(retries, url).encode()).hexdigest()
-            file_path = '{0}/{1}'.format(hash_str[0:2], hash_str[2:4])
+        response = self.fetch_url_content(url, base_url)
+        if not response:
+            raise FetchError('抓取"{0}"失败'.format(urljoin(base_url, url)))
+        return response
 
-            local_filename = '{0}/{1}'.format(file_path, hash_str[4:] + file_ext)
-            cache_path = settings.get('cache')
-            directory = '{0}/{1}'.format(cache_path, file_path)
-            full_path_filename = '{0}/{1}'.format(cache_path, local_filename)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+    def get_unmodified(self, model_class, douban_id):
+        """
+        响应来自缓存（服务器返回304）说明内容没有变化，跳过解析和入库，
+        只刷新本地对象的抓取时间。本地没有该对象则返回None
+        """
+        try:
+            obj = self.get_local_object(model_class, 'douban_id', douban_id)
+        except model_class.DoesNotExist:
+            return None
+        now = datetime.datetime.now()
+        model_class.update(updated_at=now).where(model_class.id == obj.id).execute()
+        obj.updated_at = now
+        return obj
 
-            return full_path_filename, local_filename
+    def fetch_url_contents(self, urls, base_url=DOUBAN_URL):
+        """
+        并发抓取多个URL，按顺序返回结果
+        """
+        return self._fetch_engine.map(lambda url: self.fetch_url_content(url, base_url), urls)
 
-        try:
-            attachment = db.Attachment.get(db.Attachment.local == None)
-        except db.Attachment.DoesNotExist:
-            return False
+    def fetch_pages(self, url, parsed, parse_page):
+        """
+        依次返回分页内容每一页的解析结果，parsed 为已经解析的第一页，parse_page 解析其余页面。
+        如果分页器给出了总页数，剩余页面将并发抓取，否则顺着“后页”链接逐页抓取。
+        任何一页抓取失败都抛出 FetchError，不返回不完整的结果
+        """
+        yield parsed
+        page_urls = self._expand_paginator(url, parsed['paginator'])
+        if page_urls is not None:
+            texts = []
+            for page_url, response in zip(page_urls, self.fetch_url_contents(page_urls)):
+                if not response:
+                    raise FetchError('抓取"{0}"失败'.format(urljoin(DOUBAN_URL, page_url)))
+                texts.append(response.text)
+            yield from self._parse_pool.map(parse_page, texts)
+            return
 
-        max_retries = 100
-        retries = 0
-        while retries < max_retries:
-            url = attachment.url
-            filename, local_filename = prepare_file(url, retries)
-            try:
-                with open(filename, 'xb') as f:
-                    logging.info('download url: {0}'.format(url))
-                    response = requests.get(url)
-                    for chunk in response.iter_content(chunk_size=1024): 
-                        if chunk:
-                            f.write(chunk)
-            except FileExistsError:
-                pass
+        while True:
+            next_link = parsed['paginator']['next']
+            if not next_link:
+                return
+            url = urljoin(url, next_link)
+            response = self.fetch_required_url_content(url)
+            parsed = parse_page(response.text)
+            yield parsed
+
+    def _expand_paginator(self, url, paginator):
+        """
+        根据第一页的分页器推算出剩余所有页面的URL，无法推算则返回None
+        """
+        total_pages = paginator['total_pages']
+        next_link = paginator['next']
+        if total_pages is None or not next_link:
+            return None
 
-            break
+        current_query = dict(parse_qsl(urlparse(url).query))
+        next_url = urlparse(urljoin(url, next_link))
+        next_query = parse_qsl(next_url.query)
+        for index, (name, value) in enumerate(next_query):
+            if value.isdigit() and current_query.get(name, '0') == '0' and value != '0':
+                step = int(value)
+                break
+        else:
+            return None
 
-        if retries == max_retries:
-            logging.warn('创建缓存文件失败')
-            return False
+        page_urls = []
+        for page in range(2, total_pages + 1):
+            next_query[index] = (name, str(step * (page - 1)))
+            page_urls.append(next_url._replace(query=urlencode(next_query)).geturl())
+        return page_urls
 
+    def download_attachment(self, attachment):
+        """
+        下载单个附件到按内容寻址的存储中，返回本地文件名，失败返回None
+        """
+        url = attachment.url
+        _, file_ext = os.path.splitext(urlparse(url).path)
+        self._rate_limiter.acquire(url)
         try:
-            db.Attachment.update(local=local_filename).where(
-                db.Attachment.id == attachment.id,
+            logging.info('download url: {0}'.format(url))
+            response = self._download_session.get(url, proxies=self._proxy, timeout=REQUEST_TIMEOUT, stream=True)
+            response.raise_for_status()
+            return self._attachment_store.save(response.iter_content(chunk_size=8192), file_ext)
+        except (requests.exceptions.RequestException, OSError) as e:
+            logging.warn('download url "{0}" error: {1}'.format(url, e))
+            return None
+
+    @dbo.atomic()
+    def save_attachment_files(self, downloaded):
+        """
+        批量写回附件的本地文件名，并更新共用这些文件的附件的引用计数
+        """
+        if not downloaded:
+            return
+        try:
+            db.Attachment.update(
+                local=db.Case(db.Attachment.id, downloaded)
+            ).where(
+                db.Attachment.id.in_([attachment_id for attachment_id, _ in downloaded]),
                 db.Attachment.local == None
             ).execute()
         except db.IntegrityError:
-            pass
+            for attachment_id, local_filename in downloaded:
+                try:
+                    db.Attachment.update(local=local_filename).where(
+                        db.Attachment.id == attachment_id,
+                        db.Attachment.local == None
+                    ).execute()
+                except db.IntegrityError:
+                    pass
+        self.update_attachment_ref_count(list(set(local_filename for _, local_filename in downloaded)))
+
+    def update_attachment_ref_count(self, local_filenames):
+        for chunk in db.chunked(local_filenames, db.SQLITE_MAX_VARIABLES):
+            db.dbo.execute_sql(
+                'UPDATE attachment SET ref_count = ('
+                'SELECT COUNT(*) FROM attachment AS shared WHERE shared.local = attachment.local'
+                ') WHERE local IN ({0})'.format(', '.join(['?'] * len(chunk))),
+                chunk
+            )
+
+    def download_attachments(self):
+        """
+        将附件下载到本地
 
-        return local_filename
+        每次认领一批未下载的附件，通过连接池并发下载，全部完成后在一个事务中批量写回，
+        网络请求期间不占用数据库事务。返回成功下载的附件数
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self._fetch_engine.concurrency)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'User-Agent': self._request_session.headers['User-Agent'],
+            'Referer': 'https://www.douban.com/',
+        })
+        self._download_session = session
+        self._attachment_store = AttachmentStore(self._cache_path)
+
+        downloaded_count = 0
+        last_id = 0
+        try:
+            while True:
+                attachments = list(db.Attachment.select().where(
+                    db.Attachment.local == None,
+                    db.Attachment.id > last_id
+                ).order_by(db.Attachment.id).limit(ATTACHMENT_BATCH_SIZE))
+                if not attachments:
+                    break
+                last_id = attachments[-1].id
+
+                local_filenames = self._fetch_engine.map(self.download_attachment, attachments)
+                downloaded = [
+                    (attachment.id, local_filename)
+                    for attachment, local_filename in zip(attachments, local_filenames)
+                    if local_filename
+                ]
+                self.save_attachment_files(downloaded)
+                downloaded_count += len(downloaded)
+        finally:
+            session.close()
 
+        return downloaded_count
 
     @property
     def account(self):
@@ -224,17 +494,9 @@ class Task:
         del detail['id']
         del detail['uid']    
 
-        try:
-            user = db.User.safe_create(**detail)
-            logging.debug('create user: ' + user.unique_name)
-        except db.IntegrityError:
-            user = db.User.get(db.User.douban_id == douban_id)
-            
-            if not user.equals(detail):
-                db.UserHistorical.clone(user)
-                detail['version'] = db.User.version + 1
-                db.User.safe_update(**detail).where(db.User.id == user.id).execute()
-        return user
+        user_id, = db.User.bulk_upsert([detail], revisions=True)
+        fulltext.index('user', [user_id])
+        return self._identity_map.put(db.User.get_by_id(user_id))
 
     @dbo.atomic()
     def save_movie(self, detail, douban_id):
@@ -243,17 +505,9 @@ class Task:
         detail['updated_at'] = datetime.datetime.now()
         del detail['id']
 
-        try:
-            movie = db.Movie.safe_create(**detail)
-            logging.debug('create movie: ' + movie.title)
-        except db.IntegrityError:
-            movie = db.Movie.get(db.Movie.douban_id == douban_id)
-            
-            if not movie.equals(detail):
-                db.MovieHistorical.clone(movie)
-                detail['version'] = db.Movie.version + 1
-                db.Movie.safe_update(**detail).where(db.Movie.id == movie.id).execute()
-        return movie
+        movie_id, = db.Movie.bulk_upsert([detail], revisions=True)
+        fulltext.index('movie', [movie_id])
+        return self._identity_map.put(db.Movie.get_by_id(movie_id))
 
     @dbo.atomic()
     def save_book(self, detail):
@@ -263,17 +517,9 @@ class Task:
         detail['updated_at'] = datetime.datetime.now()
         del detail['id']
 
-        try:
-            book = db.Book.safe_create(**detail)
-            logging.debug('create book: ' + book.title)
-        except db.IntegrityError:
-            book = db.Book.get(db.Book.douban_id == douban_id)
-            
-            if not book.equals(detail):
-                db.BookHistorical.clone(book)
-                detail['version'] = db.Book.version + 1
-                db.Book.safe_update(**detail).where(db.Book.id == book.id).execute()
-        return book
+        book_id, = db.Book.bulk_upsert([detail], revisions=True)
+        fulltext.index('book', [book_id])
+        return self._identity_map.put(db.Book.get_by_id(book_id))
 
     @dbo.atomic()
     def save_music(self, detail):
@@ -283,24 +529,16 @@ class Task:
         detail['updated_at'] = datetime.datetime.now()
         del detail['id']
 
-        try:
-            music = db.Music.safe_create(**detail)
-            logging.debug('create music: ' + music.title)
-        except db.IntegrityError:
-            music = db.Music.get(db.Music.douban_id == douban_id)
-            
-            if not music.equals(detail):
-                db.MusicHistorical.clone(music)
-                detail['version'] = db.Music.version + 1
-                db.Music.safe_update(**detail).where(db.Music.id == music.id).execute()
-        return music
+        music_id, = db.Music.bulk_upsert([detail], revisions=True)
+        fulltext.index('music', [music_id])
+        return self._identity_map.put(db.Music.get_by_id(music_id))
 
     def fetch_user(self, name):
         """
         尝试从本地获取用户信息，如果没有则从网上抓取
         """
         try:
-            user = db.User.get(db.User.unique_name == name)
+            user = self.get_local_object(db.User, 'unique_name', name)
             if self.is_oject_expired(user) or user.is_anonymous():
                 raise db.User.DoesNotExist()
         except db.User.DoesNotExist:
@@ -313,7 +551,7 @@ class Task:
         尝试从本地获取用户信息，如果没有则从网上抓取
         """
         try:
-            user = db.User.get(db.User.douban_id == douban_id)
+            user = self.get_local_object(db.User, 'douban_id', douban_id)
             if self.is_oject_expired(user):
                 raise db.User.DoesNotExist()
         except db.User.DoesNotExist:
@@ -331,6 +569,10 @@ class Task:
             return db.User.get_anonymous()
 
         detail = json.loads(response.text)
+        if response.from_cache:
+            user = self.get_unmodified(db.User, detail['id'])
+            if user:
+                return user
         return self.save_user(detail)
 
     def fetch_movie(self, douban_id):
@@ -338,7 +580,7 @@ class Task:
         尝试从本地获取电影，如果没有则从网上抓取
         """
         try:
-            movie = db.Movie.get(db.Movie.douban_id == douban_id)
+            movie = self.get_local_object(db.Movie, 'douban_id', douban_id)
             if self.is_oject_expired(movie):
                 raise db.Movie.DoesNotExist()
         except db.Movie.DoesNotExist:
@@ -355,6 +597,11 @@ class Task:
         if not response:
             return None
 
+        if response.from_cache:
+            movie = self.get_unmodified(db.Movie, douban_id)
+            if movie:
+                return movie
+
         detail = json.loads(response.text)
         return self.save_movie(detail, douban_id)
 
@@ -363,7 +610,7 @@ class Task:
         尝试从本地获取书，如果没有则从网上抓取
         """
         try:
-            book = db.Book.get(db.Book.douban_id == douban_id)
+            book = self.get_local_object(db.Book, 'douban_id', douban_id)
             if self.is_oject_expired(book):
                 raise db.Book.DoesNotExist()
         except db.Book.DoesNotExist:
@@ -380,6 +627,11 @@ class Task:
         if not response:
             return None
 
+        if response.from_cache:
+            book = self.get_unmodified(db.Book, id)
+            if book:
+                return book
+
         detail = json.loads(response.text)
         return self.save_book(detail)
 
@@ -388,7 +640,7 @@ class Task:
         尝试从本地获取音乐，如果没有则从网上抓取
         """
         try:
-            music = db.Music.get(db.Music.douban_id == douban_id)
+            music = self.get_local_object(db.Music, 'douban_id', douban_id)
             if self.is_oject_expired(music):
                 raise db.Music.DoesNotExist()
         except db.Music.DoesNotExist:
@@ -405,6 +657,11 @@ class Task:
         if not response:
             return None
 
+        if response.from_cache:
+            music = self.get_unmodified(db.Music, id)
+            if music:
+                return music
+
         detail = json.loads(response.text)
         return self.save_music(detail)
 
@@ -419,7 +676,11 @@ class Task:
             account.save()
         return account
 
-    def fetch_interests(self, media_type, status):
+    def fetch_interests(self, media_type, status, parallel=True):
+        """
+        获取书影音标记列表。第一页返回总数后，剩余页面的偏移量都是已知的，
+        parallel 为真时剩余页面并发抓取，结果仍按偏移量顺序合并
+        """
         interests_list = []
         url = URL_INTERESTS_API.format(
             status=status,
@@ -434,8 +695,12 @@ class Task:
         total = result['total']
         interests_list.extend(result['interests'])
 
-        for start in range(50, total, 50):
-            response = self.fetch_url_content(url.format(start=start))
+        page_urls = [url.format(start=start) for start in range(50, total, 50)]
+        if parallel:
+            responses = self.fetch_url_contents(page_urls)
+        else:
+            responses = map(self.fetch_url_content, page_urls)
+        for response in responses:
             if not response:
                 return interests_list
             result = json.loads(response.text)
@@ -443,83 +708,43 @@ class Task:
 
         return interests_list
 
-    def fetch_note_comments(self, url, dom, douban_id):
+    def fetch_note_comments(self, url, parsed, douban_id):
+        """
+        抓取日记的全部回应，parsed 为已经解析的日记页面
+        """
         comments = []
-        while True:
-            comment_items = dom('#comments .comment-item')
-            for comment_item in comment_items:
-                item_div = PyQuery(comment_item)
-                quote_user_link = item_div('.content>.reply-quote>.pubdate>a')
-                if quote_user_link:
-                    quote_user_name = quote_user_link.text()
-                    quote_user_id = _strip_username(quote_user_link)
-                    quote_text = item_div('.content>.reply-quote>.all').text()
-                    blockquote = '{0}({1}):{2}'.format(quote_user_name, quote_user_id, quote_text)
-                else:
-                    blockquote = None
-                comments.append({
-                    'douban_id': item_div.attr('data-cid'),
-                    'content': item_div.outer_html(),
-                    'target_type': 'note',
-                    'target_douban_id': douban_id,
-                    'user': self.fetch_user(_strip_username(item_div('.pic>a'))),
-                    'text': item_div('.content>p').text(),
-                    'created': item_div('.content>.author>span').text(),
-                    'quote': blockquote,
-                })
-            next_page = dom('#comments>.paginator>.next>a')
-            if next_page:
-                url = next_page.attr('href')
-            else:
-                break
-            response = self.fetch_url_content(url)
-            if not response:
-                return comments
-            dom = PyQuery(response.text)
+        for parsed in self.fetch_pages(url, parsed, parsers.parse_note_comments_page):
+            self._identity_map.warm(db.User, 'unique_name', [comment['user_name'] for comment in parsed['comments']])
+            for comment in parsed['comments']:
+                comment['target_type'] = 'note'
+                comment['target_douban_id'] = douban_id
+                comment['user'] = self.fetch_user(comment.pop('user_name'))
+                comments.append(comment)
         return comments
 
-
-    @dbo.atomic()
     def save_attachments(self, attachments):
-        attachment_objects = []
-        for attachment in attachments:
-            try:
-                attachment_object = db.Attachment.safe_create(**attachment)
-            except db.IntegrityError:
-                attachment_object = db.Attachment.get(db.Attachment.url == attachment['url'])
-            attachment_objects.append(attachment_object)
-        return attachment_objects
+        """
+        附件入库，已存在的附件保持不变，返回附件 id 列表
+        """
+        return db.Attachment.bulk_upsert(attachments, key='url', update=[])
 
-    @dbo.atomic()
     def save_note(self, detail):
-        douban_id = detail['douban_id']
         detail['user'] = self.fetch_user(detail['user']) if detail['user'] else db.User.get_anonymous()
         detail['version'] = 1
-        try:
-            note = db.Note.safe_create(**detail)
-            logging.debug('create note: ' + note.title)
-        except db.IntegrityError:
-            note = db.Note.get(db.Note.douban_id == douban_id)            
-            if not note.equals(detail):
-                db.NoteHistorical.clone(note)
-                detail['version'] = db.Note.version + 1
-                db.Note.safe_update(**detail).where(db.Note.id == note.id).execute()
-        return note
+        note_id, = db.Note.bulk_upsert([detail], revisions=True)
+        fulltext.index('note', [note_id])
+        return self._identity_map.put(db.Note.get_by_id(note_id))
 
-    @dbo.atomic()
     def save_note_comments(self, comments):
-        for detail in comments:
-            try:
-                db.Comment.safe_create(**detail)
-            except db.IntegrityError:
-                pass
+        comment_ids = db.Comment.bulk_upsert(comments, key=('target_type', 'target_douban_id', 'douban_id'), update=[])
+        fulltext.index('comment', comment_ids)
 
     def fetch_note(self, douban_id):
         """
         尝试从本地获取日记，如果没有则从网上抓取
         """
         try:
-            note = db.Note.get(db.Note.douban_id == douban_id)
+            note = self.get_local_object(db.Note, 'douban_id', douban_id)
             if self.is_oject_expired(note):
                 raise db.Note.DoesNotExist()
         except db.Note.DoesNotExist:
@@ -532,125 +757,57 @@ class Task:
         response = self.fetch_url_content(url)
         if not response:
             return None, [], []
-        dom = PyQuery(response.text)
-        attachments = []
-        subjects = []
         note_douban_id = re.match(r'https://www\.douban\.com/note/(\d+)/', url)[1]
-
-        parsed_url = urlparse(response.url)
-        if parsed_url.netloc == 'site.douban.com':
-            # 小站日记
-            note_container = dom('#content .note-item')
-            like_count_text = note_container('.sns-bar-fav .fav-num>a').text()
-            rec_count_text = note_container('.sns-bar-rec .rec-num').text()
-            #user_id = dom('body').attr('id')
-            comments = []
-            for img in note_container('#link-report img'):
-                attachments.append({
-                    'type': 'image',
-                    'url': PyQuery(img).attr('src'),
-                })
-            detail = {
-                'url': response.url,
-                'is_original': True,
-                'douban_id': note_douban_id,
-                'title': note_container('.note-hd>h1').text(),
-                'created': note_container('.datetime').text(),
-                'introduction': note_container('.summary').text(),
-                'content': note_container('#link-report').html(),
-                'attachments': attachments,
-                'subjects': subjects,
-                'views_count': None,
-                'like_count': like_count_text[:-1] if like_count_text else None,
-                'rec_count': rec_count_text[:-1] if rec_count_text else None,
-                'comments_count': len(comments),
-                'user': None,
-            }
-        else:
-            note_container = dom('#content .article>.note-container')
-            for img in note_container('.image-wrapper>img'):
-                attachments.append({
-                    'type': 'image',
-                    'url': PyQuery(img).attr('src'),
-                })
-            for subject_link in note_container('.subject-wrapper>a'):
-                subject_url = PyQuery(subject_link).attr('href')
-                re_match = re.match(r'https://([a-z]+)\.douban\.com/subject/([0-9]+)/', subject_url)
-                subject_type = re_match[1]
-                subject_id = re_match[2]
-                subjects.append({
-                    'type': subject_type,
-                    'douban_id': subject_id,
-                })
-                if subject_type == 'music':
-                    self.fetch_music(subject_id)
-                elif subject_type == 'movie':
-                    self.fetch_movie(subject_id)
-                elif subject_type == 'book':
-                    self.fetch_book(subject_id)
-
-            #note_douban_id = note_container.attr('id')[5:]
-            comments = self.fetch_note_comments(url, dom, note_douban_id)
-
-            views_count = note_container('.note-footer-stat-pv').text()[0:-3]
-            like_count = note_container('.sns-bar .action-react .react-num').text()
-            rec_count = note_container('.rec-sec .rec-num').text()
-            user_id = _strip_username(note_container('.note-author'))
-            detail = {
-                'url': url,
-                'is_original': note_container.attr('data-is-original') == '1',
-                'douban_id': note_douban_id,
-                'title': note_container('.note-header.note-header-container>h1').text(),
-                'created': note_container('.note-header.note-header-container .pub-date').text(),
-                'introduction': note_container('.introduction').text(),
-                'content': note_container('#link-report').html(),
-                'attachments': attachments,
-                'subjects': subjects,
-                'views_count': views_count if views_count else None,
-                'like_count': like_count if like_count else None,
-                'rec_count': rec_count if rec_count else None,
-                'comments_count': len(comments),
-                'user': user_id,
-            }
+        if response.from_cache:
+            note = self.get_unmodified(db.Note, note_douban_id)
+            if note:
+                return note, None, []
+        site = urlparse(response.url).netloc == 'site.douban.com'
+        parsed = parsers.parse_note_page(response.text, site)
+        detail = parsed['note']
+        attachments = detail['attachments']
+        for subject in detail['subjects']:
+            if subject['type'] == 'music':
+                self.fetch_music(subject['douban_id'])
+            elif subject['type'] == 'movie':
+                self.fetch_movie(subject['douban_id'])
+            elif subject['type'] == 'book':
+                self.fetch_book(subject['douban_id'])
+
+        # 小站日记不抓取回应
+        comments = [] if site else self.fetch_note_comments(url, parsed, note_douban_id)
+        detail['url'] = response.url if site else url
+        detail['douban_id'] = note_douban_id
+        detail['comments_count'] = len(comments)
+        detail['user'] = detail.pop('user_name')
 
         return self.save_note(detail), self.save_note_comments(comments), self.save_attachments(attachments)
 
     @dbo.atomic()
     def save_photo_album(self, album_detail, picture_details):
+        """
+        相册及其照片入库，返回相册对象和照片 id 列表
+        """
         now = datetime.datetime.now()
         album_detail['version'] = 1
         album_detail['updated_at'] = now
+        album_id, = db.PhotoAlbum.bulk_upsert([album_detail], revisions=True)
+        fulltext.index('photo_album', [album_id])
 
-        try:
-            album = db.PhotoAlbum.safe_create(**album_detail)
-            logging.debug('create photo album: {0}'.format(album.title))
-        except db.IntegrityError:
-            album = db.PhotoAlbum.get(db.PhotoAlbum.douban_id == album_detail['douban_id'])
-            if not album.equals(album_detail):
-                db.PhotoAlbumHistorical.clone(album)
-                album_detail['version'] = db.PhotoAlbum.version + 1
-                db.PhotoAlbum.safe_update(**album_detail).where(db.PhotoAlbum.id == album.id).execute()
-
-        pictures = []
         for picture_detail in picture_details:
             picture_detail['version'] = 1
             picture_detail['updated_at'] = now
-            picture_detail['photo_album'] = album
-            try:
-                picture = db.PhotoPicture.safe_create(**picture_detail)
-            except db.IntegrityError:
-                picture = db.PhotoPicture.get(db.PhotoPicture.douban_id == picture_detail['douban_id'])
-                picture_detail['version'] = db.PhotoPicture.version + 1
-                db.PhotoPicture.safe_update(**picture_detail).where(db.PhotoPicture.id == picture.id).execute()
+            picture_detail['photo_album'] = album_id
+        pictures = db.PhotoPicture.bulk_upsert(picture_details, revisions=True)
 
-        return album, pictures
+        return self._identity_map.put(db.PhotoAlbum.get_by_id(album_id)), pictures
 
     def fetch_photo_album(self, douban_id, url=None, last_updated=None, **kwargs):
         """
         尝试从本地获取相册，如果没有则从网上抓取
         """
         try:
-            album = db.PhotoAlbum.get(db.PhotoAlbum.douban_id == douban_id)
+            album = self.get_local_object(db.PhotoAlbum, 'douban_id', douban_id)
             if last_updated and album.last_updated and last_updated != album.last_updated or self.is_oject_expired(album):
                 raise db.PhotoAlbum.DoesNotExist()
         except db.PhotoAlbum.DoesNotExist:
@@ -668,16 +825,17 @@ class Task:
         if not response:
             return None, None, None
 
-        dom = PyQuery(response.text)
+        if response.from_cache and 'douban_id' in kwargs:
+            album = self.get_unmodified(db.PhotoAlbum, kwargs['douban_id'])
+            if album and album.last_updated == kwargs.get('last_updated', album.last_updated):
+                return album, [], []
+
         cover = kwargs['cover'] if 'cover' in kwargs else None
         if cover:
             attachments.append({
                 'type': 'image',
                 'url': cover,
             })
-        btn_rec = dom('.rec>a')
-        douban_id = kwargs['douban_id'] if 'douban_id' in kwargs else btn_rec.attr('data-object_id')
-        last_updated = kwargs['last_updated'] if 'last_updated' in kwargs else None
 
         if re.match(
             r'^https://site\.douban\.com/widget/public_album/(\d+)/$', 
@@ -690,136 +848,38 @@ class Task:
             response.url
         ):
             # 小站相册
-            try:
-                like_count = re.search(r'(\d+)人', dom('.fav-num>a').text())[1]
-            except (ValueError, IndexError, TypeError):
-                like_count = None
-            try:
-                rec_count = re.search(r'(\d+)人', dom('.rec-num').text())[1]
-            except (ValueError, IndexError, TypeError):
-                rec_count = None
-            views_count = None
-            user = db.User.get_anonymous()
-
-            album_info_div = dom('#content .main .album-info')
-            album_info_div('.sns-bar-top').remove()
-            album_info_div('.wr').remove()
-
-            detail = {
-                'douban_id': douban_id,
-                'title': btn_rec.attr('data-name'),
-                'desc': album_info_div.text(),
-                'user': user,
-                'last_updated': last_updated,
-                'url': url,
-                'views_count': views_count,
-                'like_count': like_count if like_count else None,
-                'rec_count': rec_count if rec_count else None,
-                'cover': cover,
-            }
-            while True:
-                for photo_item in dom('#content .list-s>li>.photo-item'):
-                    photo_item_div = PyQuery(photo_item)
-                    photo_link = photo_item_div('.album_photo')
-                    img_src = photo_item_div('.album_photo>img').attr('src').replace('/photo/thumb/public/', '/photo/l/public/', 1)
-                    comments_views_count_text = photo_item_div('.desc>a').text()
-                    try:
-                        comments_count = re.search(r'(\d+)回应', comments_views_count_text)[1]
-                    except (IndexError, TypeError):
-                        comments_count = None
-                    views_count = None
-                    photo_url = photo_link.attr('href')
-                    photo_douban_id = photo_link.attr('id')[1:]
-                    pictures.append({
-                        'douban_id': photo_douban_id,
-                        'desc': photo_link.attr('title'),
-                        'url': photo_url,
-                        'picture': img_src,
-                        'views_count': views_count,
-                        'comments_count': comments_count,
-                    })
-                    attachments.append({
-                        'type': 'image',
-                        'url': img_src,
-                    })
-                next_page = dom('#content .bd>.paginator>.next>a')
-                if next_page:
-                    url = next_page.attr('href')
-                    if url[0] == '/':
-                        url = 'https://site.douban.com' + url
-                else:
-                    break
-                response = self.fetch_url_content(url)
-                if not response:
-                    break
-                dom = PyQuery(response.text)
+            site = True
         elif re.match(
             r'^https://www\.douban\.com/photos/album/(\d+)/$', 
             response.url
         ):
-            user = kwargs['user'] if 'user' in kwargs else self.fetch_user(_strip_username(dom('#db-usr-profile>.pic>a')))
-            like_count = dom('.action-react .react-num').text()
-            rec_count = dom('.rec-num').text()
-
-            try:
-                views_count = re.search(r'(\d+)人浏览', dom('.album-edit>span:last-child').text())[1]
-            except (ValueError, IndexError, TypeError):
-                views_count = None
-
-            detail = {
-                'douban_id': douban_id,
-                'title': btn_rec.attr('data-name'),
-                'desc': dom('#content .article>.description').text(),
-                'user': user,
-                'last_updated': last_updated,
-                'url': url,
-                'views_count': views_count,
-                'like_count': like_count if like_count else None,
-                'rec_count': rec_count if rec_count else None,
-                'cover': cover,
-            }
-
-            while True:
-                for photo_item in dom('.photolst>.photo_wrap'):
-                    photo_item_div = PyQuery(photo_item)
-                    photo_link = photo_item_div('.photolst_photo')
-                    img_src = photo_item_div('.photolst_photo>img').attr('src').replace('/photo/m/public/', '/photo/l/public/', 1)
-                    comments_views_count_text = photo_item_div('div[style="color:#999"]').text()
-                    try:
-                        comments_count = re.search(r'(\d+)回应', comments_views_count_text)[1]
-                    except (IndexError, TypeError):
-                        comments_count = None
-                    try:
-                        views_count = re.search(r'(\d+)浏览', comments_views_count_text)[1]
-                    except (IndexError, TypeError):
-                        views_count = None
-                    photo_url = photo_link.attr('href')
-                    photo_douban_id = re.match(r'http(?:s?)://www\.douban\.com/photos/photo/(.+)/', photo_url)[1]
-                    pictures.append({
-                        'douban_id': photo_douban_id,
-                        'desc': photo_link.attr('title'),
-                        'url': photo_url,
-                        'picture': img_src,
-                        'views_count': views_count,
-                        'comments_count': comments_count,
-                    })
-                    attachments.append({
-                        'type': 'image',
-                        'url': img_src,
-                    })
-                next_page = dom('#content .article>.paginator>.next>a')
-                if next_page:
-                    url = next_page.attr('href')
-                else:
-                    break
-                response = self.fetch_url_content(url)
-                if not response:
-                    break
-                dom = PyQuery(response.text)
+            site = False
         else:
             # 未知相册类型
             return None, None, None
 
+        parsed = parsers.parse_photo_album_page(response.text, site)
+        detail = parsed['album']
+        user_name = detail.pop('user_name')
+        if site:
+            detail['user'] = db.User.get_anonymous()
+        else:
+            detail['user'] = kwargs['user'] if 'user' in kwargs else self.fetch_user(user_name)
+        if 'douban_id' in kwargs:
+            detail['douban_id'] = kwargs['douban_id']
+        detail['last_updated'] = kwargs['last_updated'] if 'last_updated' in kwargs else None
+        detail['url'] = url
+        detail['cover'] = cover
+
+        parse_page = lambda html: parsers.parse_photo_album_photos_page(html, site)
+        for parsed in self.fetch_pages(response.url, parsed, parse_page):
+            for picture in parsed['pictures']:
+                pictures.append(picture)
+                attachments.append({
+                    'type': 'image',
+                    'url': picture['picture'],
+                })
+
         detail['photos_count'] = len(pictures)
         album_objects, picture_objects = self.save_photo_album(detail, pictures)
         attachment_objects = self.save_attachments(attachments)
@@ -828,22 +888,32 @@ class Task:
 
 class FollowingFollowerTask(Task):
     _name = '备份我的友邻'
+    _tables = Task._tables + (db.UserExtra, db.Following, db.FollowingHistorical, db.Follower, db.FollowerHistorical, db.BlockUser, db.BlockUserHistorical)
 
     def fetch_follow_list(self, user, action):
         url = 'https://api.douban.com/shuo/v2/users/{user}/{action}?count=50&page={page}'
 
         user_list = []
         page_count = 1
-        while True:
-            response = self.fetch_url_content(url.format(action=action, user=user, page=page_count))
-            if not response:
-                break
-            user_list_partial = json.loads(response.text)
-            if len(user_list_partial) == 0:
-                break
-            #user_list.extend([user_detail['uid'] for user_detail in user_list_partial])
-            user_list.extend(user_list_partial)
-            page_count += 1
+        concurrency = self._fetch_engine.concurrency
+        finished = False
+        while not finished:
+            # 总页数未知，每次并发抓取 concurrency 页，直到遇到空页
+            responses = self.fetch_url_contents([
+                url.format(action=action, user=user, page=page)
+                for page in range(page_count, page_count + concurrency)
+            ])
+            for response in responses:
+                if not response:
+                    finished = True
+                    break
+                user_list_partial = json.loads(response.text)
+                if len(user_list_partial) == 0:
+                    finished = True
+                    break
+                #user_list.extend([user_detail['uid'] for user_detail in user_list_partial])
+                user_list.extend(user_list_partial)
+            page_count += concurrency
 
         user_list.reverse()
         return user_list
@@ -855,50 +925,37 @@ class FollowingFollowerTask(Task):
         dom = PyQuery(response.text)
         return [_strip_username(PyQuery(item)) for item in dom('dl.obu>dd>a')]
 
-    @dbo.atomic()
     def save_user_extras(self, user_extras):
+        now = datetime.datetime.now()
+        rows = []
         for user, user_extra in user_extras.items():
-            now = datetime.datetime.now()
             detail = user_extra.copy()
             detail['updated_at'] = now
             detail['user'] = user
             del detail['id']
-            try:
-                db.UserExtra.safe_create(**detail)
-            except db.IntegrityError:
-                del detail['user']
-                db.UserExtra.safe_update(**detail).where(db.UserExtra.user == user).execute()
+            rows.append(detail)
+        db.UserExtra.bulk_upsert(rows, key='user')
 
     @dbo.atomic()
     def save_following(self, account_user, following_users):
         now = datetime.datetime.now()
+        rows = []
         for following_username, following_user in following_users:
             if not following_user.id:
                 continue
 
-            real_following_username = following_user.unique_name if following_user else following_username
-            try:
-                kwargs = {
-                    'user': account_user,
-                    'following_user': following_user,
-                    'following_username': real_following_username,
-                    'updated_at': now,
-                }   
-                db.Following(**kwargs).save()
-            except db.IntegrityError:
-                try:
-                    fw = db.Following.get(
-                        db.Following.user == account_user,
-                        db.Following.following_username == real_following_username
-                    )
-                    if not fw.following_user and following_user is not None :
-                        fw.following_user = following_user
-                    if following_user and fw.following_username != following_user.unique_name:
-                        fw.following_username = following_user.unique_name
-                    fw.updated_at = now
-                    fw.save()
-                except (db.User.DoesNotExist, db.Following.DoesNotExist, db.IntegrityError):
-                    pass
+            rows.append({
+                'user': account_user,
+                'following_user': following_user,
+                'following_username': following_user.unique_name if following_user else following_username,
+                'updated_at': now,
+            })
+        db.Following.bulk_upsert(
+            rows,
+            key=('user', 'following_username'),
+            update=['following_user', 'updated_at'],
+            preserve=['following_user']
+        )
 
         db.FollowingHistorical.insert_from(
             db.Following.select(
@@ -930,24 +987,17 @@ class FollowingFollowerTask(Task):
     @dbo.atomic()
     def save_followers(self, account_user, followers):
         now = datetime.datetime.now()
-        for follower_username, follower in followers:
-            try:
-                kwargs = {
-                    'user': account_user,
-                    'follower': follower,
-                    'follower_username': follower_username,
-                    'updated_at': now,
-                }   
-                db.Follower(**kwargs).save()
-            except db.IntegrityError:
-                fw = db.Follower.get(
-                    db.Follower.user == account_user,
-                    db.Follower.follower_username == follower_username
-                )
-                if not fw.follower and follower is not None :
-                    fw.follower = follower
-                fw.updated_at = now
-                fw.save()
+        db.Follower.bulk_upsert(
+            [{
+                'user': account_user,
+                'follower': follower,
+                'follower_username': follower_username,
+                'updated_at': now,
+            } for follower_username, follower in followers],
+            key=('user', 'follower_username'),
+            update=['follower', 'updated_at'],
+            preserve=['follower']
+        )
 
         db.FollowerHistorical.insert_from(
             db.Follower.select(
@@ -979,24 +1029,16 @@ class FollowingFollowerTask(Task):
     @dbo.atomic()
     def save_block_list(self, account_user, block_users):
         now = datetime.datetime.now()
-        for block_username, block_user in block_users:
-            try:
-                kwargs = {
-                    'user': account_user,
-                    'block_user': block_user,
-                    'block_username': block_username,
-                    'updated_at': now,
-                }   
-                db.BlockUser(**kwargs).save()
-            except db.IntegrityError:
-                new_block_user = db.BlockUser.get(
-                    db.BlockUser.user == account_user,
-                    db.BlockUser.block_username == block_username
-                )
-                if not new_block_user.block_user and block_user is not None :
-                    new_block_user.block_user = block_user
-                new_block_user.updated_at = now
-                new_block_user.save()
+        db.BlockUser.bulk_upsert(
+            [{
+                'user': account_user,
+                'block_user': block_user,
+                'block_username': block_username,
+                'updated_at': now,
+            } for block_username, block_user in block_users],
+            key=('user', 'block_user'),
+            update=['updated_at']
+        )
 
         db.BlockUserHistorical.insert_from(
             db.BlockUser.select(
@@ -1029,18 +1071,22 @@ class FollowingFollowerTask(Task):
         account = self.account
 
         following_user_list = self.fetch_follow_list(account.name, 'following')
+        self._identity_map.warm(db.User, 'unique_name', [user_detail['uid'] for user_detail in following_user_list])
         following_users = [(user_detail['uid'], self.fetch_user(user_detail['uid'])) for user_detail in following_user_list]
         self.save_following(account.user, following_users)
         
         follower_list = self.fetch_follow_list(account.name, 'followers')
+        self._identity_map.warm(db.User, 'unique_name', [user_detail['uid'] for user_detail in follower_list])
         follower_users = [(user_detail['uid'], self.fetch_user(user_detail['uid'])) for user_detail in follower_list]
         self.save_followers(account.user, follower_users)
 
-        user_extras = {self.fetch_user(user_detail['uid']): user_detail for user_detail in following_user_list}
-        user_extras.update({self.fetch_user(user_detail['uid']): user_detail for user_detail in follower_list})
+        # 复用上面取到的用户对象，不再逐个重新查询
+        user_extras = {user: user_detail for (_, user), user_detail in zip(following_users, following_user_list)}
+        user_extras.update({user: user_detail for (_, user), user_detail in zip(follower_users, follower_list)})
         self.save_user_extras(user_extras)
 
         block_list = self.fetch_block_list()
+        self._identity_map.warm(db.User, 'unique_name', block_list)
         block_users = [(username, self.fetch_user(username)) for username in block_list]
         self.save_block_list(account.user, block_users)
         logging.info('备份我的友邻全部完成')
@@ -1050,24 +1096,20 @@ class InterestsTask(Task):
     @dbo.atomic()
     def save_my_interests(self, subject_name, table, table_historical, user, interests):
         now = datetime.datetime.now()
+        rows = []
         for subject_id, interest_detail in interests:
-            try:
-                interest_detail['created_at'] = now
-                interest_detail['updated_at'] = now
-                table.safe_create(**interest_detail)
-            except db.IntegrityError:
-                update_detail = {key: interest_detail[key] for key in ['rating', 'tags', 'create_time', 'comment', 'status']}
-                my_interest = table.get(
-                    table.user == user,
-                    table.subject_id == subject_id
-                )
-                if my_interest.equals(update_detail):
-                    my_interest.updated_at = now
-                    my_interest.save()
-                else:
-                    table_historical.clone(my_interest, {'deleted_at': now})
-                    update_detail['updated_at'] = now
-                    table.safe_update(**update_detail).where(table.id == my_interest.id).execute()
+            interest_detail['user'] = user
+            interest_detail['created_at'] = now
+            interest_detail['updated_at'] = now
+            rows.append(interest_detail)
+        table.bulk_upsert(
+            rows,
+            key=('user', 'subject_id'),
+            update=['rating', 'tags', 'create_time', 'comment', 'status', 'updated_at'],
+            historical=table_historical,
+            historical_defaults={'deleted_at': now},
+            touch=['updated_at']
+        )
         
         table_historical.insert_from(
             table.select(
@@ -1125,9 +1167,11 @@ class InterestsTask(Task):
     def _run(self, subject_name, table, table_historical, fetch_subject):
         self._frodotk_referer_patch()
         account_user = self.account
+        subject_model = getattr(table, subject_name).rel_model
 
         wish_list = self.fetch_interests(subject_name, 'mark')
         wish_list.reverse()
+        self._identity_map.warm(subject_model, 'douban_id', [item['subject']['id'] for item in wish_list])
         my_wish_mapping = [(item['subject']['id'], {
             'comment': item['comment'],
             'rating': item['rating'],
@@ -1141,6 +1185,7 @@ class InterestsTask(Task):
 
         doing_list = self.fetch_interests(subject_name, 'doing')
         doing_list.reverse()
+        self._identity_map.warm(subject_model, 'douban_id', [item['subject']['id'] for item in doing_list])
         my_doing_mapping = [(item['subject']['id'], {
             'comment': item['comment'],
             'rating': item['rating'],
@@ -1154,6 +1199,7 @@ class InterestsTask(Task):
 
         done_list = self.fetch_interests(subject_name, 'done')
         done_list.reverse()
+        self._identity_map.warm(subject_model, 'douban_id', [item['subject']['id'] for item in done_list])
         my_done_mapping = [(item['subject']['id'], {
             'comment': item['comment'],
             'rating': item['rating'],
@@ -1177,6 +1223,7 @@ class InterestsTask(Task):
 
 class BookTask(InterestsTask):
     _name = '备份我的书'
+    _tables = Task._tables + (db.Book, db.MyBook, db.MyBookHistorical)
 
     def run(self):
         return self._run(
@@ -1189,6 +1236,7 @@ class BookTask(InterestsTask):
 
 class MovieTask(InterestsTask):
     _name = '备份我的影视'
+    _tables = Task._tables + (db.Movie, db.MyMovie, db.MyMovieHistorical)
 
     def run(self):
         return self._run(
@@ -1201,6 +1249,7 @@ class MovieTask(InterestsTask):
 
 class MusicTask(InterestsTask):
     _name = '备份我的音乐'
+    _tables = Task._tables + (db.Music, db.MyMusic, db.MyMusicHistorical)
 
     def run(self):
         return self._run(
@@ -1218,333 +1267,232 @@ class BroadcastTask(Task):
     _MAX_CONFLICT_ALLOWED = 10
     _conflict_count = 0
     _name = '备份我的广播'
+    _tables = Task._tables + (db.Broadcast, db.Timeline, db.Note, db.Comment, db.Attachment, db.Movie, db.Book, db.Music)
 
     @dbo.atomic()
     def save_status_list(self, statuses):
+        """
+        广播入库，返回与 statuses 顺序一致的广播 id 列表
+        """
+        if not statuses:
+            return []
         current_user = self.account.user
-        broadcasts = []
+        origin_users = dict(db.Broadcast.select(db.Broadcast.douban_id, db.Broadcast.user).where(
+            db.Broadcast.douban_id.in_([str(status['douban_id']) for status in statuses])
+        ).tuples())
         for status in statuses:
-            try:
-                broadcasts.append(db.Broadcast.safe_create(**status))
+            douban_id = str(status['douban_id'])
+            if douban_id in origin_users and current_user.id == origin_users[douban_id]:
+                # 必须是本人的广播才累计
+                self._conflict_count += 1
+            else:
                 self._conflict_count = 0
-            except db.IntegrityError:
-                douban_id = status['douban_id']
-                origin_status = db.Broadcast.get(db.Broadcast.douban_id == douban_id)
-                if not origin_status.equals(status):
-                    update_values = {
-                        'reshared_count': status['reshared_count'],
-                        'like_count': status['like_count'],
-                        'comments_count': status['comments_count'],
-                    }
-                    db.Broadcast.safe_update(**update_values).where(
-                        db.Broadcast.douban_id == douban_id
-                    ).execute()
-                broadcasts.append(origin_status)
-                if current_user.id == origin_status.user.id:
-                    # 必须是本人的广播才累计
-                    self._conflict_count += 1
-                else:
-                    self._conflict_count = 0
-        return broadcasts
+        broadcast_ids = db.Broadcast.bulk_upsert(statuses, update=['reshared_count', 'like_count', 'comments_count'])
+        fulltext.index('broadcast', broadcast_ids)
+        return broadcast_ids
 
     def fetch_statuses_list(self, now, integral=False):
-        url = self.account.user.alt + 'statuses?p={0}'
-        page = 1
-        timeline_in_page = []
-        def parse_status(status_div):
-            """
-            关于object_kind说明：
-            1000: 成员
-            1001: 图书
-            1002: 电影
-            1003: 音乐
-            1005: 关注好友
-            1011: 活动
-            1012: 评论
-            1013: 小组话题
-            1014: （电影）讨论
-            1015: 日记
-            1018: 图文广播
-            1019: 小组
-            1020: 豆列
-            1021: 九点文章
-            1022: 网页
-            1025: 相册照片
-            1026: 相册
-            1043: 影人
-            1044: 艺术家
-            1062: board(???)
-            2001: 线上活动
-            2004: 小站视频
-            3043: 豆瓣FM单曲
-            3049: 读书笔记
-            3065: 条目
-            3072: 豆瓣FM兆赫
-            3090: 东西
-            3114: 游戏
-            5021: 豆瓣阅读的图片
-            5022: 豆瓣阅读的作品
-
-            """
-            if not isinstance(status_div, PyQuery):
-                status_div = PyQuery(status_div)
-            reshared_count = 0
-            like_count = 0
-            comments_count = 0
-            created_at = None
-            is_noreply = False
-            status_url = None
-            target_type = None
-            object_kind = None
-            object_id = None
-            reshared_detail = None
-            blockquote = None
-            douban_user_id = status_div.attr('data-uid')
-            douban_id = status_div.attr('data-sid')
-            is_saying = status_div.has_class('saying')
-            is_reshared = status_div.has_class('status-reshared-wrapper')
-            
-            try:
-                created_span = status_div.find('.actions>.created_at')[0]
-            except:
-                is_noreply = True
+        """
+        逐页备份广播，每一页的广播和时间轴与进度在同一个事务中写入，中断后从下一页继续。
+        抓取、解析、入库串成生成器，同一时间只有一页的数据在内存中
+        """
+        cursor, _ = self.load_checkpoint('statuses')
+        if cursor is None:
+            cursor = {
+                'page': 1,
+                'sequence_base': int(now.timestamp()) * TIMELINE_SEQUENCE_STRIDE,
+                'integral': integral,
+                'conflict_count': 0,
+            }
+        else:
+            logging.info('从第{0}页继续备份广播'.format(cursor['page']))
+        self._conflict_count = cursor['conflict_count']
 
-            try:
-                """
-                获取广播链接
-                """
-                exactly_link = PyQuery(status_div.find('.actions a').eq(0))
-                status_url = exactly_link.attr('href')
-            except:
-                pass
+        pages = self.fetch_status_pages(cursor['page'])
+        pages = self.resolve_status_pages(pages, now)
+        for _ in self.save_status_pages(pages, now, cursor):
+            if not cursor['integral'] and self._broadcast_incremental_backup and self._conflict_count >= self._MAX_CONFLICT_ALLOWED:
+                logging.info('增量备份完成')
+                break
 
-            try:
-                """
-                获取关于广播类型的属性
-                """
-                status_item_div = PyQuery(status_div.find('.status-item').eq(0))
-                target_type = status_item_div.attr('data-target-type')
-                object_kind = status_item_div.attr('data-object-kind')
-                object_id = status_item_div.attr('data-object-id')
-                if not douban_user_id:
-                    douban_user_id = status_item_div.attr('data-uid')
-                if not douban_id:
-                    douban_id = status_div.attr('data-sid')
-                blockquote = PyQuery(status_item_div.find('blockquote')).html()
-            except:
-                pass
+        # 只有抓到列表末尾或增量备份完成才清除进度，抓取失败时异常会跳过这里
+        self.clear_checkpoint('statuses')
 
-            if not is_noreply:
-                """
-                获取创建时间、回复、点赞、转播数
-                """
-                try:
-                    created_at = PyQuery(created_span).attr('title')
-                    reply_link = PyQuery(status_item_div.find('.actions>.new-reply'))
-                    comments_count = reply_link.attr('data-count')
-                    like_span = PyQuery(status_item_div.find('.actions>.like-count'))
-                    like_count = like_span.attr('data-count')
-                    if like_count is None:
-                        try:
-                            like_count = int(re.match(r'赞\((.*)\)', like_span.text().strip())[1])
-                        except:
-                            like_count = 0
-                    reshared_span = PyQuery(status_item_div.find('.actions>.reshared-count'))
-                    reshared_count = reshared_span.attr('data-count')
-                    if reshared_count is None:
-                        reshared_count = 0
-                except:
-                    pass
+    def fetch_status_pages(self, page):
+        """
+        从 page 页开始由后台线程逐页抓取广播列表，交给解析进程池解析，返回 (页码, 广播列表)。
+        页面上没有广播时列表结束；某一页抓取失败时抛出 FetchError，进度停在最后入库的一页
+        """
+        url = self.account.user.alt + 'statuses?p={0}'
+        prefetch = Prefetcher(self.fetch_required_url_content, self._parse_pool, parsers.parse_status_page)
+        for page, parsed in prefetch((page, url.format(page)) for page in itertools.count(page)):
+            if parsed['statuses'] is None:
+                return
+            self._identity_map.warm(db.User, 'douban_id', parsed['user_ids'])
+            yield page, parsed['statuses']
+
+    def resolve_status_pages(self, pages, now):
+        """
+        补全每一页的广播，返回 (页码, 广播列表, 被转播的广播列表)
+        """
+        for page, statuses in pages:
+            status_details = []
+            reshared_details = []
+            for status_detail, reshared_detail in statuses:
+                status_details.append(self.resolve_status(status_detail, now))
+                if reshared_detail:
+                    reshared_details.append(self.resolve_status(reshared_detail, now))
+            yield page, status_details, reshared_details
 
-            if not douban_id or douban_id == 'None':
-                """
-                原广播已被删除
-                """
-                return None, None
-
-            detail = {
-                'douban_id': douban_id,
-                'douban_user_id': douban_user_id,
-                'content': status_div.outer_html(),
-                'created': created_at,
-                'is_reshared': is_reshared,
-                'is_saying': is_saying,
-                'is_noreply': is_noreply,
-                'updated_at': now,
-                'reshared_count': reshared_count,
-                'like_count': like_count,
-                'comments_count': comments_count,
-                'status_url': status_url,
-                'target_type': target_type,
-                'object_kind': object_kind,
-                'object_id': object_id,
-                'user': self.fetch_user_by_id(douban_user_id),
-                'blockquote': blockquote,
-            }
+    def save_status_pages(self, pages, now, cursor):
+        """
+        每一页的广播、时间轴和进度在同一个事务中入库，返回 (页码, 入库的广播 id 列表)
+        """
+        for page, status_details, reshared_details in pages:
+            with dbo.atomic():
+                reshared_ids = self.save_status_list(reshared_details)
+                reshared_mapping = {detail['douban_id']: broadcast_id for detail, broadcast_id in zip(reshared_details, reshared_ids)}
+                for detail in status_details:
+                    if 'reshared_id' in detail:
+                        detail['reshared'] = reshared_mapping[detail['reshared_id']]
+                        del detail['reshared_id']
+                status_ids = self.save_status_list(status_details)
+                self.save_timeline(status_ids, now, cursor['sequence_base'] - page * TIMELINE_PAGE_STRIDE)
+                cursor['page'] = page + 1
+                cursor['conflict_count'] = self._conflict_count
+                self.save_checkpoint('statuses', cursor)
+            yield page, status_ids
+
+
+    def resolve_status(self, detail, now):
+        """
+        补全解析出的广播：关联发布者、保存图片，并抓取广播涉及的日记和条目。
+
+        关于object_kind说明：
+        1000: 成员
+        1001: 图书
+        1002: 电影
+        1003: 音乐
+        1005: 关注好友
+        1011: 活动
+        1012: 评论
+        1013: 小组话题
+        1014: （电影）讨论
+        1015: 日记
+        1018: 图文广播
+        1019: 小组
+        1020: 豆列
+        1021: 九点文章
+        1022: 网页
+        1025: 相册照片
+        1026: 相册
+        1043: 影人
+        1044: 艺术家
+        1062: board(???)
+        2001: 线上活动
+        2004: 小站视频
+        3043: 豆瓣FM单曲
+        3049: 读书笔记
+        3065: 条目
+        3072: 豆瓣FM兆赫
+        3090: 东西
+        3114: 游戏
+        5021: 豆瓣阅读的图片
+        5022: 豆瓣阅读的作品
 
-            if is_reshared:
-                reshared_status_div = PyQuery(status_div.find('.status-real-wrapper').eq(0))
-                reshared_detail, _ = parse_status(reshared_status_div)
-                if reshared_detail:
-                    detail['reshared_id'] = reshared_detail['douban_id']
-
-            if target_type == 'sns':
-                attachments = []
-                images = status_div.find('.attachments-saying.group-pics a.view-large')
-                for img_lnk in images:
-                    attachments.append({
-                        'type': 'image',
-                        'url': PyQuery(img_lnk).attr('href'),
-                    })
-                images = status_div.find('.attachments-saying.attachments-pic img')
-                for img in images:
-                    img_lnk = PyQuery(img).attr('data-raw-src')
-                    if img_lnk:
-                        attachments.append({
-                            'type': 'image',
-                            'url': img_lnk,
-                        })
-                if attachments:
-                    self.save_attachments(attachments)
-                    detail['attachments'] = attachments
-
-                if object_kind == '1015':
-                    # 发布日记
-                    self.fetch_note(object_id)
-                elif object_kind == '1026':
-                    # 发布相册
-                    pass
-                elif object_kind == '1025':
-                    # 上传照片
-                    pass
-            elif target_type == 'movie' and object_kind == '1002':
-                self.fetch_movie(object_id)
-            elif target_type == 'book' and object_kind == '1001':
+        """
+        target_type = detail['target_type']
+        object_kind = detail['object_kind']
+        object_id = detail['object_id']
+        detail['updated_at'] = now
+        detail['user'] = self.fetch_user_by_id(detail['douban_user_id'])
+
+        if target_type == 'sns':
+            if detail.get('attachments'):
+                self.save_attachments(detail['attachments'])
+
+            if object_kind == '1015':
+                # 发布日记
+                self.fetch_note(object_id)
+            elif object_kind == '1026':
+                # 发布相册
+                pass
+            elif object_kind == '1025':
+                # 上传照片
+                pass
+        elif target_type == 'movie' and object_kind == '1002':
+            self.fetch_movie(object_id)
+        elif target_type == 'book' and object_kind == '1001':
+            self.fetch_book(object_id)
+        elif target_type == 'music' and object_kind == '1003':
+            self.fetch_music(object_id)
+        elif target_type == 'rec':
+            if object_kind == '1015':
+                # 推荐日记
+                self.fetch_note(object_id)
+            elif object_kind == '1001':
+                # 推荐书
                 self.fetch_book(object_id)
-            elif target_type == 'music' and object_kind == '1003':
+            elif object_kind == '1002':
+                # 推荐影视
+                self.fetch_movie(object_id)
+            elif object_kind == '1003':
+                # 推荐音乐
                 self.fetch_music(object_id)
-            elif target_type == 'rec':
-                if object_kind == '1015':
-                    # 推荐日记
-                    self.fetch_note(object_id)
-                elif object_kind == '1001':
-                    # 推荐书
-                    self.fetch_book(object_id)
-                elif object_kind == '1002':
-                    # 推荐影视
-                    self.fetch_movie(object_id)
-                elif object_kind == '1003':
-                    # 推荐音乐
-                    self.fetch_music(object_id)
-                elif object_kind == '1026':
-                    # 推荐相册
-                    pass
-                elif object_kind == '1025':
-                    # 推荐照片
-                    pass
-
-            return detail, reshared_detail
-
-        while True:
-            response = self.fetch_url_content(url.format(page))
-            if not response:
-                break
-            dom = PyQuery(response.text)
-            statuses_in_page = dom('.stream-items>.new-status.status-wrapper')
-            if len(statuses_in_page) == 0:
-                break
-            status_details = []
-            reshared_details = []
-            for status_wrapper in statuses_in_page:
-                status_detail, reshared_detail = parse_status(status_wrapper)
-                if status_detail:
-                    status_details.append(status_detail)
-                    if reshared_detail:
-                        reshared_details.append(reshared_detail)
-
-            reshared_objects = self.save_status_list(reshared_details)
-            reshared_mapping = {_.douban_id: _ for _ in reshared_objects}
-            for detail in status_details:
-                if 'reshared_id' in detail:
-                    detail['reshared'] = reshared_mapping[detail['reshared_id']]
-                    del detail['reshared_id']
-            status_objects = self.save_status_list(status_details)
-            timeline_in_page.extend(status_objects)
-            page += 1
-
-            if not integral and self._broadcast_incremental_backup and self._conflict_count >= self._MAX_CONFLICT_ALLOWED:
-                logging.info('增量备份完成')
-                break
+            elif object_kind == '1026':
+                # 推荐相册
+                pass
+            elif object_kind == '1025':
+                # 推荐照片
+                pass
 
-        return timeline_in_page
+        return detail
 
-    @dbo.atomic()
-    def save_timeline(self, timeline, now):
-        timeline_objects = []
+    def save_timeline(self, timeline, now, sequence):
+        """
+        时间轴入库，timeline 按从新到旧排列，序号从 sequence 开始依次减小。已有记录的序号不变
+        """
         user = self.account.user
-        #db.Timeline.delete().where(db.Timeline.user == user).execute()
-        for broadcast in timeline:
-            try:
-                timeline_item = db.Timeline.create(user=user, broadcast=broadcast, updated_at=now)
-            except db.IntegrityError:
-                timeline_item = db.Timeline.get(
-                    db.Timeline.user == user,
-                    db.Timeline.broadcast == broadcast
-                )
-                timeline_item.updated_at = now
-                timeline_item.save()
-            timeline_objects.append(timeline_item)
-        return timeline_objects
+        return db.Timeline.bulk_upsert(
+            [
+                {'user': user, 'broadcast': broadcast, 'sequence': sequence - position, 'updated_at': now}
+                for position, broadcast in enumerate(timeline)
+            ],
+            key=('user', 'broadcast'),
+            update=['updated_at']
+        )
 
     def run(self):
         now = datetime.datetime.now()
-        timeline = []
-        timeline.extend(self.fetch_statuses_list(now, db.Timeline.select().where(db.Timeline.user == self.account.user).count() == 0))
-        timeline.reverse()
-        self.save_timeline(timeline, now)
+        integral = not db.Timeline.select().where(db.Timeline.user == self.account.user).exists()
+        self.fetch_statuses_list(now, integral)
         if self._image_local_cache:
-            while self.fetch_attachment():
-                pass
+            self.download_attachments()
         logging.info('备份我的广播全部完成')
 
 
 class BroadcastCommentTask(Task):
     _name = '备份广播评论'
+    _tables = Task._tables + (db.Comment,)
 
     def fetch_comment_list(self, broadcast_url, broadcast_douban_id):
-        url = broadcast_url
         comments = []
-        while True:
-            response = self.fetch_url_content(url)
-            if not response:
-                break
-            dom = PyQuery(response.text)
-            comment_items = dom('#comments>.comment-item')
-            for comment_item in comment_items:
-                item_div = PyQuery(comment_item)
-                comments.append({
-                    'content': item_div.outer_html(),
-                    'target_type': 'broadcast',
-                    'target_douban_id': broadcast_douban_id,
-                    'douban_id': item_div.attr('data-cid'),
-                    'user': self.fetch_user(PyQuery(item_div('.pic>a')).attr('data-uid')),
-                    'text': PyQuery(item_div('.content>p.text')).text(),
-                    'created': PyQuery(item_div('.content>.author>.created_at')).text(),
-                })
-            next_page = dom('#comments>.paginator>.next>a')
-            if next_page:
-                url = broadcast_url + next_page.attr('href')
-            else:
-                break
+        response = self.fetch_url_content(broadcast_url)
+        if not response:
+            return comments
+        parsed = parsers.parse_broadcast_comments_page(response.text)
+        for parsed in self.fetch_pages(broadcast_url, parsed, parsers.parse_broadcast_comments_page):
+            self._identity_map.warm(db.User, 'unique_name', [comment['user_name'] for comment in parsed['comments']])
+            for comment in parsed['comments']:
+                comment['target_type'] = 'broadcast'
+                comment['target_douban_id'] = broadcast_douban_id
+                comment['user'] = self.fetch_user(comment.pop('user_name'))
+                comments.append(comment)
         return comments
 
-    @dbo.atomic()
     def save_comment_list(self, comments):
-        for detail in comments:
-            try:
-                db.Comment.safe_create(**detail)
-            except db.IntegrityError:
-                pass
+        comment_ids = db.Comment.bulk_upsert(comments, key=('target_type', 'target_douban_id', 'douban_id'), update=[])
+        fulltext.index('comment', comment_ids)
 
 
     def run(self):
@@ -1562,145 +1510,59 @@ class BroadcastCommentTask(Task):
 
 class NoteTask(Task):
     _name = '备份我的日记'
+    _tables = Task._tables + (db.Note, db.Comment, db.Attachment, db.Movie, db.Book, db.Music)
 
     def fetch_note_list(self):
-        url = self.account.user.alt + 'notes'
-        notes = []
-        while True:
-            response = self.fetch_url_content(url)
-            if not response:
-                break
-            dom = PyQuery(response.text)
-            note_items = dom('#content .article>.note-container')
-            for note_item in note_items:
-                notes.append(PyQuery(note_item).attr('data-url'))
-            next_page = dom('#content .article>.paginator>.next>a')
-            if next_page:
-                url = next_page.attr('href')
-            else:
-                break
-        return notes
+        return self.fetch_list_pages('notes', self.account.user.alt + 'notes', parsers.parse_note_list_page, reverse=True)
 
     def run(self):
-        notes = self.fetch_note_list()
-        notes.reverse()
-        for url in notes:
+        notes, cursor = self.fetch_note_list()
+        for url in self.iter_unfinished('notes', notes, cursor):
             self.fetch_note_by_url(url)
+        self.clear_checkpoint('notes')
         if self._image_local_cache:
-            while self.fetch_attachment():
-                pass
+            self.download_attachments()
         logging.info('备份我的日记全部完成')
 
 
 class PhotoAlbumTask(Task):
     _name = '备份我的相册'
+    _tables = Task._tables + (db.PhotoAlbum, db.PhotoPicture, db.Attachment)
 
     def fetch_photo_album_list(self):
-        url = self.account.user.alt + 'photos'
-        albums = []
-        while True:
-            response = self.fetch_url_content(url)
-            if not response:
-                break
-            dom = PyQuery(response.text)
-            album_items = dom('#content .article>.wr>.albumlst')
-            for album_item in album_items:
-                album_div = PyQuery(album_item)
-                misc_text = album_div('.albumlst_r>.pl').text()
-                try:
-                    last_updated = re.search(r'(\d+\-\d+\-\d+)(?:创建|更新)', misc_text)[1]
-                except (IndexError, TypeError):
-                    last_updated = None
-
-                albums.append((
-                    album_div('.album_photo').attr('href'),
-                    album_div('.album').attr('src'),
-                    last_updated,
-                ))
-            next_page = dom('#content .article>.paginator>.next>a')
-            if next_page:
-                url = next_page.attr('href')
-            else:
-                break
-        return albums
+        return self.fetch_list_pages('photos', self.account.user.alt + 'photos', parsers.parse_photo_album_list_page)
 
     def run(self):
         user = self.account.user
-        albums = self.fetch_photo_album_list()
-        for url, cover, last_updated in albums:
+        albums, cursor = self.fetch_photo_album_list()
+        for url, cover, last_updated in self.iter_unfinished('photos', albums, cursor):
             photo_album_douban_id = re.match(r'https://www\.douban\.com/photos/album/(\d+)/', url)[1]
             self.fetch_photo_album(photo_album_douban_id, url=url, user=user, cover=cover, last_updated=last_updated)
+        self.clear_checkpoint('photos')
         if self._image_local_cache:
-            while self.fetch_attachment():
-                pass
+            self.download_attachments()
 
 
 class LikeTask(Task):
     _name = '备份我的喜欢'
+    _tables = Task._tables + (db.Favorite, db.FavoriteHistorical, db.PhotoAlbum, db.PhotoPicture, db.Note, db.Comment, db.Attachment, db.Movie, db.Book, db.Music)
 
-    def fetch_like_list(self, url):
-        item_list = []
-        while True:
-            response = self.fetch_url_content(url)
-            if not response:
-                break
-            dom = PyQuery(response.text)
-            items = dom('#content .article>.fav-list>li')
-            for item in items:
-                div = PyQuery(item)
-                author_tags = div('.author-tags>.tag-add')
-                douban_id = author_tags.attr('data-id')
-
-                if not douban_id:
-                    # 喜欢的对象不存在了
-                    continue
-
-                tags = author_tags.attr('data-tags')
-
-                lnk_delete = div('.gact.lnk-delete')
-                target_type = lnk_delete.attr('data-tkind')
-                target_douban_id = lnk_delete.attr('data-tid')
-                target_url = lnk_delete.attr('href')
-                
-                created = div('.status-item .time').text()
-
-                item_list.append({
-                    'douban_id': douban_id,
-                    'target_type': target_type,
-                    'target_douban_id': target_douban_id,
-                    'created': created,
-                    'tags': tags,
-                    'url': target_url,
-                    '_extra': div('.status-item .block .content'),
-                })
-            next_page = dom('#content .article>.paginator>.next>a')
-            if next_page:
-                url = next_page.attr('href')
-            else:
-                break
-        item_list.reverse()
-        return item_list
+    def fetch_like_list(self, name, url):
+        return self.fetch_list_pages(name, url, parsers.parse_like_list_page, reverse=True)
 
     @dbo.atomic()
     def save_like_list(self, item_list):
         user = self.account.user
         now = datetime.datetime.now()
-        like_list = []
         try:
             target_type = item_list[0]['target_type']
         except IndexError:
-            return like_list
+            return []
 
         for detail in item_list:
             detail['user'] = user
             detail['updated_at'] = now
-            try:
-                like = db.Favorite.safe_create(**detail)
-            except db.IntegrityError:
-                like = db.Favorite.get(db.Favorite.douban_id == detail['douban_id'])
-                like.updated_at = now
-                like.save()
-            like_list.append(like)
+        like_list = db.Favorite.bulk_upsert(item_list, update=['updated_at'])
 
         db.FavoriteHistorical.insert_from(
             db.Favorite.select(
@@ -1738,23 +1600,26 @@ class LikeTask(Task):
         return like_list
 
     def run(self):
-        item_list = self.fetch_like_list(self.account.user.alt + 'likes/note/')
-        notes = [self.fetch_note(detail['target_douban_id']) for detail in item_list]
+        item_list, cursor = self.fetch_like_list('likes/note', self.account.user.alt + 'likes/note/')
+        self._identity_map.warm(db.Note, 'douban_id', [detail['target_douban_id'] for detail in item_list[cursor['done']:]])
+        for detail in self.iter_unfinished('likes/note', item_list, cursor):
+            self.fetch_note(detail['target_douban_id'])
         self.save_like_list(item_list)
+        self.clear_checkpoint('likes/note')
 
-        item_list = self.fetch_like_list(self.account.user.alt + 'likes/photo_album/')
-        photo_albums = [
+        item_list, cursor = self.fetch_like_list('likes/photo_album', self.account.user.alt + 'likes/photo_album/')
+        self._identity_map.warm(db.PhotoAlbum, 'douban_id', [detail['target_douban_id'] for detail in item_list[cursor['done']:]])
+        for detail in self.iter_unfinished('likes/photo_album', item_list, cursor):
             self.fetch_photo_album(
                 detail['target_douban_id'], 
                 url=detail['url'], 
-                cover=detail['_extra']('.album-photos img').eq(0).attr('src')
-            ) for detail in item_list
-        ]
+                cover=detail['cover']
+            )
         self.save_like_list(item_list)
+        self.clear_checkpoint('likes/photo_album')
 
         if self._image_local_cache:
-            while self.fetch_attachment():
-                pass
+            self.download_attachments()
 
 
 class ReviewTask(Task):
@@ -1800,6 +1665,56 @@ class DoulistTask(Task):
         pass
 
 
+class AttachmentGCTask(Task):
+    _name = '整理图片缓存'
+    _tables = Task._tables + (db.Attachment,)
+
+    def adopt_legacy_files(self, store):
+        """
+        把旧版本按 URL 命名的图片移入按内容寻址的存储，内容相同的图片只保留一份
+        """
+        last_id = 0
+        while True:
+            attachments = list(db.Attachment.select().where(
+                db.Attachment.local != None,
+                db.Attachment.id > last_id
+            ).order_by(db.Attachment.id).limit(ATTACHMENT_BATCH_SIZE))
+            if not attachments:
+                break
+            last_id = attachments[-1].id
+
+            adopted = []
+            for attachment in attachments:
+                if store.is_blob_name(attachment.local):
+                    continue
+                try:
+                    adopted.append((attachment.id, store.adopt(attachment.local)))
+                except OSError:
+                    # 文件已经丢失，重新下载
+                    adopted.append((attachment.id, None))
+            if adopted:
+                with dbo.atomic():
+                    db.Attachment.update(
+                        local=db.Case(db.Attachment.id, adopted)
+                    ).where(
+                        db.Attachment.id.in_([attachment_id for attachment_id, _ in adopted])
+                    ).execute()
+
+    def run(self):
+        store = AttachmentStore(self._cache_path)
+        self.adopt_legacy_files(store)
+
+        local_filenames = [row[0] for row in db.Attachment.select(
+            db.Attachment.local
+        ).where(db.Attachment.local != None).distinct().tuples()]
+        with dbo.atomic():
+            db.Attachment.update(ref_count=0).where(db.Attachment.local == None).execute()
+            self.update_attachment_ref_count(local_filenames)
+
+        removed_count, removed_bytes = store.collect_garbage(set(local_filenames))
+        logging.info('整理图片缓存完成，删除{0}个文件，释放{1:.1f}MB空间'.format(removed_count, removed_bytes / 1024 / 1024))
+
+
 class SyncAccountTask(Task):
     _name = '同步我的帐号'
 
@@ -1807,6 +1722,19 @@ class SyncAccountTask(Task):
         self.sync_account()
 
 
+class SearchIndexTask(Task):
+    _name = '重建搜索索引'
+
+    def run(self):
+        if not fulltext.is_ready():
+            logging.warn('当前环境不支持全文索引')
+            return
+        for kind, spec in fulltext.KINDS.items():
+            indexed_count = fulltext.rebuild(kind)
+            logging.info('{0}索引完成，共{1}条'.format(spec.label, indexed_count))
+        logging.info('重建搜索索引全部完成')
+
+
 ALL_TASKS = OrderedDict([(cls._name, cls) for cls in [
     FollowingFollowerTask,
     BroadcastTask,
@@ -1817,6 +1745,12 @@ ALL_TASKS = OrderedDict([(cls._name, cls) for cls in [
     NoteTask,
     PhotoAlbumTask,
     LikeTask,
+    AttachmentGCTask,
+    SearchIndexTask,
     #ReviewTask,
     #DoulistTask,
 ]])
+
+# 可以从任务队列中恢复的任务，包括不在界面上列出的任务
+TASK_TYPES = OrderedDict(ALL_TASKS)
+TASK_TYPES[SyncAccountTask._name] = SyncAccountTask
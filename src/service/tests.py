@@ -20,8 +20,7 @@ class DownloadPictureTask(tasks.LikeTask):
 
     def run(self):
         if self._image_local_cache:
-            while self.fetch_attachment():
-                pass
+            self.download_attachments()
 
 
 class TestTask(tasks.BroadcastTask):
@@ -44,9 +43,11 @@ task = tasks.NoteTask(db.Account.get_by_id(1))
 
 result = task(
     requests_per_minute=30,
+    concurrent_requests=4,
     local_object_duration=60*60*24*300,
     broadcast_active_duration=60*60*24*10,
     broadcast_incremental_backup=True,
-    image_local_cache=True
+    image_local_cache=True,
+    http_cache=True,
 )
 print(result)
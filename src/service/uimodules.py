@@ -22,7 +22,7 @@ class Movie(tornado.web.UIModule):
 
     def render(self, douban_id):
         try:
-            movie = db.Movie.get(db.Movie.douban_id == douban_id)
+            movie = db.read_only(db.Movie.select().where(db.Movie.douban_id == douban_id)).get()
         except db.Movie.DoesNotExist:
             movie = None
         return self.render_string('modules/movie.html', movie=movie)
@@ -36,7 +36,7 @@ class Book(tornado.web.UIModule):
 
     def render(self, douban_id):
         try:
-            book = db.Book.get(db.Book.douban_id == douban_id)
+            book = db.read_only(db.Book.select().where(db.Book.douban_id == douban_id)).get()
         except db.Book.DoesNotExist:
             book = None
         return self.render_string('modules/book.html', book=book)
@@ -49,7 +49,7 @@ class Music(tornado.web.UIModule):
 
     def render(self, douban_id):
         try:
-            music = db.Music.get(db.Music.douban_id == douban_id)
+            music = db.read_only(db.Music.select().where(db.Music.douban_id == douban_id)).get()
         except db.Music.DoesNotExist:
             music = None
         return self.render_string('modules/music.html', music=music)
@@ -62,7 +62,7 @@ class Note(tornado.web.UIModule):
 
     def render(self, douban_id):
         try:
-            note = db.Note.get(db.Note.douban_id == douban_id)
+            note = db.read_only(db.Note.select().where(db.Note.douban_id == douban_id)).get()
         except db.Note.DoesNotExist:
             note = None
         return self.render_string('modules/note.html', note=note)
@@ -75,7 +75,7 @@ class User(tornado.web.UIModule):
 
     def render(self, douban_id):
         try:
-            user = db.User.get(db.User.douban_id == douban_id)
+            user = db.read_only(db.User.select().where(db.User.douban_id == douban_id)).get()
         except db.User.DoesNotExist:
             user = None
         return self.render_string('modules/user.html', user=user)
@@ -0,0 +1,258 @@
+# encoding: utf-8
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import db
+from dbwriter import DatabaseWriter
+
+
+class CompressTextTest(unittest.TestCase):
+
+    def tearDown(self):
+        db._dictionaries.clear()
+        db._current_dictionaries.clear()
+
+    def test_short_text(self):
+        value = db.compress_text('短文本', ('note', 'content'))
+        self.assertEqual(value[:1], db._RAW)
+        self.assertEqual(db.decompress_text(value), '短文本')
+
+    def test_long_text(self):
+        text = '<div class="note">豆瓣日记</div>' * 50
+        value = db.compress_text(text, ('note', 'content'))
+        self.assertEqual(value[:1], db._DEFLATE)
+        self.assertLess(len(value), len(text.encode()))
+        self.assertEqual(db.decompress_text(value), text)
+
+    def test_dictionary(self):
+        samples = ['<div class="status-item" data-sid="{0}"><p>第 {0} 条广播</p></div>'.format(index) for index in range(20)]
+        dictionary = db.train_dictionary(samples)
+        self.assertTrue(dictionary)
+        db._dictionaries[7] = dictionary
+        db._current_dictionaries[('broadcast', 'content')] = (7, dictionary)
+
+        text = ''.join(samples)
+        value = db.compress_text(text, ('broadcast', 'content'))
+        self.assertEqual(value[:3], db._DEFLATE + b'\x07\x00')
+        self.assertEqual(db.decompress_text(value), text)
+        self.assertLess(len(value), len(db.compress_text(text, ('note', 'content'))))
+
+    def test_legacy_text(self):
+        self.assertIsNone(db.decompress_text(None))
+        self.assertEqual(db.decompress_text('未压缩'), '未压缩')
+        self.assertEqual(db.decompress_text(memoryview(db._RAW + '文本'.encode())), '文本')
+
+
+class JsonFromReprTest(unittest.TestCase):
+
+    def test_repr(self):
+        value = db._json_from_repr(repr({'average': 8.5, 'tags': ['剧情', "It's"], 'numRaters': None}))
+        self.assertEqual(json.loads(value), {'average': 8.5, 'tags': ['剧情', "It's"], 'numRaters': None})
+
+    def test_json(self):
+        self.assertEqual(db._json_from_repr('{"a": [1, 2]}'), '{"a": [1, 2]}')
+        self.assertEqual(json.loads(db._json_from_repr('{"a": true, "b": null}')), {'a': True, 'b': None})
+
+    def test_text(self):
+        self.assertIsNone(db._json_from_repr(None))
+        self.assertEqual(json.loads(db._json_from_repr('剧情')), '剧情')
+
+
+class BulkUpsertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db.init(os.path.join(self.directory, 'test.db'))
+
+    def tearDown(self):
+        if not db.dbo.is_closed():
+            db.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def user(self, douban_id, **kwargs):
+        row = {'douban_id': douban_id, 'unique_name': 'user' + douban_id, 'name': '用户' + douban_id, 'version': 1}
+        row.update(kwargs)
+        return row
+
+    def test_insert_and_update(self):
+        ids = db.User.bulk_upsert([self.user('1'), self.user('2')])
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual(db.User.bulk_upsert([self.user('3'), self.user('2', name='新名字')]), [ids[1] + 1, ids[1]])
+        self.assertEqual(db.User.get_by_id(ids[1]).name, '新名字')
+        self.assertEqual(db.User.get_by_id(ids[0]).name, '用户1')
+        self.assertEqual(db.User.select().count(), 3)
+
+    def test_duplicate_keys(self):
+        ids = db.User.bulk_upsert([self.user('1'), self.user('1', name='后一行')])
+        self.assertEqual(ids[0], ids[1])
+        self.assertEqual(db.User.get_by_id(ids[0]).name, '后一行')
+
+    def test_preserve(self):
+        user_id, = db.User.bulk_upsert([self.user('1', signature='签名')])
+        db.User.bulk_upsert([self.user('1', signature='新签名', name='新名字')], preserve=('signature',))
+        user = db.User.get_by_id(user_id)
+        self.assertEqual(user.signature, '签名')
+        self.assertEqual(user.name, '新名字')
+
+    def test_version(self):
+        user_id, = db.User.bulk_upsert([self.user('1')])
+        db.User.bulk_upsert([self.user('1', name='新名字')])
+        db.User.bulk_upsert([self.user('1', name='又改了')])
+        self.assertEqual(db.User.get_by_id(user_id).version, 3)
+
+    def test_unprovided_fields(self):
+        user_id, = db.User.bulk_upsert([self.user('1', signature='签名')])
+        db.User.bulk_upsert([{'douban_id': '1', 'name': '新名字', 'version': 1}, self.user('2')])
+        user = db.User.get_by_id(user_id)
+        self.assertEqual(user.name, '新名字')
+        self.assertEqual(user.signature, '签名')
+        self.assertEqual(user.unique_name, 'user1')
+
+        with self.assertRaises(db.IntegrityError):
+            db.User.bulk_upsert([{'douban_id': '3', 'name': '新用户', 'version': 1}])
+
+
+class AtVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db.init(os.path.join(self.directory, 'test.db'))
+        self.user = db.User.create(douban_id='1', unique_name='ahbei', name='阿北', version=1)
+
+    def tearDown(self):
+        if not db.dbo.is_closed():
+            db.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def save_note(self, day, **kwargs):
+        row = {
+            'douban_id': '100',
+            'user': self.user.id,
+            'title': '标题',
+            'content': '<p>日记内容</p>' * 20,
+            'views_count': 1,
+            'version': 1,
+            'updated_at': datetime.datetime(2018, 1, day),
+        }
+        row.update(kwargs)
+        db.Note.bulk_upsert([row], revisions=True)
+
+    def test_at_version(self):
+        self.save_note(1)
+        self.save_note(2, title='新标题')
+        self.save_note(3, title='新标题', content='<p>改过的内容</p>' * 20)
+        note = db.Note.get(db.Note.douban_id == '100')
+        self.assertEqual(note.version, 3)
+        self.assertEqual([revision.version for revision in note.revisions()], [2, 1])
+
+        first = note.at_version(1)
+        self.assertEqual(first.version, 1)
+        self.assertEqual(first.title, '标题')
+        self.assertEqual(first.content, '<p>日记内容</p>' * 20)
+        self.assertEqual(first.updated_at, datetime.datetime(2018, 1, 1))
+
+        second = note.at_version(2)
+        self.assertEqual(second.title, '新标题')
+        self.assertEqual(second.content, '<p>日记内容</p>' * 20)
+
+        self.assertIs(note.at_version(3), note)
+        with self.assertRaises(db.Revision.DoesNotExist):
+            note.at_version(4)
+
+    def test_counters_do_not_create_versions(self):
+        self.save_note(1)
+        self.save_note(2, views_count=5)
+        note = db.Note.get(db.Note.douban_id == '100')
+        self.assertEqual(note.version, 1)
+        self.assertEqual(note.views_count, 5)
+        self.assertEqual(list(note.revisions()), [])
+
+    def test_counters(self):
+        self.save_note(1)
+        self.assertEqual(db.Counter.select().count(), 0)
+        self.save_note(2)
+        self.assertEqual(db.Counter.select().count(), 0)
+        self.save_note(3, views_count=5)
+        self.assertEqual(db.Counter.select().count(), 1)
+
+
+class WriterCounterTest(unittest.TestCase):
+    """
+    工作进程通过写入线程保存计数，Counter 的 values 是 BLOB
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'test.db')
+        db.init(path)
+        user_id = db.User.create(douban_id='1', unique_name='ahbei', name='阿北', version=1).id
+        db.dbo.close()
+        self.writer = DatabaseWriter(path, db.DATEBASE_PRAGMAS)
+        self.writer.start()
+        db.init(path, False, db.DEFAULT_PRAGMAS, self.writer.client())
+        self.row = {'douban_id': '100', 'user': user_id, 'title': '标题', 'views_count': 1, 'version': 1}
+
+    def tearDown(self):
+        if not db.dbo.is_closed():
+            db.dbo.close()
+        self.writer.stop()
+        db.dbo.writer = None
+        shutil.rmtree(self.directory)
+
+    def test_counter_change(self):
+        db.Note.bulk_upsert([self.row], revisions=True)
+        self.row['views_count'] = 5
+        db.Note.bulk_upsert([self.row], revisions=True)
+        note = db.Note.get(db.Note.douban_id == '100')
+        self.assertEqual(note.views_count, 5)
+        counter = db.Counter.get(db.Counter.target_id == note.id)
+        self.assertEqual(db.Counter.unpack(bytes(counter.values))[0], 5)
+
+
+class MigrateRevisionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        db.init(os.path.join(self.directory, 'test.db'))
+        self.user = db.User.create(douban_id='1', unique_name='ahbei', name='阿北', version=3)
+        db.dbo.execute_sql('CREATE TABLE "user_historical" AS SELECT * FROM "user" WHERE 0')
+        db.dbo.execute_sql('ALTER TABLE "user_historical" ADD COLUMN "user_id" INTEGER')
+
+    def tearDown(self):
+        if not db.dbo.is_closed():
+            db.dbo.close()
+        shutil.rmtree(self.directory)
+
+    def add_history(self, user_id, version, name):
+        db.dbo.execute_sql(
+            'INSERT INTO "user_historical" ("douban_id", "unique_name", "name", "version", "user_id") VALUES (?, ?, ?, ?, ?)',
+            ['1', 'ahbei', name, version, user_id]
+        )
+
+    def test_migrate(self):
+        self.add_history(self.user.id, 1, '阿北一')
+        self.add_history(self.user.id, 2, '阿北')
+        db._migrate_revisions(None)
+        self.assertNotIn('user_historical', db.dbo.get_tables())
+        self.assertEqual(self.user.at_version(1).name, '阿北一')
+        self.assertEqual(self.user.at_version(2).name, '阿北')
+        self.assertEqual([revision.version for revision in self.user.revisions()], [2, 1])
+
+    def test_orphaned_history(self):
+        orphan_id = self.user.id + 1
+        self.add_history(orphan_id, 1, '已注销')
+        db._migrate_revisions(None)
+        revision = db.Revision.get(db.Revision.target_type == 'user', db.Revision.target_id == orphan_id)
+        self.assertEqual(revision.version, 1)
+        changes = json.loads(revision.changes)
+        self.assertEqual(changes['name'], '已注销')
+        self.assertEqual(changes['unique_name'], 'ahbei')
+        self.assertNotIn('version', changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
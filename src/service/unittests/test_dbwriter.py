@@ -0,0 +1,245 @@
+# encoding: utf-8
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import dbwriter
+from dbwriter import DatabaseWriter, WriterClient
+
+
+OK = ([], None, None, -1)
+
+
+class DatabaseWriterTest(unittest.TestCase):
+    """
+    直接调用写入线程的 _handle，检查合并提交、工作进程事务和事务回滚
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+        conn.close()
+        self.writer = DatabaseWriter(self.path)
+        self.writer._conn = self.writer._connect()
+        self.replies = {}
+        for client_id in (1, 2):
+            self.replies[client_id] = self.writer._replies[client_id] = queue.Queue()
+
+    def tearDown(self):
+        self.writer._conn.close()
+        shutil.rmtree(self.directory)
+
+    def insert(self, client_id, thread_id, request_id, name):
+        self.writer._handle(client_id, thread_id, request_id, 'execute', 'INSERT INTO item (name) VALUES (?)', [name])
+
+    def names(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return [name for name, in conn.execute('SELECT name FROM item ORDER BY id')]
+        finally:
+            conn.close()
+
+    def reply(self, client_id):
+        return self.replies[client_id].get_nowait()
+
+    def test_group_commit(self):
+        self.insert(1, 1, 'a', 'a')
+        self.insert(2, 1, 'b', 'b')
+        self.assertEqual(self.writer._group_size, 2)
+        self.assertTrue(self.replies[1].empty())
+        self.assertTrue(self.replies[2].empty())
+        self.assertEqual(self.names(), [])
+
+        self.writer._commit()
+        self.assertEqual(self.reply(1)[:2], ('a', 'ok'))
+        self.assertEqual(self.reply(2)[:2], ('b', 'ok'))
+        self.assertEqual(self.names(), ['a', 'b'])
+
+    def test_on_commit(self):
+        committed = []
+        self.writer._on_commit = committed.append
+        self.insert(1, 1, 'a', 'a')
+        self.writer._handle(2, 1, 'b', 'execute', 'SELECT name FROM item', [])
+        self.writer._commit()
+        self.assertEqual(committed, [{'item'}])
+
+        self.writer._handle(2, 1, 'c', 'execute', 'SELECT name FROM item', [])
+        self.writer._commit()
+        self.assertEqual(committed, [{'item'}])
+
+    def test_failed_statement_does_not_affect_group(self):
+        self.insert(1, 1, 'a', 'a')
+        self.insert(2, 1, 'b', 'a')
+        self.assertEqual(self.reply(2)[:3], ('b', 'error', 'IntegrityError'))
+
+        self.writer._commit()
+        self.assertEqual(self.reply(1)[:2], ('a', 'ok'))
+        self.assertEqual(self.names(), ['a'])
+
+    def test_transaction_savepoint(self):
+        self.writer._handle(1, 1, 'begin', 'begin', None, None)
+        self.assertEqual(self.reply(1), ('begin',) + ('ok',) + OK)
+        self.insert(1, 1, 'a', 'a')
+        self.assertEqual(self.reply(1)[:2], ('a', 'ok'))
+
+        # 同一客户端其他线程的请求不加入事务
+        self.insert(1, 2, 'b', 'b')
+        self.insert(2, 1, 'c', 'c')
+        self.assertEqual(len(self.writer._deferred), 2)
+
+        self.writer._handle(1, 1, 'rollback', 'rollback', None, None)
+        self.assertEqual(self.reply(1)[:2], ('rollback', 'ok'))
+        self.assertIsNone(self.writer._owner)
+        while self.writer._deferred:
+            self.writer._handle(*self.writer._deferred.popleft())
+        self.writer._commit()
+        self.assertEqual(self.names(), ['b', 'c'])
+
+    def test_transaction_commit(self):
+        self.writer._handle(1, 1, 'begin', 'begin', None, None)
+        self.insert(1, 1, 'a', 'a')
+        self.writer._handle(1, 1, 'commit', 'commit', None, None)
+        self.reply(1)
+        self.reply(1)
+        self.assertTrue(self.replies[1].empty())
+
+        self.writer._commit()
+        self.assertEqual(self.reply(1)[:2], ('commit', 'ok'))
+        self.assertEqual(self.names(), ['a'])
+
+    def test_abort(self):
+        self.writer._handle(1, 1, 'begin', 'begin', None, None)
+        self.insert(1, 1, 'a', 'a')
+        self.writer._abort_owner()
+        self.assertIn((1, 1), self.writer._aborted)
+        self.reply(1)
+        self.reply(1)
+
+        self.insert(1, 1, 'b', 'b')
+        self.assertEqual(self.reply(1)[:3], ('b', 'error', 'OperationalError'))
+        self.writer._handle(1, 1, 'commit', 'commit', None, None)
+        self.assertEqual(self.reply(1)[:2], ('commit', 'error'))
+        self.assertNotIn((1, 1), self.writer._aborted)
+
+        self.insert(1, 1, 'c', 'c')
+        self.writer._commit()
+        self.assertEqual(self.names(), ['c'])
+
+    def test_rollback_after_abort(self):
+        self.writer._handle(1, 1, 'begin', 'begin', None, None)
+        self.writer._abort_owner()
+        self.reply(1)
+        self.writer._handle(1, 1, 'rollback', 'rollback', None, None)
+        self.assertEqual(self.reply(1)[:2], ('rollback', 'ok'))
+        self.assertFalse(self.writer._aborted)
+
+    def test_release(self):
+        self.writer._handle(1, 1, 'begin', 'begin', None, None)
+        self.insert(1, 1, 'a', 'a')
+        self.insert(1, 2, 'b', 'b')
+        self.writer._handle(1, None, None, 'release', None, None)
+        self.assertIsNone(self.writer._owner)
+        self.assertFalse(self.writer._deferred)
+        self.assertNotIn(1, self.writer._replies)
+        self.writer._commit()
+        self.assertEqual(self.names(), [])
+
+
+class WriterClientTest(unittest.TestCase):
+    """
+    同一个客户端被多个线程共用
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, name TEXT, data BLOB)')
+        conn.close()
+        self.writer = DatabaseWriter(self.path)
+        self.writer.start()
+        self.client = self.writer.client()
+
+    def tearDown(self):
+        self.writer.stop()
+        shutil.rmtree(self.directory)
+
+    def test_threads(self):
+        errors = []
+
+        def insert(thread_index):
+            try:
+                for index in range(20):
+                    _, _, lastrowid, rowcount = self.client.request(
+                        'execute', 'INSERT INTO item (name) VALUES (?)', ['{0}-{1}'.format(thread_index, index)]
+                    )
+                    self.assertEqual(rowcount, 1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=insert, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(errors, [])
+        rows, _, _, _ = self.client.request('execute', 'SELECT COUNT(*) FROM item', [])
+        self.assertEqual(rows, [(80,)])
+
+    def test_transaction_per_thread(self):
+        self.client.request('begin')
+        self.client.request('execute', 'INSERT INTO item (name) VALUES (?)', ['a'])
+
+        other = threading.Thread(
+            target=self.client.request, args=('execute', 'INSERT INTO item (name) VALUES (?)', ['b'])
+        )
+        other.start()
+        self.client.request('rollback')
+        other.join(30)
+        self.assertFalse(other.is_alive())
+
+        rows, _, _, _ = self.client.request('execute', 'SELECT name FROM item', [])
+        self.assertEqual(rows, [('b',)])
+
+    def test_blob(self):
+        conn = sqlite3.connect(self.path)
+        connection = self.client.connect(conn)
+        connection.execute('INSERT INTO item (name, data) VALUES (?, ?)', ['a', memoryview(b'\x00\x01')])
+        connection.executemany('INSERT INTO item (name, data) VALUES (?, ?)', [['b', bytearray(b'\x02')]])
+        rows, _, _, _ = self.client.request('execute', 'SELECT name, data FROM item ORDER BY id', [])
+        self.assertEqual(rows, [('a', b'\x00\x01'), ('b', b'\x02')])
+        connection.close()
+
+    def test_unpicklable(self):
+        with self.assertRaises(sqlite3.InterfaceError):
+            self.client.request('execute', 'INSERT INTO item (name) VALUES (?)', [lambda: None])
+        rows, _, _, _ = self.client.request('execute', 'SELECT COUNT(*) FROM item', [])
+        self.assertEqual(rows, [(0,)])
+
+    def test_reply_timeout(self):
+        reply_timeout = dbwriter.REPLY_TIMEOUT
+        dbwriter.REPLY_TIMEOUT = 0.2
+        try:
+            client = DatabaseWriter(self.path).client()
+            with self.assertRaises(sqlite3.OperationalError):
+                client.request('execute', 'SELECT 1', [])
+        finally:
+            dbwriter.REPLY_TIMEOUT = reply_timeout
+
+    def test_pickle(self):
+        state = self.client.__getstate__()
+        self.assertNotIn('_condition', state)
+        client = WriterClient.__new__(WriterClient)
+        client.__setstate__(state)
+        self.assertIsNotNone(client._condition)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# encoding: utf-8
+import unittest
+from types import SimpleNamespace
+
+import fulltext
+
+
+class ExtractTest(unittest.TestCase):
+
+    def test_movie(self):
+        movie = SimpleNamespace(
+            douban_id='1292052',
+            title='肖申克的救赎',
+            alt_title='The Shawshank Redemption',
+            author=[{'name': '弗兰克·德拉邦特'}],
+            summary='二十世纪四十年代末',
+            tags=[{'count': 100, 'name': '经典'}, {'count': 50, 'name': '励志'}],
+        )
+        title, body, route, route_arg = fulltext._extract_movie(movie)
+        self.assertEqual(title, '肖申克的救赎\nThe Shawshank Redemption')
+        self.assertEqual(body, '弗兰克·德拉邦特\n二十世纪四十年代末\n经典 励志')
+        self.assertEqual((route, route_arg), ('movie', '1292052'))
+
+    def test_book(self):
+        book = SimpleNamespace(
+            douban_id='1084336',
+            title='小王子',
+            subtitle=None,
+            origin_title='Le Petit Prince',
+            author=['圣埃克苏佩里'],
+            publisher='人民文学出版社',
+            summary=None,
+            author_intro='',
+            tags=[{'name': '童话', 'title': '童话'}, {'count': 3}],
+        )
+        title, body, _, _ = fulltext._extract_book(book)
+        self.assertEqual(title, '小王子\nLe Petit Prince')
+        self.assertEqual(body, '圣埃克苏佩里\n人民文学出版社\n童话')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# encoding: utf-8
+import os
+import unittest
+
+from tasks import parsers
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+class ListPageTest(unittest.TestCase):
+
+    def test_note_list(self):
+        self.assertEqual(parsers.parse_note_list_page(fixture('note_list.html')), {
+            'items': ['https://www.douban.com/note/100/', 'https://www.douban.com/note/101/'],
+            'next': 'https://www.douban.com/people/ahbei/notes?start=10',
+        })
+
+    def test_photo_album_list(self):
+        self.assertEqual(parsers.parse_photo_album_list_page(fixture('photo_album_list.html')), {
+            'items': [
+                ('https://www.douban.com/photos/album/200/', 'https://img3.doubanio.com/view/photo/albumcover/public/p200.jpg', '2017-05-01'),
+                ('https://www.douban.com/photos/album/201/', 'https://img3.doubanio.com/view/photo/albumcover/public/p201.jpg', '2018-02-14'),
+            ],
+            'next': None,
+        })
+
+
+class StatusPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.page = parsers.parse_status_page(fixture('status_page.html'))
+
+    def test_statuses(self):
+        # 被删除的广播不返回
+        self.assertEqual([detail['douban_id'] for detail, _ in self.page['statuses']], ['300', '310'])
+        self.assertEqual(self.page['user_ids'], ['1000001', '1000001', '1000002', '1000003'])
+
+    def test_saying(self):
+        detail, reshared = self.page['statuses'][0]
+        self.assertIsNone(reshared)
+        self.assertTrue(detail['content'].startswith('<div class="new-status status-wrapper saying"'))
+        del detail['content']
+        self.assertEqual(detail, {
+            'douban_id': '300',
+            'douban_user_id': '1000001',
+            'created': '2018-04-01 12:00:00',
+            'is_reshared': False,
+            'is_saying': True,
+            'is_noreply': False,
+            'reshared_count': '1',
+            'like_count': '5',
+            'comments_count': '2',
+            'status_url': 'https://www.douban.com/people/ahbei/status/300/',
+            'target_type': 'sns',
+            'object_kind': '1018',
+            'object_id': '300',
+            'blockquote': '<p>今天天气<b>不错</b></p>',
+            'attachments': [{'type': 'image', 'url': 'https://img3.doubanio.com/view/status/raw/public/p301.jpg'}],
+        })
+
+    def test_reshared(self):
+        detail, reshared = self.page['statuses'][1]
+        self.assertTrue(detail['is_reshared'])
+        self.assertEqual(detail['reshared_id'], '305')
+        self.assertEqual(detail['like_count'], 3)
+        self.assertEqual(detail['reshared_count'], 0)
+        self.assertEqual(reshared['douban_id'], '305')
+        self.assertEqual(reshared['douban_user_id'], '1000002')
+        self.assertEqual(reshared['target_type'], 'note')
+        self.assertEqual(reshared['blockquote'], '写了日记')
+
+
+class NotePageTest(unittest.TestCase):
+
+    def test_note(self):
+        page = parsers.parse_note_page(fixture('note.html'))
+        note = page['note']
+        self.assertTrue(note['content'].startswith('<p>第一段</p>'))
+        del note['content']
+        self.assertEqual(note, {
+            'is_original': True,
+            'title': '第一篇日记',
+            'created': '2018-04-01 10:00:00',
+            'introduction': '日记的摘要',
+            'attachments': [{'type': 'image', 'url': 'https://img3.doubanio.com/view/note/l/public/p400.jpg'}],
+            'subjects': [{'type': 'movie', 'douban_id': '1292052'}],
+            'views_count': '128',
+            'like_count': '7',
+            'rec_count': '2',
+            'user_name': 'ahbei',
+        })
+        self.assertEqual(page['paginator'], {
+            'total_pages': 2,
+            'next': 'https://www.douban.com/note/100/?start=100#comments',
+        })
+
+    def test_comments(self):
+        comments = parsers.parse_note_page(fixture('note.html'))['comments']
+        for comment in comments:
+            del comment['content']
+        self.assertEqual(comments, [{
+            'douban_id': '500',
+            'user_name': 'friend',
+            'text': '写得好',
+            'created': '2018-04-01 11:00:00',
+            'quote': None,
+        }, {
+            'douban_id': '501',
+            'user_name': 'ahbei',
+            'text': '谢谢',
+            'created': '2018-04-01 12:00:00',
+            'quote': '朋友(friend):写得好',
+        }])
+
+
+class PhotoAlbumPageTest(unittest.TestCase):
+
+    def test_album(self):
+        page = parsers.parse_photo_album_page(fixture('photo_album.html'))
+        self.assertEqual(page['album'], {
+            'douban_id': '200',
+            'title': '旅行',
+            'desc': '去海边玩的照片',
+            'user_name': 'ahbei',
+            'views_count': '356',
+            'like_count': '9',
+            'rec_count': '4',
+        })
+        self.assertEqual(page['paginator'], {
+            'total_pages': 4,
+            'next': 'https://www.douban.com/photos/album/200/?m_start=18',
+        })
+
+    def test_pictures(self):
+        pictures = parsers.parse_photo_album_photos_page(fixture('photo_album.html'))['pictures']
+        self.assertEqual(pictures, [{
+            'douban_id': '600',
+            'desc': '海',
+            'url': 'https://www.douban.com/photos/photo/600/',
+            'picture': 'https://img3.doubanio.com/view/photo/l/public/p600.jpg',
+            'views_count': '42',
+            'comments_count': '3',
+        }, {
+            'douban_id': '601',
+            'desc': '沙滩',
+            'url': 'https://www.douban.com/photos/photo/601/',
+            'picture': 'https://img3.doubanio.com/view/photo/l/public/p601.jpg',
+            'views_count': '10',
+            'comments_count': None,
+        }])
+
+
+if __name__ == '__main__':
+    unittest.main()
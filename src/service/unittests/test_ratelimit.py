@@ -0,0 +1,43 @@
+# encoding: utf-8
+import time
+import unittest
+
+from ratelimit import TokenBucket, host_key
+
+
+class HostKeyTest(unittest.TestCase):
+
+    def test_host_key(self):
+        self.assertEqual(host_key('https://www.douban.com/people/ahbei/'), 'www.douban.com')
+        self.assertEqual(host_key('https://img3.doubanio.com/view/photo/l/public/p1.jpg'), 'doubanio.com')
+        self.assertEqual(host_key('https://example.com/'), '*')
+        self.assertEqual(host_key('not a url'), '*')
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def elapsed(self, bucket, url, times):
+        started = time.monotonic()
+        for _ in range(times):
+            bucket.acquire(url)
+        return time.monotonic() - started
+
+    def test_burst(self):
+        bucket = TokenBucket(60, burst=3)
+        self.assertLess(self.elapsed(bucket, 'https://www.douban.com/', 3), 0.1)
+
+    def test_rate(self):
+        # 每 0.1 秒一个令牌
+        bucket = TokenBucket(600, burst=1)
+        bucket.acquire('https://www.douban.com/')
+        self.assertGreaterEqual(self.elapsed(bucket, 'https://www.douban.com/', 3), 0.25)
+
+    def test_hosts_are_independent(self):
+        bucket = TokenBucket(1, burst=1)
+        bucket.acquire('https://www.douban.com/')
+        self.assertLess(self.elapsed(bucket, 'https://m.douban.com/', 1), 0.1)
+        self.assertLess(self.elapsed(bucket, 'https://img1.doubanio.com/a.jpg', 1), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
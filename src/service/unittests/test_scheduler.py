@@ -0,0 +1,76 @@
+# encoding: utf-8
+import unittest
+
+from scheduler import DIRECT, Scheduler
+
+
+class Task:
+
+    def __init__(self, account_id):
+        self.account_id = account_id
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, self.account_id)
+
+
+class FollowingTask(Task):
+    pass
+
+
+class NoteTask(Task):
+    pass
+
+
+class PhotoTask(Task):
+    pass
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def pop_all(self, scheduler, route=DIRECT):
+        tasks = []
+        while True:
+            task = scheduler.pop(route)
+            if task is None:
+                return tasks
+            tasks.append(task)
+
+    def test_round_robin(self):
+        scheduler = Scheduler()
+        first = [FollowingTask(1), NoteTask(1), PhotoTask(1)]
+        second = [FollowingTask(2), NoteTask(2)]
+        for task in first + second:
+            scheduler.push(task)
+        self.assertEqual(len(scheduler), 5)
+        self.assertEqual(self.pop_all(scheduler), [first[0], second[0], first[1], second[1], first[2]])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_priority(self):
+        scheduler = Scheduler()
+        normal = FollowingTask(1)
+        urgent = NoteTask(2)
+        scheduler.push(normal)
+        scheduler.push(urgent, priority=True)
+        self.assertEqual(scheduler.tasks, [urgent, normal])
+        self.assertEqual(self.pop_all(scheduler), [urgent, normal])
+
+    def test_duplicate(self):
+        scheduler = Scheduler()
+        self.assertTrue(scheduler.push(FollowingTask(1)))
+        self.assertFalse(scheduler.push(FollowingTask(1)))
+        self.assertTrue(scheduler.push(FollowingTask(2)))
+        self.assertIn(FollowingTask(1), scheduler)
+        self.assertNotIn(NoteTask(1), scheduler)
+
+    def test_route(self):
+        scheduler = Scheduler()
+        proxied = FollowingTask(1)
+        anywhere = NoteTask(1)
+        scheduler.push(proxied, route='http://proxy:8080')
+        scheduler.push(anywhere)
+        self.assertEqual(self.pop_all(scheduler), [anywhere])
+        self.assertEqual(self.pop_all(scheduler, 'http://proxy:8080'), [proxied])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 # encoding: utf-8
 import logging
+import signal
 import traceback
 from enum import Enum
 from inspect import isgeneratorfunction
@@ -11,13 +12,22 @@ import tasks
 
 
 REQUESTS_PER_MINUTE = 60
+CONCURRENT_REQUESTS = 4
 LOCAL_OBJECT_DURATION = 60 * 60 * 24 * 30
 BROADCAST_ACTIVE_DURATION = 60 * 60 * 24 * 30
 BROADCAST_INCREMENTAL_BACKUP = True
 IMAGE_LOCAL_CACHE = True
+HTTP_CACHE = True
+# 每个工作进程的解析进程数，0 表示按 CPU 核数平均分配给所有工作进程
+PARSE_PROCESSES = 0
 HEARTBEAT_INTERVAL = 10
 
 
+def _terminate(signum, frame):
+    # 让 Process.terminate() 像正常退出一样展开调用栈，执行清理代码
+    raise SystemExit()
+
+
 class Worker:
     """
     工作进程封装
@@ -114,6 +124,20 @@ class Worker:
     def name(self):
         return self._name
 
+    @property
+    def proxy(self):
+        """
+        工作进程使用的代理，不使用代理时为 None
+        """
+        return self._settings.get('proxy')
+
+    @property
+    def db_writer(self):
+        """
+        服务进程中写入线程的客户端，没有时工作进程直接写入数据库
+        """
+        return self._settings.get('db_writer')
+
     def __str__(self):
         return self.name
 
@@ -136,29 +160,35 @@ class Worker:
         self.queue_out.put(Worker.ReturnHeartbeat(self._name, sequence))
 
     def __call__(self, *args, **kwargs):
+        signal.signal(signal.SIGTERM, _terminate)
         queue_in = self.queue_in
         queue_out = self.queue_out
         logger = logging.getLogger()
         logger.addHandler(QueueHandler(queue_out))
         logger.setLevel(logging.DEBUG if self._debug else logging.INFO)
-        db.init(self._settings['db_path'], False)
+        db.init(self._settings['db_path'], False, self._settings.get('db_pragmas', db.DEFAULT_PRAGMAS), self.db_writer)
+        parse_pool = tasks.ParsePool(self._settings.get('parse_processes', 0))
 
         self._ready()
 
         heartbeat_sequence = 1
-        while True:
-            try:
-                task = queue_in.get(timeout=HEARTBEAT_INTERVAL)
-                if isinstance(task, tasks.Task):
-                    self._work(str(task))
-                    self._done(task(**self._settings))
-            except queues.Empty:
-                self._heartbeat(heartbeat_sequence)
-                heartbeat_sequence += 1
-            except Exception as e:
-                self._error(e, traceback.format_exc())
-            except KeyboardInterrupt:
-                break
+        try:
+            while True:
+                try:
+                    task = queue_in.get(timeout=HEARTBEAT_INTERVAL)
+                    if isinstance(task, tasks.Task):
+                        self._work(str(task))
+                        self._done(task(parse_pool=parse_pool, **self._settings))
+                except queues.Empty:
+                    self._heartbeat(heartbeat_sequence)
+                    heartbeat_sequence += 1
+                except Exception as e:
+                    self._error(e, traceback.format_exc())
+                except KeyboardInterrupt:
+                    break
+        finally:
+            # 工作进程被 stop() 终止时也要关闭解析进程，否则它们会一直留在系统中
+            parse_pool.close()
 
     def start(self):
         if self.is_pending():